@@ -0,0 +1,79 @@
+"""
+Import time benchmark for the console script modules. Every cluster job starts one of these entry points, so their
+startup cost is paid once per specimen. Each module is imported in a fresh interpreter with `python -X importtime`
+and the best cumulative time over a few repeats is compared to a budget. Exits with 1 when any module is over budget.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --budget_ms 300 --repeats 5
+"""
+import argparse
+import subprocess
+import sys
+
+# console script module -> import budget in milliseconds
+DEFAULT_BUDGETS_MS = {
+    "skeleton_keychain.run_feature_pipeline": 400,
+    "skeleton_keychain.quality_control_swc_files": 400,
+}
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: (str): stderr of `python -X importtime`
+    :return: (list) of (module name, self us, cumulative us) in import order
+    """
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        records.append((name.strip(), int(self_us), int(cumulative_us)))
+    return records
+
+
+def measure_import(module_name, python=sys.executable):
+    """
+    Import a module in a fresh interpreter
+
+    :return: (int) cumulative import time of the module in microseconds, (list) see parse_importtime
+    """
+    result = subprocess.run([python, "-X", "importtime", "-c", f"import {module_name}"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module_name} failed:\n{result.stderr[-2000:]}")
+    records = parse_importtime(result.stderr)
+    cumulative_us = [c for name, _, c in records if name == module_name]
+    return cumulative_us[-1], records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=list(DEFAULT_BUDGETS_MS.keys()))
+    parser.add_argument("--budget_ms", type=float, default=None,
+                        help="budget for every module, overrides the per module defaults")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show per module")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module_name in args.modules:
+        budget_ms = args.budget_ms if args.budget_ms is not None else DEFAULT_BUDGETS_MS.get(module_name, 400)
+        runs = [measure_import(module_name) for _ in range(args.repeats)]
+        best_us, records = min(runs, key=lambda r: r[0])
+        best_ms = best_us / 1000
+
+        status = "OK" if best_ms <= budget_ms else "OVER BUDGET"
+        print(f"{module_name}: {best_ms:.0f} ms (budget {budget_ms:.0f} ms) {status}")
+        for name, self_us, _ in sorted(records, key=lambda r: r[1], reverse=True)[:args.top]:
+            print(f"    {self_us / 1000:8.1f} ms  {name}")
+
+        if best_ms > budget_ms:
+            over_budget.append(module_name)
+
+    if over_budget:
+        print(f"Import time regressed past the budget for: {over_budget}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
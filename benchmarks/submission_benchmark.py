@@ -0,0 +1,258 @@
+"""
+Submission path benchmark. A fake sbatch (and sacct) that hands out synthetic job ids is put on PATH, then
+Slurm_DAG.submit_dag_to_scheduler and run_feature_pipeline.main are driven with synthetic cohorts. Reports wall time,
+per job overhead, sbatch processes spawned and the files written for each cohort size, so scaling regressions show up
+before they reach the cluster. Exits with 1 when --max_per_job_ms is given and exceeded.
+
+    python benchmarks/submission_benchmark.py
+    python benchmarks/submission_benchmark.py --sizes 100 1000 10000 100000 --configs arrays chunked_arrays
+    python benchmarks/submission_benchmark.py --sbatch_latency_ms 50 --output_json submission_benchmark.json
+    python benchmarks/submission_benchmark.py --sbatch_failure_rate 0.05 --submissions_per_second 200
+"""
+from contextlib import redirect_stdout
+import argparse
+import tempfile
+import shutil
+import json
+import stat
+import time
+import sys
+import os
+
+FAKE_SBATCH = """#!/bin/bash
+# fake sbatch: hands out increasing job ids and logs the call
+{fail}
+exec 9>"{bin_dir}/sbatch.lock"
+flock 9
+n=$(( $(cat "{bin_dir}/sbatch.counter" 2>/dev/null || echo 0) + 1 ))
+echo $n > "{bin_dir}/sbatch.counter"
+flock -u 9
+echo "$n $@" >> "{bin_dir}/sbatch.log"
+{sleep}
+echo "Submitted batch job $n"
+"""
+
+FAKE_SACCT = """#!/bin/bash
+# fake sacct: every requested job completed instantly
+ids="${@: -1}"
+for i in ${ids//,/ }; do
+    echo "$i|COMPLETED|2026-01-01T00:00:00|2026-01-01T00:00:00|2026-01-01T00:01:00|60||0:0"
+done
+"""
+
+# run_feature_pipeline.main options for each benchmarked configuration
+CONFIGS = {
+    "per_specimen": {},
+    "arrays": {"use_job_arrays": True},
+    "chunked_arrays": {"use_job_arrays": True, "specimens_per_job": 50},
+    "chunked_arrays_sharded": {"use_job_arrays": True, "specimens_per_job": 50, "histogram_shards": 10,
+                               "feature_shards": 10},
+}
+
+
+FAKE_SBATCH_FAILURE = """if (( RANDOM % 10000 < {threshold} )); then
+    echo "sbatch: error: Batch job submission failed: Socket timed out on send/recv operation" >&2
+    exit 1
+fi"""
+
+
+def install_fake_slurm(bin_dir, sbatch_latency_ms=0, sbatch_failure_rate=0):
+    """
+    Write fake sbatch and sacct scripts to bin_dir and put it first on PATH. sbatch_failure_rate of the sbatch calls
+    fail with a (transient) controller timeout before handing out a job id
+    """
+    sleep = f"sleep {sbatch_latency_ms / 1000}" if sbatch_latency_ms else ""
+    fail = FAKE_SBATCH_FAILURE.format(threshold=int(sbatch_failure_rate * 10000)) if sbatch_failure_rate else ""
+    for name, script in [("sbatch", FAKE_SBATCH.format(bin_dir=bin_dir, sleep=sleep, fail=fail)),
+                         ("sacct", FAKE_SACCT)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def count_sbatch_calls(bin_dir):
+    log_file = os.path.join(bin_dir, "sbatch.log")
+    if not os.path.exists(log_file):
+        return 0
+    with open(log_file, "r") as f:
+        return sum(1 for _ in f)
+
+
+def reset_fake_slurm(bin_dir):
+    for name in ["sbatch.log", "sbatch.counter"]:
+        path = os.path.join(bin_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def directory_usage(directory):
+    """(int) number of files, (int) total bytes under a directory"""
+    n_files, n_bytes = 0, 0
+    for root, _, files in os.walk(directory):
+        for f in files:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(root, f))
+    return n_files, n_bytes
+
+
+def benchmark_dag(n_specimens, work_dir, bin_dir, max_workers, submissions_per_second=None):
+    """
+    Submit a DAG shaped like a per specimen run (n file generation jobs, then histogram, features and post
+    processing) straight through Slurm_DAG
+    """
+    from skeleton_keychain.SlurmDAG import Slurm_DAG
+    from skeleton_keychain.executors import SlurmExecutor
+
+    job_dir = os.path.join(work_dir, "dag")
+    os.mkdir(job_dir)
+    nodes = []
+    for i in range(n_specimens):
+        nodes.append({"id": i + 1, "parent_ids": [], "name": f"{i}-file-gen",
+                      "job_file": os.path.join(job_dir, f"{i}.sh"),
+                      "slurm_kwargs": {"--job-name": f"seg-{i}", "--mem": "10gb", "--time": "96:00:00"},
+                      "slurm_commands": ["source ~/.bashrc", f"echo {i}"]})
+    last_ids = list(range(1, n_specimens + 1))
+    for name in ["histogram", "features", "postprocess"]:
+        nodes.append({"id": len(nodes) + 1, "parent_ids": last_ids, "name": name,
+                      "job_file": os.path.join(job_dir, f"{name}.sh"),
+                      "slurm_kwargs": {"--job-name": name}, "slurm_commands": [f"echo {name}"]})
+        last_ids = [len(nodes)]
+
+    start = time.perf_counter()
+    dag = Slurm_DAG(nodes)
+    build_s = time.perf_counter() - start
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        executor = SlurmExecutor(max_concurrent_submissions=max_workers, submissions_per_second=submissions_per_second,
+                                 submission_burst=max_workers)
+        dag.submit_dag_to_scheduler(executor=executor, max_workers=max_workers)
+    total_s = time.perf_counter() - start
+    return {"build_s": build_s, "wall_s": total_s, "jobs": len(nodes), "files": directory_usage(job_dir)}
+
+
+def benchmark_main(n_specimens, work_dir, config_name, config_kwargs, max_workers=8, submissions_per_second=None):
+    """Plan and submit a whole run_features run for a synthetic cohort"""
+    from skeleton_keychain.run_feature_pipeline import main
+
+    output_dir = os.path.join(work_dir, f"run_{config_name}")
+    os.mkdir(output_dir)
+    specimen_id_file = os.path.join(work_dir, "specimen_ids.txt")
+    with open(specimen_id_file, "w") as f:
+        for i in range(n_specimens):
+            f.write(f"{100000000 + i}\n")
+
+    main_kwargs = {
+        "input_specimen_id_txt": specimen_id_file,
+        "output_dir": output_dir,
+        "calculate_features": True,
+        "orientation_independent_features": False,
+        "species": "mouse",
+        "aligned_swc_dir": None,
+        "upright_swc_dir": None,
+        "slurm_virtual_env": "benchmark_env",
+        "layer_depths_file": None,
+        "raw_orientation_swc_dir": None,
+        "polygon_json_dir": None,
+        "shrinkage_correction": True,
+        "slice_angle_tilt_correction": False,
+        "analyze_apical_dendrite": False,
+        "analyze_basal_dendrite": True,
+        "analyze_axon": False,
+        "axon_depth_profile_loadings_file": None,
+        "basal_dendrite_depth_profile_loadings_file": None,
+        "apical_dendrite_depth_profile_loadings_file": None,
+        "surface_paths_file": None,
+        "closest_surface_voxel_file": None,
+        "save_axon_depth_profile_loadings_file": None,
+        "save_basal_dendrite_depth_profile_loadings_file": None,
+        "save_apical_dendrite_depth_profile_loadings_file": None,
+        "align_morph_to_layer_drawings": False,
+        "max_concurrent_submissions": max_workers,
+        "submissions_per_second": submissions_per_second,
+    }
+    main_kwargs.update(config_kwargs)
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        main(**main_kwargs)
+    wall_s = time.perf_counter() - start
+    return {"wall_s": wall_s, "files": directory_usage(output_dir)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS.keys()), choices=list(CONFIGS.keys()))
+    parser.add_argument("--skip_dag", action="store_true", help="don't benchmark Slurm_DAG on its own")
+    parser.add_argument("--sbatch_latency_ms", type=float, default=0,
+                        help="time the fake sbatch takes to answer, to mimic a busy slurmctld")
+    parser.add_argument("--sbatch_failure_rate", type=float, default=0,
+                        help="fraction of sbatch calls that fail with a transient controller timeout and are retried")
+    parser.add_argument("--max_workers", type=int, default=8, help="max number of sbatch calls running at once")
+    parser.add_argument("--submissions_per_second", type=float, default=None,
+                        help="rate limit of the sbatch calls, none by default")
+    parser.add_argument("--max_per_job_ms", type=float, default=None,
+                        help="fail when any benchmark spends more than this per submitted job")
+    parser.add_argument("--output_json", default=None, help="write the results to this json file")
+    args = parser.parse_args()
+
+    bench_dir = tempfile.mkdtemp(prefix="skeleton_keychain_submission_benchmark_")
+    bin_dir = os.path.join(bench_dir, "bin")
+    os.mkdir(bin_dir)
+    install_fake_slurm(bin_dir, args.sbatch_latency_ms, args.sbatch_failure_rate)
+
+    results = []
+    try:
+        for n_specimens in args.sizes:
+            benchmarks = [] if args.skip_dag else [("slurm_dag", None)]
+            benchmarks += [(config_name, CONFIGS[config_name]) for config_name in args.configs]
+            for name, config_kwargs in benchmarks:
+                work_dir = os.path.join(bench_dir, f"{name}_{n_specimens}")
+                os.mkdir(work_dir)
+                reset_fake_slurm(bin_dir)
+
+                if config_kwargs is None:
+                    result = benchmark_dag(n_specimens, work_dir, bin_dir, args.max_workers,
+                                           args.submissions_per_second)
+                else:
+                    result = benchmark_main(n_specimens, work_dir, name, config_kwargs, args.max_workers,
+                                            args.submissions_per_second)
+
+                n_jobs = count_sbatch_calls(bin_dir)
+                n_files, n_bytes = result.pop("files")
+                result.update({
+                    "benchmark": name,
+                    "n_specimens": n_specimens,
+                    "sbatch_calls": n_jobs,
+                    "per_job_ms": 1000 * result["wall_s"] / max(n_jobs, 1),
+                    "per_specimen_ms": 1000 * result["wall_s"] / n_specimens,
+                    "files_written": n_files,
+                    "bytes_written": n_bytes,
+                })
+                results.append(result)
+                print(f"{name:<24}{n_specimens:>8} specimens {result['wall_s']:>9.2f}s  {n_jobs:>7} sbatch calls "
+                      f"{result['per_job_ms']:>8.2f} ms/job {result['per_specimen_ms']:>8.3f} ms/specimen "
+                      f"{n_files:>7} files {n_bytes / 1024 ** 2:>8.1f} MB")
+                sys.stdout.flush()
+                shutil.rmtree(work_dir)
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump({"generated_at": time.time(), "sbatch_latency_ms": args.sbatch_latency_ms,
+                       "sbatch_failure_rate": args.sbatch_failure_rate, "max_workers": args.max_workers,
+                       "submissions_per_second": args.submissions_per_second, "results": results}, f, indent=2)
+
+    if args.max_per_job_ms is not None:
+        too_slow = [r for r in results if r["per_job_ms"] > args.max_per_job_ms]
+        if too_slow:
+            for r in too_slow:
+                print(f"{r['benchmark']} with {r['n_specimens']} specimens: {r['per_job_ms']:.2f} ms/job exceeds "
+                      f"{args.max_per_job_ms} ms/job")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
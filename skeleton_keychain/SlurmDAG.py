@@ -1,36 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
 from collections import deque
-import subprocess
+import queue
 import os
+from skeleton_keychain.executors import SlurmExecutor
+from skeleton_keychain.profiling import profile_job_commands
 
 
 class InvalidWorkflow(ValueError):
 
-    def __init__(self):
+    def __init__(self, reason=None):
         super().__init__()
+        self.reason = reason
 
     def __str__(self):
+        if self.reason is not None:
+            return f'The workflow graph is invalid: {self.reason}'
         return 'The workflow graph is invalid'
 
 
+def node_parent_ids(dag_node):
+    """
+    Parent node ids of a dag node. Nodes list their parents with parent_ids (list), the single parent_id key
+    (-1 meaning no parent) is still supported.
+
+    :param dag_node: (dict): dag node
+    :return: (list) parent node ids
+    """
+    if "parent_ids" in dag_node:
+        return list(dag_node["parent_ids"])
+    parent_id = dag_node.get("parent_id", -1)
+    if parent_id == -1:
+        return []
+    return [parent_id]
+
+
 def validate_slurm_dag(slurm_dag):
-    root_ct = len([item for item in slurm_dag.nodes if item['parent_id'] == -1])
-    if root_ct != 1:
-        raise InvalidWorkflow()
+    """
+    Check node ids are unique, every parent exists and the graph has no cycles. Runs in O(nodes + edges).
 
-    node_ids = [n['id'] for n in slurm_dag.nodes]
-    orphaned_nodes = [n for n in slurm_dag.nodes if (n['parent_id'] not in node_ids) and (n['parent_id'] != -1)]
-    if orphaned_nodes:
-        raise InvalidWorkflow()
+    :param slurm_dag: (Slurm_DAG)
+    :return: (list) node ids in topological order
+    """
+    node_ids = set()
+    for n in slurm_dag.nodes:
+        if n['id'] in node_ids:
+            raise InvalidWorkflow(f"duplicate node id {n['id']}")
+        node_ids.add(n['id'])
+
+    for node_id, parent_ids in slurm_dag.parent_index.items():
+        orphaned = [p for p in parent_ids if p not in node_ids]
+        if orphaned:
+            raise InvalidWorkflow(f"node {node_id} has unknown parents {orphaned}")
+
+    # Kahn's algorithm, any node left unvisited is part of a cycle
+    in_degree = {node_id: len(parent_ids) for node_id, parent_ids in slurm_dag.parent_index.items()}
+    ready = deque([node_id for node_id, degree in in_degree.items() if degree == 0])
+    topological_order = []
+    while ready:
+        node_id = ready.popleft()
+        topological_order.append(node_id)
+        for child_id in slurm_dag.children_index[node_id]:
+            in_degree[child_id] -= 1
+            if in_degree[child_id] == 0:
+                ready.append(child_id)
+
+    if len(topological_order) != len(slurm_dag.nodes):
+        cycle_nodes = [node_id for node_id, degree in in_degree.items() if degree > 0]
+        raise InvalidWorkflow(f"cycle detected between nodes {cycle_nodes[:10]}")
+
+    return topological_order
+
+
+def format_array_spec(array, array_throttle=None):
+    """
+    Build a slurm --array specification string. The array can be given as the number of tasks (int), an inclusive
+    (first, last) task index tuple, or an already formatted range string (e.g. "0-99,120").
+
+    :param array: (int), (tuple) or (str): array range description
+    :param array_throttle: (int): max number of array tasks slurm should run at once (the %N suffix)
+    :return: (str) array specification, e.g. "0-99%20"
+    """
+    if isinstance(array, bool):
+        raise ValueError(f"Invalid array specification {array}")
+
+    if isinstance(array, int):
+        if array < 1:
+            raise ValueError(f"An array job needs at least one task, got {array}")
+        array_spec = f"0-{array - 1}"
+    elif isinstance(array, (tuple, list)):
+        first, last = array
+        if first > last:
+            raise ValueError(f"Invalid array range {first}-{last}")
+        array_spec = f"{first}-{last}"
+    else:
+        array_spec = str(array)
 
+    if array_throttle is not None:
+        if array_throttle < 1:
+            raise ValueError(f"array_throttle must be a positive integer, got {array_throttle}")
+        array_spec = f"{array_spec}%{array_throttle}"
 
-def submit_job_return_id(job_file, parent_job_id, start_condition):
+    return array_spec
+
+
+def submit_job_return_id(job_file, parent_job_id, start_condition, array=None, array_throttle=None, executor=None):
     """
     Will submit a job file with the dependency type (start_condition) on parent_job_id. If a parent_job_id is
-    specified, a start condition must also be specified.
+    specified, a start condition must also be specified. When array is given the job file is submitted as a slurm
+    job array; the returned id is the array job id which downstream jobs can depend on as a whole.
 
     :param start_condition: (str): slurm start condition (e.g. afterok, afterany)
     :param job_file: (str): path to job file to submit
     :param parent_job_id: (int) or (iterable (e.g. list)) : slurm job id for parent dependency job(s)
+    :param array: (int), (tuple) or (str): optional array range, see format_array_spec
+    :param array_throttle: (int): optional max number of simultaneously running array tasks
+    :param executor: executor backend (see skeleton_keychain.executors), defaults to submitting with sbatch
     :return:
     """
 
@@ -44,26 +128,22 @@ def submit_job_return_id(job_file, parent_job_id, start_condition):
                 f"If parent_job_id ({parent_job_id}) or start_conditon ({start_condition}) is defined, both must be "
                 f"defined (not None)")
 
-    # a single job can depend on multiple jobs
-    if parent_job_id:
-        if hasattr(parent_job_id, "__iter__"):
-            command = "sbatch --dependency={}".format(start_condition)
-            for p_jid in parent_job_id:
-                command = command + f":{p_jid}"
-            command = command + " {}".format(job_file)
-        else:
-            command = "sbatch --dependency={}:{} {}".format(start_condition, parent_job_id, job_file)
+    if executor is None:
+        executor = SlurmExecutor()
 
-    else:
-        command = "sbatch {}".format(job_file)
-    command_list = command.split(" ")
-    result = subprocess.run(command_list, stdout=subprocess.PIPE)
-    std_out = result.stdout.decode('utf-8')
+    array_spec = None
+    if array is not None:
+        array_spec = format_array_spec(array, array_throttle)
 
-    job_id = std_out.split("Submitted batch job ")[-1].replace("\n", "")
-    print(command)
+    # a single job can depend on multiple jobs
+    if not parent_job_id:
+        parent_job_ids = []
+    elif hasattr(parent_job_id, "__iter__") and not isinstance(parent_job_id, str):
+        parent_job_ids = list(parent_job_id)
+    else:
+        parent_job_ids = [parent_job_id]
 
-    return job_id
+    return executor.submit(job_file, parent_job_ids, start_condition, array_spec=array_spec)
 
 
 def create_job_file(dag_node):
@@ -71,14 +151,21 @@ def create_job_file(dag_node):
     Will create a slurm job file from parameters contained in the dag_node
 
     :param dag_node: (dict) : keys: job_file, slurm_kwargs, slurm_commands, with the respective value datatypes
-    string/path to job file, dict/representing resource requests for slurm, list of str/commands to execute in job
+    string/path to job file, dict/representing resource requests for slurm, list of str/commands to execute in job.
+    Optional keys array and array_throttle make the job file a slurm job array (see format_array_spec), the optional
+    profile key (dict with mode, profile_dir and stage) wraps the commands with profile_command
     :return: None
     """
     job_file = dag_node["job_file"]
     slurm_kwargs = dag_node["slurm_kwargs"]
     command_list = dag_node["slurm_commands"]
+    if dag_node.get("profile") is not None:
+        command_list = profile_job_commands(command_list, **dag_node["profile"])
 
     job_string_list = [f"#SBATCH {k}={v}" for k, v in slurm_kwargs.items()]
+    if dag_node.get("array") is not None:
+        array_spec = format_array_spec(dag_node["array"], dag_node.get("array_throttle"))
+        job_string_list.append(f"#SBATCH --array={array_spec}")
     job_string_list = job_string_list + command_list
     job_string_list = ["#!/bin/bash"] + job_string_list
 
@@ -93,50 +180,108 @@ def create_job_file(dag_node):
 
 class Slurm_DAG:
     """
-    Slurm workflow DAG to process an individual specimen through various steps of the pipeline
+    Slurm workflow DAG. Each node is a dict with keys id, job_file, slurm_kwargs, slurm_commands and optionally
+    parent_ids (list of node ids this job depends on), dependency_job_ids (list of job ids submitted outside of the DAG
+    this job depends on) and start_condition (afterok or afterany, default afterany).
     """
     def __init__(self, list_of_nodes):
         self.nodes = list_of_nodes
-        validate_slurm_dag(self)
+        self.node_index = {n['id']: n for n in self.nodes}
+        self.parent_index = {n['id']: node_parent_ids(n) for n in self.nodes}
+        self.children_index = {n['id']: [] for n in self.nodes}
+        for node_id, parent_ids in self.parent_index.items():
+            for p_id in parent_ids:
+                if p_id in self.children_index:
+                    self.children_index[p_id].append(node_id)
+        self.topological_order = validate_slurm_dag(self)
+        self.job_ids = {}
+
+    def get_roots(self):
+        return [self.node_index[node_id] for node_id in self.topological_order if not self.parent_index[node_id]]
 
     def get_root(self):
-        return [n for n in self.nodes if n['parent_id'] == -1][0]
+        return self.get_roots()[0]
+
+    def get_parents(self, node):
+        return [self.node_index[p_id] for p_id in self.parent_index[node['id']]]
 
     def get_children(self, node):
-        return [n for n in self.nodes if n['parent_id'] == node['id']]
+        return [self.node_index[c_id] for c_id in self.children_index[node['id']]]
 
     def dfs_traversal(self):
-        """Travers the dag in depth first search"""
+        """Travers the dag in depth first search, visiting each node once"""
 
-        queue = deque([self.get_root()])
+        stack = deque(reversed(self.get_roots()))
+        visited = set()
         dfs_nodes = []
-        while len(queue) > 0:
-            curr_node = queue.popleft()
+        while len(stack) > 0:
+            curr_node = stack.pop()
+            if curr_node['id'] in visited:
+                continue
+            visited.add(curr_node['id'])
             dfs_nodes.append(curr_node)
-            children = self.get_children(curr_node)
-            for ch in children:
-                queue.appendleft(ch)
+            for ch in reversed(self.get_children(curr_node)):
+                if ch['id'] not in visited:
+                    stack.append(ch)
 
         return dfs_nodes
 
-    def submit_dag_to_scheduler(self, parent_job_id, start_condition):
+    def _submit_node(self, node_id, parent_job_id, start_condition, executor):
+        node = self.node_index[node_id]
+        parent_ids = self.parent_index[node_id]
+        if parent_ids:
+            parent_job_id = [self.job_ids[p_id] for p_id in parent_ids]
+            start_condition = node.get('start_condition', 'afterany')
+        # jobs submitted outside of this DAG (e.g. by an earlier run of a run spec) the node also waits on
+        if node.get('dependency_job_ids'):
+            if not parent_job_id:
+                parent_job_id = []
+            elif not isinstance(parent_job_id, list):
+                parent_job_id = [parent_job_id]
+            parent_job_id = parent_job_id + list(node['dependency_job_ids'])
+            start_condition = node.get('start_condition', 'afterany')
+
+        create_job_file(node)
+        return submit_job_return_id(node['job_file'], parent_job_id, start_condition, executor=executor)
+
+    def submit_dag_to_scheduler(self, parent_job_id=None, start_condition=None, executor=None, max_workers=8):
         """
-        Submit dag to slurm scheduler
+        Submit dag to slurm scheduler. A node is submitted as soon as all of its parents have job ids and depends on
+        exactly those job ids, so independent branches are submitted concurrently.
 
-        :param parent_job_id: (int): slurm job id dependency for starting this dag
+        :param parent_job_id: (int): slurm job id dependency for starting this dag's root nodes
         :param start_condition: (str) start condition for above job dependency (e.g. afterok, afterany)
-        :return parent_job_id: (int) the slurm job id associated with the last step in this DAG
+        :param executor: executor backend (see skeleton_keychain.executors), defaults to submitting with sbatch
+        :param max_workers: (int) max number of jobs being submitted at once
+        :return parent_job_id: (int) the slurm job id associated with the last step in this DAG. Job ids of every
+        node are kept in self.job_ids
         """
-
-        root = self.get_root()
-
-        job_node_list = self.dfs_traversal()
-        for node in job_node_list:
-            # TODO add validate dag node step
-            if node['id'] != root['id']:
-                start_condition = node['start_condition']
-            create_job_file(node)
-            job_file_path = node['job_file']
-            parent_job_id = submit_job_return_id(job_file_path, parent_job_id, start_condition)
-
-        return parent_job_id
+        if executor is None:
+            executor = SlurmExecutor()
+
+        waiting_parents = {node_id: len(parent_ids) for node_id, parent_ids in self.parent_index.items()}
+        # finished submissions are handed back through a queue, waiting on all in flight futures after every
+        # submission would be quadratic in the number of nodes
+        finished = queue.Queue()
+
+        def submit(node_id, node_parent_job_id, node_start_condition):
+            future = pool.submit(self._submit_node, node_id, node_parent_job_id, node_start_condition, executor)
+            future.add_done_callback(lambda f: finished.put((node_id, f)))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            n_submitting = 0
+            for node in self.get_roots():
+                submit(node['id'], parent_job_id, start_condition)
+                n_submitting += 1
+
+            while n_submitting:
+                node_id, future = finished.get()
+                n_submitting -= 1
+                self.job_ids[node_id] = future.result()
+                for child_id in self.children_index[node_id]:
+                    waiting_parents[child_id] -= 1
+                    if waiting_parents[child_id] == 0:
+                        submit(child_id, None, None)
+                        n_submitting += 1
+
+        return self.job_ids[self.topological_order[-1]]
@@ -0,0 +1,197 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import argschema as ags
+import numpy as np
+
+
+class IO_Schema(ags.ArgSchema):
+    ur_swc_dir = ags.fields.InputDir(description="Directory of upright swc files", default=None, allow_none=True)
+    la_swc_dir = ags.fields.InputDir(description="Directory of layer aligned swc files (same file names as "
+                                                 "ur_swc_dir)", default=None, allow_none=True)
+    specimen_id_file = ags.fields.InputFile(description="Optional txt with the specimen ids to render from the "
+                                                        "directories", default=None, allow_none=True)
+    swc_pairs_file = ags.fields.InputFile(description="Alternative to the directories, txt with one "
+                                                      "'upright_swc,layer_aligned_swc' pair per line",
+                                          default=None, allow_none=True)
+    output_dir = ags.fields.OutputDir(description="Directory to write qc images to")
+    layer_depths_file = ags.fields.InputFile(description="layer depths file", allow_none=True, default=None)
+    dpi = ags.fields.Int(description="resolution of the per cell qc images", default=300)
+    thumbnail = ags.fields.Boolean(description="If true, render small low resolution images (overrides dpi)",
+                                   default=False)
+    per_cell_images = ags.fields.Boolean(description="If true, write one image per cell", default=True)
+    skip_existing = ags.fields.Boolean(description="If true, don't re-render per cell images that already exist",
+                                       default=True)
+    contact_sheet_cells = ags.fields.Int(description="If more than 0, also write contact sheets with this many "
+                                                     "cells each to output_dir/contact_sheets", default=0)
+    contact_sheet_columns = ags.fields.Int(description="Number of cells per contact sheet row", default=5)
+    fast_render = ags.fields.Boolean(description="see qc_swc_image", default=False)
+    decimate_step = ags.fields.Int(description="see qc_swc_image", default=1)
+    n_workers = ags.fields.Int(description="Number of rendering processes (defaults to all cpus)", default=None,
+                               allow_none=True)
+
+
+THUMBNAIL_DPI = 72
+
+# per process state, set up once by _init_worker so figures and layer depths are reused across cells
+_worker_state = {}
+
+
+def find_swc_pairs(ur_swc_dir=None, la_swc_dir=None, specimen_id_file=None, swc_pairs_file=None):
+    """
+    :return: (list) of (upright swc path, layer aligned swc path) tuples
+    """
+    if swc_pairs_file is not None:
+        with open(swc_pairs_file, "r") as f:
+            return [tuple(p.strip() for p in line.split(",")) for line in f if line.strip()]
+
+    if (ur_swc_dir is None) or (la_swc_dir is None):
+        raise ValueError("Either swc_pairs_file or both ur_swc_dir and la_swc_dir are required")
+
+    if specimen_id_file is not None:
+        file_names = [f"{sp_id}.swc" for sp_id in np.loadtxt(specimen_id_file, dtype=str, ndmin=1)]
+    else:
+        file_names = sorted(f for f in os.listdir(ur_swc_dir) if f.endswith(".swc"))
+
+    la_file_names = set(os.listdir(la_swc_dir))
+    missing = [f for f in file_names if f not in la_file_names]
+    if missing:
+        print(f"No layer aligned swc file for {len(missing)} upright files, e.g. {missing[:5]}")
+
+    return [(os.path.join(ur_swc_dir, f), os.path.join(la_swc_dir, f)) for f in file_names if f in la_file_names]
+
+
+def _init_worker(layer_depths_file, fast_render, decimate_step):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from skeleton_keychain.quality_control_swc_files import load_layer_depths
+
+    _worker_state["layer_depths"] = load_layer_depths(layer_depths_file)
+    _worker_state["figure"] = plt.figure()
+    _worker_state["fast_render"] = fast_render
+    _worker_state["decimate_step"] = decimate_step
+
+
+def _load_pair(ur_swc, la_swc):
+    from skeleton_keychain.quality_control_swc_files import load_qc_morphology
+    load_kwargs = {"fast_render": _worker_state["fast_render"], "decimate_step": _worker_state["decimate_step"]}
+    return load_qc_morphology(ur_swc, **load_kwargs), load_qc_morphology(la_swc, **load_kwargs)
+
+
+def _render_cell(ur_swc, la_swc, qc_image_file, dpi, thumbnail):
+    """Render one cell's qc image on this worker's reusable figure"""
+    from skeleton_keychain.quality_control_swc_files import draw_qc_panels
+
+    fig = _worker_state["figure"]
+    fig.clf()
+    ur_morph, la_morph = _load_pair(ur_swc, la_swc)
+    axe = fig.subplots(1, 2)
+    draw_qc_panels(axe[0], axe[1], ur_morph, la_morph, _worker_state["layer_depths"],
+                   line_w=0.5 if thumbnail else 1)
+
+    fig.suptitle("sp: {}".format(os.path.basename(ur_swc)), ha='center', y=1.15)
+    fig.set_size_inches(*((4.5, 2) if thumbnail else (9, 4)))
+    fig.savefig(qc_image_file, dpi=THUMBNAIL_DPI if thumbnail else dpi, bbox_inches='tight')
+    return qc_image_file
+
+
+def _render_contact_sheet(swc_pairs, sheet_file, n_columns):
+    """Render many cells (upright and layer aligned panel each) onto a single low resolution image"""
+    import matplotlib.pyplot as plt
+    from skeleton_keychain.quality_control_swc_files import draw_qc_panels
+
+    n_columns = min(n_columns, len(swc_pairs))
+    n_rows = int(np.ceil(len(swc_pairs) / n_columns))
+    fig, axe = plt.subplots(n_rows, 2 * n_columns, squeeze=False)
+    for a in axe.flat:
+        a.axis('off')
+
+    for idx, (ur_swc, la_swc) in enumerate(swc_pairs):
+        row, col = divmod(idx, n_columns)
+        ur_ax, la_ax = axe[row, 2 * col], axe[row, 2 * col + 1]
+        cell_name = os.path.splitext(os.path.basename(ur_swc))[0]
+        try:
+            ur_morph, la_morph = _load_pair(ur_swc, la_swc)
+            draw_qc_panels(ur_ax, la_ax, ur_morph, la_morph, _worker_state["layer_depths"], line_w=0.25,
+                           titles=(cell_name, ""))
+        except Exception as e:
+            ur_ax.set_title(f"{cell_name} failed", color="red")
+            print(f"Contact sheet {sheet_file}: {cell_name} failed ({e})")
+        for a in [ur_ax, la_ax]:
+            a.title.set_fontsize(6)
+
+    fig.set_size_inches(2 * n_columns * 1.5, n_rows * 2)
+    fig.savefig(sheet_file, dpi=THUMBNAIL_DPI, bbox_inches='tight')
+    plt.close(fig)
+    return sheet_file
+
+
+def main(output_dir,
+         layer_depths_file,
+         dpi,
+         thumbnail,
+         per_cell_images,
+         skip_existing,
+         contact_sheet_cells,
+         contact_sheet_columns,
+         n_workers,
+         fast_render=False,
+         decimate_step=1,
+         ur_swc_dir=None,
+         la_swc_dir=None,
+         specimen_id_file=None,
+         swc_pairs_file=None,
+         **kwargs):
+    """
+    Render qc images for many upright/layer aligned swc pairs across a process pool. Each worker process uses the
+    non-interactive Agg backend and reuses one figure for every per cell image it renders.
+    """
+    swc_pairs = find_swc_pairs(ur_swc_dir, la_swc_dir, specimen_id_file, swc_pairs_file)
+    print(f"Rendering qc images for {len(swc_pairs)} cells")
+
+    tasks = []
+    if per_cell_images:
+        for ur_swc, la_swc in swc_pairs:
+            qc_image_file = os.path.join(output_dir, os.path.splitext(os.path.basename(ur_swc))[0] + ".png")
+            if skip_existing and os.path.exists(qc_image_file):
+                continue
+            tasks.append((qc_image_file, _render_cell, (ur_swc, la_swc, qc_image_file, dpi, thumbnail)))
+
+    if contact_sheet_cells > 0:
+        sheet_dir = os.path.join(output_dir, "contact_sheets")
+        if not os.path.exists(sheet_dir):
+            os.mkdir(sheet_dir)
+        for sheet_idx, sheet_start in enumerate(range(0, len(swc_pairs), contact_sheet_cells)):
+            sheet_file = os.path.join(sheet_dir, f"contact_sheet_{sheet_idx:04d}.png")
+            tasks.append((sheet_file, _render_contact_sheet,
+                          (swc_pairs[sheet_start:sheet_start + contact_sheet_cells], sheet_file,
+                           contact_sheet_columns)))
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(layer_depths_file, fast_render, decimate_step)) as pool:
+        futures = {pool.submit(func, *args): image_file for image_file, func, args in tasks}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+            except Exception as e:
+                failures[futures[future]] = repr(e)
+            if (n_done % 100 == 0) or (n_done == len(futures)):
+                print(f"Rendered {n_done}/{len(futures)} images")
+
+    if failures:
+        failure_file = os.path.join(output_dir, "qc_failures.txt")
+        with open(failure_file, "w") as f:
+            for image_file, error in failures.items():
+                f.write(f"{image_file}\t{error}\n")
+        print(f"{len(failures)} images failed, see {failure_file}")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
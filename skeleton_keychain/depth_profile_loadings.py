@@ -0,0 +1,88 @@
+import csv
+import numpy as np
+import argschema as ags
+
+# swc node type of each compartment, the compartment's columns in the aligned depth profile file start with it
+COMPARTMENT_NODE_TYPES = {"axon": 2, "basal_dendrite": 3, "apical_dendrite": 4}
+
+
+class IO_Schema(ags.ArgSchema):
+    specimen_id_file = ags.fields.InputFile(description="txt file with the specimen ids the loadings are fit to")
+    aligned_depth_profile_file = ags.fields.InputFile(description="depth profiles of every specimen "
+                                                                  "(AlignedHistogram.csv)")
+    axon_loadings_file = ags.fields.OutputFile(default=None, allow_none=True,
+                                               description="csv to save the axon depth profile loadings to")
+    basal_dendrite_loadings_file = ags.fields.OutputFile(default=None, allow_none=True,
+                                                         description="csv to save the basal dendrite depth profile "
+                                                                     "loadings to")
+    apical_dendrite_loadings_file = ags.fields.OutputFile(default=None, allow_none=True,
+                                                          description="csv to save the apical dendrite depth profile "
+                                                                      "loadings to")
+
+
+def load_depth_profiles(aligned_depth_profile_file, specimen_ids):
+    """
+    :param aligned_depth_profile_file: (str): csv with a header line and one row per specimen, the first column is the
+    specimen id
+    :param specimen_ids: (list): specimens to load, in this order
+    :return: (list) column names without the specimen id column and (np.ndarray) one row of profiles per specimen
+    """
+    rows = {}
+    with open(aligned_depth_profile_file, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)[1:]
+        for row in reader:
+            rows[row[0]] = row[1:]
+    missing = [sp_id for sp_id in specimen_ids if str(sp_id) not in rows]
+    if missing:
+        raise ValueError(f"{aligned_depth_profile_file} has no depth profiles for {missing}")
+    return header, np.array([rows[str(sp_id)] for sp_id in specimen_ids], dtype=float)
+
+
+def compartment_columns(header, compartment):
+    """:return: (list) indices of the columns of a compartment's depth profile"""
+    prefix = f"{COMPARTMENT_NODE_TYPES[compartment]}_"
+    columns = [idx for idx, name in enumerate(header) if name.startswith(prefix)]
+    if not columns:
+        raise ValueError(f"No {compartment} depth profile columns (starting with {prefix}) in {header}")
+    return columns
+
+
+def fit_loadings(profiles):
+    """
+    Fit the depth profile PCA the same way skelekeys-morph-features does when it is not given loadings
+
+    :param profiles: (np.ndarray): depth profiles of one compartment, one row per specimen
+    :return: (np.ndarray) loadings
+    """
+    from skeleton_keys.depth_profile import calculate_pca_transforms_and_loadings
+    _, loadings = calculate_pca_transforms_and_loadings(profiles)
+    return loadings
+
+
+def main(specimen_id_file, aligned_depth_profile_file, axon_loadings_file=None, basal_dendrite_loadings_file=None,
+         apical_dendrite_loadings_file=None, **kwargs):
+    """
+    Fit the depth profile loadings of every compartment once over the whole cohort, so feature shards that each
+    calculate the features of a share of the specimens all project onto the loadings a single feature job would fit
+    """
+    specimen_ids = [str(sp_id) for sp_id in np.loadtxt(specimen_id_file, dtype=str, ndmin=1)]
+    header, profiles = load_depth_profiles(aligned_depth_profile_file, specimen_ids)
+    for compartment, loadings_file in [("axon", axon_loadings_file),
+                                       ("basal_dendrite", basal_dendrite_loadings_file),
+                                       ("apical_dendrite", apical_dendrite_loadings_file)]:
+        if loadings_file is None:
+            continue
+        loadings = fit_loadings(profiles[:, compartment_columns(header, compartment)])
+        np.savetxt(loadings_file, loadings, delimiter=",")
+        print(f"Saved {compartment} depth profile loadings of {len(specimen_ids)} specimens to {loadings_file}")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
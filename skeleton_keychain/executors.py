@@ -0,0 +1,447 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import subprocess
+import threading
+import random
+import json
+import time
+import os
+import re
+
+
+def parse_memory_mb(mem_value):
+    """
+    Convert a slurm --mem value into megabytes. Slurm treats unit-less values as megabytes.
+
+    :param mem_value: (str) or (int): memory request, e.g. "10gb", "500M", "2048"
+    :return: (int) memory in megabytes
+    """
+    mem_str = str(mem_value).strip().upper()
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", mem_str)
+    if match is None:
+        raise ValueError(f"Unable to parse slurm memory request {mem_value}")
+    value, unit = match.groups()
+    scale = {"K": 1 / 1024, "": 1, "M": 1, "G": 1024, "T": 1024 ** 2}[unit]
+    return int(float(value) * scale)
+
+
+def parse_time_minutes(time_value):
+    """
+    Convert a slurm --time value into minutes
+
+    :param time_value: (str) or (int): time limit, e.g. "90", "96:00:00", "2-00:00:00", "1-12"
+    :return: (int) minutes
+    """
+    time_str = str(time_value).strip()
+    days = 0
+    if "-" in time_str:
+        days, time_str = time_str.split("-", 1)
+        days = int(days)
+        # days-hours, days-hours:minutes and days-hours:minutes:seconds
+        parts = [int(p) for p in time_str.split(":")] + [0, 0]
+        hours, minutes, seconds = parts[:3]
+    else:
+        # minutes, minutes:seconds and hours:minutes:seconds
+        parts = [int(p) for p in time_str.split(":")]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        elif len(parts) == 3:
+            hours, minutes, seconds = parts
+        else:
+            raise ValueError(f"Unable to parse slurm time limit {time_value}")
+    return days * 24 * 60 + hours * 60 + minutes + (1 if seconds else 0)
+
+
+def parse_array_spec(array_spec):
+    """
+    Expand a slurm --array specification into task ids and throttle.
+
+    :param array_spec: (str): e.g. "0-99%10", "1,3,5-9:2"
+    :return: (list) of int task ids, (int) or None throttle
+    """
+    throttle = None
+    if "%" in array_spec:
+        array_spec, throttle = array_spec.split("%")
+        throttle = int(throttle)
+
+    task_ids = []
+    for part in array_spec.split(","):
+        step = 1
+        if ":" in part:
+            part, step = part.split(":")
+            step = int(step)
+        if "-" in part:
+            first, last = part.split("-")
+            task_ids.extend(range(int(first), int(last) + 1, step))
+        else:
+            task_ids.append(int(part))
+
+    return task_ids, throttle
+
+
+def read_job_file_directives(job_file):
+    """
+    Read the #SBATCH directives from a job file
+
+    :param job_file: (str): path to job file
+    :return: (dict) directive name (e.g. --mem) -> value
+    """
+    directives = {}
+    with open(job_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("#SBATCH"):
+                continue
+            directive = line[len("#SBATCH"):].strip()
+            if "=" in directive:
+                k, v = directive.split("=", 1)
+            else:
+                k, _, v = directive.partition(" ")
+            directives[k.strip()] = v.strip()
+    return directives
+
+
+class SubmissionError(RuntimeError):
+    """sbatch did not accept a job, or its output did not contain a job id"""
+
+
+# sbatch errors that go away on their own when the controller is busy or restarting
+TRANSIENT_SBATCH_ERRORS = [
+    "socket timed out",
+    "temporarily unable to accept job",
+    "resource temporarily unavailable",
+    "unable to contact slurm controller",
+    "transaction blocked",
+    "connection refused",
+    "slurmctld not responding",
+]
+
+
+def parse_sbatch_job_id(std_out):
+    """
+    :param std_out: (str): sbatch output, "Submitted batch job 123" or the --parsable form "123" / "123;cluster"
+    :return: (str) job id
+    """
+    match = re.search(r"Submitted batch job (\d+)", std_out)
+    if match is None:
+        match = re.fullmatch(r"\s*(\d+)(?:;\S+)?\s*", std_out)
+    if match is None:
+        raise SubmissionError(f"Could not find a job id in the sbatch output: {std_out.strip()!r}")
+    return match.group(1)
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, acquire() blocks until a token is available. Tokens refill at rate per second up to
+    capacity, so short bursts of capacity calls go through at once and longer runs are held to rate.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: (float): tokens added per second
+        :param capacity: (int): max number of stored tokens, defaults to one second worth of tokens
+        """
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = max(1, int(capacity if capacity is not None else rate))
+        self._tokens = float(self.capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                sleep_time = (1 - self._tokens) / self.rate
+            time.sleep(sleep_time)
+
+
+class SlurmExecutor:
+    """
+    Submits job files to a slurm cluster with sbatch. submit() is thread safe, Slurm_DAG calls it from a thread pool
+    so independent jobs are submitted concurrently. The executor caps how many sbatch calls run at once and how many
+    start per second, and retries calls that failed because the controller was busy.
+    """
+
+    def __init__(self, max_concurrent_submissions=8, submissions_per_second=None, submission_burst=None,
+                 max_submit_retries=5, retry_backoff=1.0, max_retry_backoff=60.0):
+        """
+        :param max_concurrent_submissions: (int): max number of sbatch calls running at once
+        :param submissions_per_second: (float): max average rate of sbatch calls, None for no limit
+        :param submission_burst: (int): number of sbatch calls allowed back to back before the rate limit applies
+        :param max_submit_retries: (int): times a transient sbatch failure is retried before giving up. A timed out
+        call may still have been accepted by the controller, so a retry can in rare cases submit a job twice
+        :param retry_backoff: (float): seconds to wait before the first retry, doubled (with jitter) on every retry
+        :param max_retry_backoff: (float): longest wait between retries in seconds
+        """
+        if max_concurrent_submissions < 1:
+            raise ValueError(f"max_concurrent_submissions must be at least 1, got {max_concurrent_submissions}")
+        self.max_concurrent_submissions = max_concurrent_submissions
+        self.max_submit_retries = max_submit_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self._submission_slots = threading.BoundedSemaphore(max_concurrent_submissions)
+        self._rate_limit = None
+        if submissions_per_second is not None:
+            self._rate_limit = TokenBucket(submissions_per_second, submission_burst)
+
+    def _run_sbatch(self, command_list):
+        """Run sbatch once, returns (return code, stdout, stderr)"""
+        if self._rate_limit is not None:
+            self._rate_limit.acquire()
+        with self._submission_slots:
+            result = subprocess.run(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+        return result.returncode, result.stdout, result.stderr
+
+    def submit(self, job_file, parent_job_ids, start_condition, array_spec=None):
+        """
+        :param job_file: (str): path to job file to submit
+        :param parent_job_ids: (list): job ids this job depends on, may be empty
+        :param start_condition: (str): slurm start condition (e.g. afterok, afterany)
+        :param array_spec: (str): optional slurm --array specification
+        :return: (str) slurm job id
+        """
+        command_list = ["sbatch"]
+        if array_spec is not None:
+            command_list.append("--array={}".format(array_spec))
+
+        # a single job can depend on multiple jobs
+        if parent_job_ids:
+            dependency = ":".join([start_condition] + [str(p_jid) for p_jid in parent_job_ids])
+            command_list.append("--dependency={}".format(dependency))
+
+        command_list.append(job_file)
+        command = " ".join(command_list)
+
+        for attempt in range(self.max_submit_retries + 1):
+            return_code, std_out, std_err = self._run_sbatch(command_list)
+            if return_code == 0:
+                job_id = parse_sbatch_job_id(std_out)
+                print(command)
+                return job_id
+
+            error = std_err.strip() or std_out.strip()
+            transient = any(e in error.lower() for e in TRANSIENT_SBATCH_ERRORS)
+            if (not transient) or (attempt == self.max_submit_retries):
+                raise SubmissionError(f"{command} failed with exit code {return_code}: {error}")
+            # jitter keeps the threads that hit the same controller hiccup from retrying in lockstep
+            backoff = min(self.max_retry_backoff, self.retry_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+            print(f"{command} failed ({error}), retrying in {backoff:.1f}s")
+            time.sleep(backoff)
+
+    def wait(self):
+        """Slurm runs jobs asynchronously, there is nothing to wait on"""
+        return {}
+
+
+def _run_job_script(job_file, env, output_file):
+    """Run a job file with bash, returns (return code, start time, end time, max rss in mb)"""
+    start = time.time()
+    with open(output_file, "w") as out_f:
+        process = subprocess.Popen(["bash", job_file], stdout=out_f, stderr=subprocess.STDOUT, env=env)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is the largest resident set of the job script or any process it waited on, in kilobytes
+    return process.returncode, start, time.time(), rusage.ru_maxrss / 1024
+
+
+class LocalExecutor:
+    """
+    Runs job files on the local machine in a process pool. Jobs are started once their afterok/afterany
+    dependencies are met and only while their --cpus-per-task and --mem requests fit in the local budget.
+    Nothing runs until wait() is called.
+    """
+
+    def __init__(self, max_cpus=None, max_memory=None, poll_interval=1.0, accounting_file=None, job_id_prefix=""):
+        """
+        :param max_cpus: (int): number of cpus jobs may use at once, defaults to os.cpu_count()
+        :param max_memory: (str): memory jobs may use at once (slurm --mem syntax), defaults to physical memory
+        :param poll_interval: (float): seconds between scheduling passes while jobs are running
+        :param accounting_file: (str): optional jsonl file to append a sacct-like record of every finished job (or
+        array task) to
+        :param job_id_prefix: (str): prefix of the local job ids, keeps ids unique when several executors record
+        jobs of the same run
+        """
+        self.max_cpus = max_cpus if max_cpus is not None else os.cpu_count()
+        if max_memory is None:
+            self.max_memory_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024 ** 2
+        else:
+            self.max_memory_mb = parse_memory_mb(max_memory)
+        self.poll_interval = poll_interval
+        self.accounting_file = accounting_file
+        self.jobs = {}
+        self._next_job_id = 1
+        self.job_id_prefix = job_id_prefix
+        self._submit_lock = threading.Lock()
+
+    def submit(self, job_file, parent_job_ids, start_condition, array_spec=None):
+        """
+        Queue a job file to be run by wait(), arguments are the same as SlurmExecutor.submit
+
+        :return: (str) local job id
+        """
+        parent_job_ids = [str(p) for p in parent_job_ids]
+        directives = read_job_file_directives(job_file)
+        if array_spec is None:
+            array_spec = directives.get("--array")
+
+        with self._submit_lock:
+            unknown_parents = [p for p in parent_job_ids if p not in self.jobs]
+            if unknown_parents:
+                raise ValueError(f"{job_file} depends on unknown local job ids {unknown_parents}")
+            job_id = f"{self.job_id_prefix}{self._next_job_id}"
+            self._next_job_id += 1
+
+        if array_spec is not None:
+            task_ids, throttle = parse_array_spec(array_spec)
+        else:
+            task_ids, throttle = [None], None
+
+        output_pattern = directives.get("--output", os.path.splitext(job_file)[0] + "_%j.out")
+        job = {
+            "job_file": job_file,
+            "parents": parent_job_ids,
+            "start_condition": start_condition,
+            "cpus": int(directives.get("--cpus-per-task", 1)),
+            "mem_mb": parse_memory_mb(directives.get("--mem", 0)),
+            "output_pattern": output_pattern,
+            "pending_tasks": list(task_ids),
+            "running_tasks": 0,
+            "return_codes": [],
+            "throttle": throttle,
+            "state": "PENDING",
+            "submit_time": time.time(),
+        }
+        with self._submit_lock:
+            self.jobs[job_id] = job
+        print(f"local job {job_id}: {job_file}")
+
+        return job_id
+
+    def _dependency_status(self, job):
+        """Return 'ready', 'waiting' or 'never' for a job's dependencies"""
+        parent_states = [self.jobs[p]["state"] for p in job["parents"]]
+        if any(s in ["PENDING", "RUNNING"] for s in parent_states):
+            return "waiting"
+        if job["start_condition"] == "afterok" and any(s != "COMPLETED" for s in parent_states):
+            return "never"
+        return "ready"
+
+    def _task_env(self, job_id, job, task_id):
+        env = dict(os.environ)
+        env["SLURM_JOB_ID"] = job_id
+        env["SLURM_CPUS_PER_TASK"] = str(job["cpus"])
+        if task_id is not None:
+            env["SLURM_ARRAY_JOB_ID"] = job_id
+            env["SLURM_ARRAY_TASK_ID"] = str(task_id)
+        return env
+
+    def _task_output(self, job_id, task_id):
+        output_file = self.jobs[job_id]["output_pattern"].replace("%A", job_id).replace("%j", job_id)
+        return output_file.replace("%a", "" if task_id is None else str(task_id))
+
+    def _record_accounting(self, job_id, task_id, return_code, start_time, end_time, max_rss_mb):
+        if self.accounting_file is None:
+            return
+        if return_code is None:
+            state = "CANCELLED"
+        else:
+            state = "COMPLETED" if return_code == 0 else "FAILED"
+        record = {
+            "job_id": job_id if task_id is None else f"{job_id}_{task_id}",
+            "parent_job_id": job_id,
+            "task_id": task_id,
+            "state": state,
+            "submit_time": self.jobs[job_id]["submit_time"],
+            "start_time": start_time,
+            "end_time": end_time,
+            "elapsed_s": None if start_time is None else end_time - start_time,
+            "max_rss_mb": max_rss_mb,
+            "exit_code": None if return_code is None else f"{return_code}:0",
+        }
+        with open(self.accounting_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def wait(self):
+        """
+        Run every submitted job, respecting dependencies and the cpu/memory budget
+
+        :return: (dict) local job id -> final state (COMPLETED, FAILED or CANCELLED)
+        """
+        used_cpus, used_mem = 0, 0
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.max_cpus) as pool:
+            while True:
+                for job_id, job in self.jobs.items():
+                    if job["state"] not in ["PENDING", "RUNNING"] or not job["pending_tasks"]:
+                        continue
+
+                    dependency_status = self._dependency_status(job)
+                    if dependency_status == "never":
+                        job["state"] = "CANCELLED"
+                        for task_id in job["pending_tasks"]:
+                            self._record_accounting(job_id, task_id, None, None, None, None)
+                        job["pending_tasks"] = []
+                        print(f"local job {job_id} cancelled, dependency never satisfied")
+                        continue
+                    if dependency_status == "waiting":
+                        continue
+
+                    while job["pending_tasks"]:
+                        if job["throttle"] is not None and job["running_tasks"] >= job["throttle"]:
+                            break
+                        # a job bigger than the whole budget is allowed to run alone
+                        fits = (used_cpus + job["cpus"] <= self.max_cpus) and \
+                               (used_mem + job["mem_mb"] <= self.max_memory_mb)
+                        if not fits and running:
+                            break
+
+                        task_id = job["pending_tasks"].pop(0)
+                        future = pool.submit(_run_job_script,
+                                             job["job_file"],
+                                             self._task_env(job_id, job, task_id),
+                                             self._task_output(job_id, task_id))
+                        running[future] = (job_id, task_id)
+                        job["running_tasks"] += 1
+                        job["state"] = "RUNNING"
+                        used_cpus += job["cpus"]
+                        used_mem += job["mem_mb"]
+
+                if not running:
+                    break
+
+                done, _ = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id, task_id = running.pop(future)
+                    job = self.jobs[job_id]
+                    return_code, start_time, end_time, max_rss_mb = future.result()
+                    self._record_accounting(job_id, task_id, return_code, start_time, end_time, max_rss_mb)
+                    job["return_codes"].append(return_code)
+                    job["running_tasks"] -= 1
+                    used_cpus -= job["cpus"]
+                    used_mem -= job["mem_mb"]
+                    if job["running_tasks"] == 0 and not job["pending_tasks"]:
+                        job["state"] = "COMPLETED" if all(c == 0 for c in job["return_codes"]) else "FAILED"
+                        print(f"local job {job_id} {job['state']}")
+
+        return {job_id: job["state"] for job_id, job in self.jobs.items()}
+
+
+def get_executor(executor_name, **executor_kwargs):
+    """
+    :param executor_name: (str): slurm or local
+    :param executor_kwargs: passed to the executor's constructor
+    :return: executor instance
+    """
+    executors = {"slurm": SlurmExecutor, "local": LocalExecutor}
+    if executor_name not in executors:
+        raise ValueError(f"{executor_name} not in accepted executors {list(executors.keys())}")
+    return executors[executor_name](**executor_kwargs)
@@ -0,0 +1,267 @@
+import subprocess
+import json
+import time
+import sys
+import os
+import argschema as ags
+import numpy as np
+from skeleton_keychain.SlurmDAG import Slurm_DAG
+from skeleton_keychain.executors import get_executor, parse_memory_mb, parse_time_minutes
+from skeleton_keychain.job_tracking import JobDatabase, LOCAL_ACCOUNTING_FILE_NAME, update_job_status
+from skeleton_keychain.manifest import RunManifest
+
+GATE_FILE_NAME = "file_gen_gate.json"
+FILE_GEN_STAGES = ["file_gen", "file_gen_retry"]
+
+
+class IO_Schema(ags.ArgSchema):
+    gate_file = ags.fields.InputFile(description="json written by run_features describing the file generation to check")
+    attempt = ags.fields.Int(default=0, description="number of retries that already ran")
+
+
+def file_gen_gate_command(gate_file, attempt):
+    return f"file_gen_gate --gate_file {gate_file} --attempt {attempt}"
+
+
+def add_linked_job_id(gate_file, job_id):
+    """
+    Record a job of a later run of the run spec that links this run's files (see shared_file_gen), so retries re-point
+    it to the next gate like the downstream stages of this run
+    """
+    with open(gate_file, "r") as f:
+        gate = json.load(f)
+    gate["linked_job_ids"] = gate.get("linked_job_ids", []) + [str(job_id)]
+    tmp_file = f"{gate_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(gate, f, indent=2)
+    os.replace(tmp_file, gate_file)
+
+
+def specimen_outputs_current(output_files, submitted_at_ns=None):
+    """
+    :param output_files: (list): files a specimen's file generation writes
+    :param submitted_at_ns: (int): when the specimen was submitted, outputs written before that are stale
+    :return: (list) missing or stale output files
+    """
+    bad_files = []
+    for output_file in output_files:
+        try:
+            mtime_ns = os.stat(output_file).st_mtime_ns
+        except FileNotFoundError:
+            bad_files.append(output_file)
+            continue
+        if (submitted_at_ns is not None) and (mtime_ns < submitted_at_ns):
+            bad_files.append(output_file)
+    return bad_files
+
+
+def latest_specimen_jobs(job_db, run_id):
+    """
+    The most recent file generation (or retry) job and task of every specimen in a run, with its accounting
+
+    :return: (dict) specimen id -> dict with keys job (see JobDatabase.get_jobs) and state
+    """
+    jobs = [job for job in job_db.get_jobs(run_id) if job["stage"] in FILE_GEN_STAGES]
+    accounting = job_db.get_accounting([job["job_id"] for job in jobs])
+    specimen_jobs = {}
+    for job in sorted(jobs, key=lambda j: j["submitted_at"]):
+        task_records = {r["task_id"]: r for r in accounting[job["job_id"]]}
+        is_array = any(task_id is not None for task_id in task_records)
+        for task_idx, task_specimen_ids in enumerate(job["task_specimen_ids"]):
+            record = task_records.get(task_idx if is_array else None)
+            for sp_id in task_specimen_ids:
+                specimen_jobs[sp_id] = {"job": job, "state": "UNKNOWN" if record is None else record["state"]}
+    return specimen_jobs
+
+
+def escalate_resources(slurm_kwargs, failed_jobs, memory_factor, time_factor):
+    """
+    Resource request for retrying specimens, the largest request of the jobs they failed in scaled by the factors
+
+    :param slurm_kwargs: (dict): file generation resource request used when the failed jobs are not known
+    :param failed_jobs: (list): jobs (see JobDatabase.get_jobs) the specimens failed in
+    :return: (dict) resource request
+    """
+    memory_mb = max([job["mem_mb"] for job in failed_jobs if job["mem_mb"]], default=None)
+    time_minutes = max([parse_time_minutes(job["time_limit"]) for job in failed_jobs if job["time_limit"]],
+                       default=None)
+    if memory_mb is None:
+        memory_mb = parse_memory_mb(slurm_kwargs["--mem"])
+    if time_minutes is None:
+        time_minutes = parse_time_minutes(slurm_kwargs["--time"])
+    return dict(slurm_kwargs, **{"--mem": f"{int(np.ceil(memory_mb * memory_factor))}mb",
+                                 "--time": str(int(np.ceil(time_minutes * time_factor)))})
+
+
+def wait_for_run(job_db, gate_node_id, timeout=600, poll_interval=10):
+    """The gate can start before run_features recorded the run's jobs, wait for its own job to show up"""
+    start = time.time()
+    while True:
+        run_id = job_db.latest_run_id()
+        if (run_id is not None) and any(job["node_id"] == gate_node_id for job in job_db.get_jobs(run_id)):
+            return run_id
+        if time.time() - start > timeout:
+            raise RuntimeError(f"The jobs of this run were not recorded in {job_db.db_file}")
+        time.sleep(poll_interval)
+
+
+def check_specimens(gate, job_db, run_id):
+    """
+    :return: (dict) failed specimen id -> dict with keys state (of its last job), bad_files and job
+    """
+    try:
+        update_job_status(job_db, run_id, gate["output_dir"])
+    except (RuntimeError, OSError) as e:
+        print(f"Could not collect job accounting ({e}), judging specimens by their output files only")
+
+    manifest = RunManifest(gate["output_dir"])
+    specimen_jobs = latest_specimen_jobs(job_db, run_id)
+    failed = {}
+    for sp_id in gate["specimen_ids"]:
+        entry = manifest.get_entry("file_gen", sp_id)
+        bad_files = specimen_outputs_current(gate["output_files"][sp_id],
+                                             None if entry is None else entry["submitted_at_ns"])
+        if bad_files:
+            specimen_job = specimen_jobs.get(sp_id, {"job": None, "state": "UNKNOWN"})
+            failed[sp_id] = {"state": specimen_job["state"], "bad_files": bad_files, "job": specimen_job["job"]}
+    return failed
+
+
+def write_failure_report(report_file, failed):
+    with open(report_file, "w") as f:
+        f.write("specimen_id\tstate\tmissing_or_stale_files\n")
+        for sp_id, failure in failed.items():
+            f.write(f"{sp_id}\t{failure['state']}\t{','.join(failure['bad_files'])}\n")
+
+
+def build_retry_nodes(gate, failed, attempt, first_node_id):
+    """
+    Job array nodes that regenerate the failed specimens with escalated resources
+
+    :return: (list) dag nodes
+    """
+    job_dir = gate["job_dir"]
+    failed_ids = list(failed.keys())
+    slurm_kwargs = escalate_resources(gate["slurm_kwargs"], [f["job"] for f in failed.values() if f["job"]],
+                                      gate["memory_factor"], gate["time_factor"])
+    nodes = []
+    for array_idx, array_start in enumerate(range(0, len(failed_ids), gate["max_array_size"])):
+        array_specimen_ids = failed_ids[array_start:array_start + gate["max_array_size"]]
+        name = f"file_gen_retry_{attempt}_{array_idx}"
+        id_file = os.path.join(job_dir, f"{name}.txt")
+        with open(id_file, "w") as f:
+            for sp_id in array_specimen_ids:
+                f.write(f"{sp_id}\n")
+        nodes.append({
+            "id": first_node_id + array_idx,
+            "parent_ids": [],
+            "name": name,
+            "stage": "file_gen_retry",
+            "task_specimen_ids": [[sp_id] for sp_id in array_specimen_ids],
+            "job_file": os.path.join(job_dir, f"{name}.sh"),
+            "slurm_kwargs": dict(slurm_kwargs, **{"--job-name": f"seg-retry-{attempt}-{array_idx}",
+                                                  "--output": os.path.join(job_dir, f"{name}_%a.out")}),
+            "slurm_commands": gate["setup_commands"] + [
+                f'SPECIMEN_ID=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {id_file})',
+                'echo "SPECIMEN_ID: ${SPECIMEN_ID}"',
+            ] + gate["task_commands"],
+            "array": len(array_specimen_ids),
+            "array_throttle": gate["array_throttle"],
+            "profile": None if gate.get("profile") is None else dict(gate["profile"], stage="file_gen_retry"),
+        })
+    return nodes
+
+
+def redirect_dependencies(job_ids, new_parent_job_id, start_condition="afterok"):
+    """Make pending slurm jobs wait for new_parent_job_id instead of their current dependencies"""
+    for job_id in job_ids:
+        command = ["scontrol", "update", f"JobId={job_id}", f"Dependency={start_condition}:{new_parent_job_id}"]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(command)} failed: {result.stderr.strip()}")
+        print(" ".join(command))
+
+
+def main(gate_file, attempt, **kwargs):
+    """
+    Check the file generation of a run once its jobs finished. Specimens whose outputs are missing (or older than
+    their submission) are resubmitted as job arrays with escalated memory and time, up to max_retries times. With
+    slurm the retries are followed by a new gate job and the stages downstream of this gate are re-pointed to it with
+    scontrol, so they keep waiting, and so are the jobs of later runs that link this run's files. Once no retries are
+    left the gate fails, and with it every downstream stage, when fewer than success_threshold of the specimens have
+    their files.
+    """
+    with open(gate_file, "r") as f:
+        gate = json.load(f)
+    job_db = JobDatabase(gate["output_dir"])
+    run_id = wait_for_run(job_db, gate["gate_node_id"])
+
+    while True:
+        failed = check_specimens(gate, job_db, run_id)
+        n_specimens = len(gate["specimen_ids"])
+        print(f"Attempt {attempt}: {n_specimens - len(failed)} of {n_specimens} specimens have their files")
+        write_failure_report(os.path.join(gate["job_dir"], f"file_gen_failures_attempt_{attempt}.txt"), failed)
+        if (not failed) or (attempt >= gate["max_retries"]):
+            break
+
+        attempt += 1
+        first_node_id = max(job["node_id"] for job in job_db.get_jobs(run_id)) + 1
+        retry_nodes = build_retry_nodes(gate, failed, attempt, first_node_id)
+        print(f"Retrying {len(failed)} specimens with {retry_nodes[0]['slurm_kwargs']['--mem']} and "
+              f"{retry_nodes[0]['slurm_kwargs']['--time']} minutes")
+
+        if gate["executor"] == "local":
+            executor = get_executor("local", job_id_prefix=f"{gate.get('job_id_prefix', '')}retry{attempt}-",
+                                    accounting_file=os.path.join(gate["output_dir"], LOCAL_ACCOUNTING_FILE_NAME),
+                                    **gate["executor_kwargs"])
+            workflow = Slurm_DAG(retry_nodes)
+            workflow.submit_dag_to_scheduler(executor=executor)
+            job_db.record_jobs(run_id, workflow)
+            executor.wait()
+            continue
+
+        # the next gate checks the retries, downstream stages now wait for it instead of this gate
+        next_gate_node = {
+            "id": first_node_id + len(retry_nodes),
+            "parent_ids": [node["id"] for node in retry_nodes],
+            "start_condition": "afterany",
+            "name": f"file-gen-gate-{attempt}",
+            "stage": "file_gen_gate",
+            "job_file": os.path.join(gate["job_dir"], f"file_gen_gate_{attempt}.sh"),
+            "slurm_kwargs": dict(gate["gate_slurm_kwargs"], **{
+                "--output": os.path.join(gate["job_dir"], f"file_gen_gate_{attempt}.out")}),
+            "slurm_commands": gate["setup_commands"] + [file_gen_gate_command(gate_file, attempt)],
+            "profile": None if gate.get("profile") is None else dict(gate["profile"], stage="file_gen_gate"),
+        }
+        workflow = Slurm_DAG(retry_nodes + [next_gate_node])
+        workflow.submit_dag_to_scheduler(executor=get_executor("slurm", **gate["executor_kwargs"]))
+        job_db.record_jobs(run_id, workflow)
+        downstream_job_ids = [job["job_id"] for job in job_db.get_jobs(run_id)
+                              if job["node_id"] in gate["downstream_node_ids"]]
+        redirect_dependencies(downstream_job_ids, workflow.job_ids[next_gate_node["id"]])
+        # later runs register their link jobs after this gate started, and link whatever the gate leaves behind
+        with open(gate_file, "r") as f:
+            linked_job_ids = json.load(f).get("linked_job_ids", [])
+        redirect_dependencies(linked_job_ids, workflow.job_ids[next_gate_node["id"]], start_condition="afterany")
+        job_db.close()
+        return
+
+    job_db.close()
+    write_failure_report(os.path.join(gate["job_dir"], "file_gen_failures.txt"), failed)
+    success_fraction = 1 - len(failed) / max(len(gate["specimen_ids"]), 1)
+    if success_fraction < gate["success_threshold"]:
+        print(f"Only {100 * success_fraction:.1f}% of specimens have their files, below the threshold of "
+              f"{100 * gate['success_threshold']:.1f}%. Downstream stages will not run")
+        sys.exit(1)
+    if failed:
+        print(f"Continuing without {len(failed)} specimens: {list(failed.keys())[:20]}")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
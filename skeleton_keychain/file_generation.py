@@ -0,0 +1,191 @@
+import os
+import shlex
+
+# --layer_list of skelekeys-layer-aligned-swc by species
+SPECIES_LAYER_LISTS = {
+    "mouse": ["Layer1", "Layer2/3", "Layer4", "Layer5", "Layer6a", "Layer6b"],
+    "human": ["Layer1", "Layer2", "Layer3", "Layer4", "Layer5", "Layer6"],
+}
+
+
+def layer_list_argument(species):
+    """
+    :param species: (str): species of the specimens
+    :return: (str) --layer_list value of skelekeys-layer-aligned-swc, e.g. "['Layer1', 'Layer2/3', ...]", or "None"
+    for species without a layer list
+    """
+    if species not in SPECIES_LAYER_LISTS:
+        return "None"
+    return str(SPECIES_LAYER_LISTS[species])
+
+
+def command_argv(command_kwargs):
+    """
+    :param command_kwargs: (dict): argument name -> value, arguments with a None value are left out
+    :return: (list) of str command line arguments, e.g. ["--specimen_id", "123", ...], one item per value however
+    many spaces it contains
+    """
+    argv = []
+    for k, v in command_kwargs.items():
+        if v is not None:
+            argv.extend([f"--{k}", str(v)])
+    return argv
+
+
+def shell_quote(value):
+    """
+    Quote a command line argument for a job file. Values with shell variables (e.g. "${SPECIMEN_ID}") are double
+    quoted so the variables still expand when the job runs
+
+    :param value: (str): argument
+    :return: (str)
+    """
+    if (shlex.quote(value) == value) or any(c in value for c in '"\\`!'):
+        return shlex.quote(value)
+    return f'"{value}"'
+
+
+def shell_command(script_name, argv):
+    """
+    :param script_name: (str): console script name
+    :param argv: (list): command line arguments, see command_argv
+    :return: (str) command line to execute in a job file
+    """
+    return " ".join([script_name] + [shell_quote(arg) for arg in argv])
+
+
+def file_gen_paths(sp_id,
+                   upright_swc_dir,
+                   aligned_swc_dir,
+                   qc_image_dir,
+                   raw_orientation_swc_dir,
+                   polygon_json_dir,
+                   **kwargs):
+    """
+    Input and output file paths used when generating files for a single specimen. Raw swc and polygon json paths are
+    None when those are pulled from the database.
+
+    :param sp_id: (str): specimen id
+    :return: dict with keys la_file, ur_file, qc_image_file, raw_swc_file, polygon_json
+    """
+    paths = {
+        "la_file": os.path.abspath(os.path.join(aligned_swc_dir, "{}.swc".format(sp_id))),
+        "ur_file": os.path.abspath(os.path.join(upright_swc_dir, "{}.swc".format(sp_id))),
+        "qc_image_file": os.path.abspath(os.path.join(qc_image_dir, "{}.png".format(sp_id))),
+        "raw_swc_file": None,
+        "polygon_json": None,
+    }
+    if raw_orientation_swc_dir is not None:
+        # In this scenario we have raw swc files that we will need to upright/layeralign based on drawings
+        paths["raw_swc_file"] = os.path.abspath(os.path.join(raw_orientation_swc_dir, "{}.swc".format(sp_id)))
+
+    if polygon_json_dir is not None:
+        paths["polygon_json"] = os.path.abspath(os.path.join(polygon_json_dir, "{}.json".format(sp_id)))
+
+    return paths
+
+
+def file_gen_command_args(sp_id,
+                          upright_swc_dir,
+                          aligned_swc_dir,
+                          qc_image_dir,
+                          raw_orientation_swc_dir,
+                          polygon_json_dir,
+                          layer_depths_file,
+                          surface_paths_file,
+                          closest_surface_voxel_file,
+                          shrinkage_correction,
+                          slice_angle_tilt_correction,
+                          layer_list,
+                          align_morph_to_layer_drawings,
+                          swc_sidecars=False):
+    """
+    Console scripts and their command line arguments that generate layer-aligned, upright and qc image files for a
+    single specimen.
+
+    :param sp_id: (str): specimen id, or a shell variable (e.g. "${SPECIMEN_ID}") that resolves to one at run time
+    :param layer_list: (str): see layer_list_argument
+    :param swc_sidecars: (bool): also write binary sidecars of the upright and layer-aligned swc files, the qc image is
+    then drawn from them
+    :return: list of (console script name, argv) tuples, see command_argv
+    """
+    paths = file_gen_paths(sp_id, upright_swc_dir, aligned_swc_dir, qc_image_dir, raw_orientation_swc_dir,
+                           polygon_json_dir)
+    la_file, ur_file, qc_image_file = paths["la_file"], paths["ur_file"], paths["qc_image_file"]
+    raw_swc_file, polygon_json = paths["raw_swc_file"], paths["polygon_json"]
+
+    # what you want to run on slurm
+    upright_command_kwargs = {
+        "specimen_id": sp_id,
+        "output_file": ur_file,
+        "closest_surface_voxel_file": closest_surface_voxel_file,
+        "surface_paths_file": surface_paths_file,
+        "swc_path": raw_swc_file,
+        "surface_and_layers_file": polygon_json,
+        "correct_for_shrinkage": shrinkage_correction,
+        "correct_for_slice_angle": slice_angle_tilt_correction,
+    }
+
+    layer_align_command_kwargs = {
+        "specimen_id": sp_id,
+        "output_file": la_file,
+        "layer_depths_file": layer_depths_file,
+        "closest_surface_voxel_file": closest_surface_voxel_file,
+        "surface_paths_file": surface_paths_file,
+        "swc_path": raw_swc_file,
+        "surface_and_layers_file": polygon_json,
+        "correct_for_shrinkage": shrinkage_correction,
+        "correct_for_slice_angle": slice_angle_tilt_correction,
+        "layer_list": layer_list,
+        "align_morph_to_layer_drawings": align_morph_to_layer_drawings
+    }
+
+    qc_image_command_kwargs = {
+        "ur_swc": ur_file,
+        "la_swc": la_file,
+        "qc_image_file": qc_image_file,
+        "layer_depths_file": layer_depths_file
+    }
+
+    command_args = [
+        ("skelekeys-layer-aligned-swc", command_argv(layer_align_command_kwargs)),
+        ("skelekeys-upright-corrected-swc", command_argv(upright_command_kwargs)),
+    ]
+    if swc_sidecars:
+        command_args.append(("swc_sidecars", command_argv({"swc_files": [la_file, ur_file]})))
+    command_args.append(("qc_swc_image", command_argv(qc_image_command_kwargs)))
+    return command_args
+
+
+def file_gen_commands(sp_id, swc_sidecars=False, **file_gen_kwargs):
+    """
+    Build the commands that generate layer-aligned, upright and qc image files for a single specimen.
+
+    :param sp_id: (str): specimen id, or a shell variable (e.g. "${SPECIMEN_ID}") that resolves to one at run time
+    :param swc_sidecars: (bool): see file_gen_command_args
+    :param file_gen_kwargs: see file_gen_command_args
+    :return: list of str commands to execute in a job file
+    """
+    return [shell_command(script, argv) for script, argv in file_gen_command_args(sp_id, swc_sidecars=swc_sidecars,
+                                                                                  **file_gen_kwargs)]
+
+
+def file_gen_chunk_command(specimen_id_file, failure_log_file=None, swc_cache_kwargs=None, swc_sidecars=False,
+                           **file_gen_kwargs):
+    """
+    Build the command that generates files for every specimen listed in specimen_id_file in one python process
+    (see skeleton_keychain.process_specimen_chunk)
+
+    :param specimen_id_file: (str): txt file with specimen ids, or a shell variable that resolves to one at run time
+    :param failure_log_file: (str): file the chunk appends failed specimen ids to
+    :param swc_cache_kwargs: (dict): swc_cache_dir, swc_cache_key_file and max_swc_cache_gb when generated files
+    should be added to the swc cache
+    :param swc_sidecars: (bool): see file_gen_command_args
+    :param file_gen_kwargs: see file_gen_command_args
+    :return: (str) command to execute in a job file
+    """
+    chunk_kwargs = {"specimen_id_file": specimen_id_file, **file_gen_kwargs, "failure_log_file": failure_log_file,
+                    **(swc_cache_kwargs or {})}
+    if swc_sidecars:
+        chunk_kwargs["swc_sidecars"] = True
+    return shell_command("process_specimen_chunk", command_argv(chunk_kwargs))
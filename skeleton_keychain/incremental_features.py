@@ -0,0 +1,245 @@
+import json
+import time
+import os
+import argschema as ags
+import numpy as np
+from skeleton_keychain.manifest import file_fingerprint
+from skeleton_keychain.file_generation import command_argv, shell_command
+
+# record of the specimens in RawFeatureLong.csv and the swc files their features were calculated from
+FEATURE_RECORD_FILE_NAME = "feature_record.json"
+SPECIMEN_ID_COLUMN = "specimen_id"
+
+
+class IO_Schema(ags.ArgSchema):
+    specimen_id_file = ags.fields.InputFile(description="txt file with the specimen ids of the merged long table")
+    increment_specimen_id_file = ags.fields.InputFile(
+        description="txt file with the specimen ids whose features were calculated by this run")
+    increment_files = ags.fields.List(ags.fields.InputFile, cli_as_single_argument=True, default=None,
+                                      allow_none=True,
+                                      description="long format feature csvs of the increment specimens")
+    base_file = ags.fields.Str(default=None, allow_none=True,
+                               description="existing long format feature csv, rows of specimens in "
+                                           "specimen_id_file but not in the increment are kept")
+    output_file = ags.fields.OutputFile(description="merged long format feature csv")
+    swc_dirs = ags.fields.List(ags.fields.Str, cli_as_single_argument=True,
+                               description="directories of the swc files the features are calculated from")
+    params_hash = ags.fields.Str(description="digest of the feature parameters, see feature_record_params")
+    record_file = ags.fields.OutputFile(description="feature record to update")
+
+
+def feature_record_params(swc_dir, analyze_axon, analyze_basal_dendrite, analyze_apical_dendrite,
+                          orientation_independent_features, loadings_files):
+    """
+    Parameters that make rows of two runs incomparable, a change recalculates every specimen. The aligned soma
+    depth and depth profile files are not part of them because old specimens keep their rows in those files
+
+    :param loadings_files: (dict): compartment -> depth profile loadings file the features are projected onto
+    :return: (dict)
+    """
+    return {
+        "swc_dir": os.path.abspath(swc_dir),
+        "analyze_axon": analyze_axon,
+        "analyze_basal_dendrite": analyze_basal_dendrite,
+        "analyze_apical_dendrite": analyze_apical_dendrite,
+        "orientation_independent_features": orientation_independent_features,
+        "loadings_files": {compartment: os.path.abspath(f) for compartment, f in loadings_files.items()},
+    }
+
+
+def specimen_signature(sp_id, swc_dirs):
+    """
+    :return: (list) size and mtime of the specimen's swc file in each directory (None for a missing file)
+    """
+    return [file_fingerprint(os.path.join(swc_dir, f"{sp_id}.swc")) for swc_dir in swc_dirs]
+
+
+def load_feature_record(record_file):
+    """:return: (dict) the feature record or None when there is none"""
+    if not os.path.exists(record_file):
+        return None
+    with open(record_file, "r") as f:
+        return json.load(f)
+
+
+def write_feature_record(record_file, record):
+    tmp_file = record_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp_file, record_file)
+
+
+def plan_feature_increment(specimen_ids, swc_dirs, long_file, record_file, params_hash,
+                           pending_specimen_ids=()):
+    """
+    Find the specimens whose features have to be calculated to bring an existing long table up to date
+
+    :param specimen_ids: (list): specimen ids the long table should hold
+    :param swc_dirs: (list): directories of the swc files the features are calculated from
+    :param long_file: (str): existing RawFeatureLong.csv
+    :param record_file: (str): feature record written with long_file
+    :param params_hash: (str): digest of feature_record_params
+    :param pending_specimen_ids: (iterable): specimens whose swc files are (re)generated by this run
+    :return: (list) specimen ids to calculate, or None when the long table can not be reused and every specimen
+    has to be calculated
+    """
+    record = load_feature_record(record_file)
+    if record is None:
+        print(f"No feature record in {record_file}, calculating features of every specimen")
+        return None
+    if record["long_file_fingerprint"] != file_fingerprint(long_file):
+        print(f"{long_file} is missing or was rewritten outside of an incremental run, calculating features of "
+              f"every specimen")
+        return None
+    if record["params_hash"] != params_hash:
+        print("Feature parameters changed since the long table was written, calculating features of every specimen")
+        return None
+
+    pending_specimen_ids = set(str(sp_id) for sp_id in pending_specimen_ids)
+    recorded = record["specimens"]
+    increment_specimen_ids = []
+    n_new = 0
+    for sp_id in specimen_ids:
+        sp_id = str(sp_id)
+        if sp_id not in recorded:
+            n_new += 1
+            increment_specimen_ids.append(sp_id)
+        elif (sp_id in pending_specimen_ids) or (recorded[sp_id] != specimen_signature(sp_id, swc_dirs)):
+            increment_specimen_ids.append(sp_id)
+    print(f"Incremental features: {n_new} new and {len(increment_specimen_ids) - n_new} changed specimens to "
+          f"calculate, {len(specimen_ids) - len(increment_specimen_ids)} reused from {long_file}")
+    return increment_specimen_ids
+
+
+def _specimen_id_column(header_line):
+    columns = [c.strip().strip('"') for c in header_line.rstrip("\r\n").split(",")]
+    if SPECIMEN_ID_COLUMN in columns:
+        return columns.index(SPECIMEN_ID_COLUMN)
+    return 0
+
+
+def _line_specimen_id(line, id_column):
+    value = line.split(",", id_column + 1)[id_column].strip().strip('"')
+    # pandas writes integer ids of a column that held missing values as floats
+    if value.endswith(".0"):
+        value = value[:-2]
+    return value
+
+
+def merge_feature_increment(base_file, increment_files, keep_specimen_ids, output_file):
+    """
+    Stream the rows of keep_specimen_ids out of an existing long table and append the increment tables, the output
+    is only moved into place once everything was copied so base_file may be the output_file
+
+    :param base_file: (str): existing long table or None
+    :param increment_files: (list): long tables of the recalculated specimens, with the header of base_file
+    :param keep_specimen_ids: (set): specimens whose rows are kept from base_file
+    :param output_file: (str): merged long table
+    :return: (dict) with keys kept and calculated, the specimen ids written from base_file and increment_files
+    """
+    keep_specimen_ids = set(str(sp_id) for sp_id in keep_specimen_ids)
+    written = {"kept": set(), "calculated": set()}
+    tmp_file = output_file + ".tmp"
+    header = None
+    with open(tmp_file, "w", newline="") as out_f:
+        sources = [(base_file, "kept")] if base_file is not None else []
+        sources += [(increment_file, "calculated") for increment_file in increment_files]
+        for input_file, source in sources:
+            with open(input_file, "r", newline="") as in_f:
+                file_header = in_f.readline()
+                if not file_header:
+                    continue
+                if header is None:
+                    header = file_header
+                    id_column = _specimen_id_column(header)
+                    out_f.write(header if header.endswith("\n") else header + "\n")
+                elif file_header.rstrip("\r\n") != header.rstrip("\r\n"):
+                    raise ValueError(f"Header of {input_file} does not match the header of {sources[0][0]}")
+                for line in in_f:
+                    if not line.strip():
+                        continue
+                    sp_id = _line_specimen_id(line, id_column)
+                    if (source == "kept") and (sp_id not in keep_specimen_ids):
+                        continue
+                    written[source].add(sp_id)
+                    out_f.write(line if line.endswith("\n") else line + "\n")
+    if header is None:
+        os.remove(tmp_file)
+        raise ValueError("No feature rows to merge")
+    os.replace(tmp_file, output_file)
+    return written
+
+
+def long_table_specimen_ids(long_file):
+    """:return: (set) specimen ids with rows in a long table"""
+    specimen_ids = set()
+    with open(long_file, "r", newline="") as f:
+        id_column = _specimen_id_column(f.readline())
+        for line in f:
+            if line.strip():
+                specimen_ids.add(_line_specimen_id(line, id_column))
+    return specimen_ids
+
+
+def merge_feature_increment_command(specimen_id_file, increment_specimen_id_file, output_file, swc_dirs,
+                                    params_hash, record_file, base_file=None, increment_files=None):
+    """
+    :return: (str) command that merges an increment into the long table (when base_file or increment_files are
+    given) and records the calculated specimens
+    """
+    return shell_command("merge_feature_increment", command_argv({
+        "specimen_id_file": specimen_id_file,
+        "increment_specimen_id_file": increment_specimen_id_file,
+        "output_file": output_file,
+        "swc_dirs": list(swc_dirs),
+        "params_hash": params_hash,
+        "record_file": record_file,
+        "base_file": base_file,
+        "increment_files": list(increment_files) if increment_files else None,
+    }))
+
+
+def main(specimen_id_file, increment_specimen_id_file, increment_files, base_file, output_file, swc_dirs,
+         params_hash, record_file, **kwargs):
+    start_time = time.time()
+    specimen_ids = [str(sp_id) for sp_id in np.loadtxt(specimen_id_file, dtype=str, ndmin=1)]
+    increment_specimen_ids = set(str(sp_id) for sp_id in np.loadtxt(increment_specimen_id_file, dtype=str,
+                                                                    ndmin=1))
+
+    if (base_file is not None) or increment_files:
+        written = merge_feature_increment(base_file, increment_files or [],
+                                          set(specimen_ids) - increment_specimen_ids, output_file)
+        print(f"Merged rows of {len(written['kept'])} kept and {len(written['calculated'])} calculated specimens "
+              f"into {output_file}")
+    else:
+        # every specimen was calculated straight into output_file
+        written = {"kept": set(), "calculated": long_table_specimen_ids(output_file)}
+
+    # specimens the feature calculation failed for have no rows and no record, they are calculated again next run
+    old_record = load_feature_record(record_file) or {"specimens": {}}
+    record_specimens = {}
+    for sp_id in specimen_ids:
+        if (sp_id in written["calculated"]) and (sp_id in increment_specimen_ids):
+            record_specimens[sp_id] = specimen_signature(sp_id, swc_dirs)
+        elif (sp_id in written["kept"]) and (sp_id in old_record["specimens"]):
+            record_specimens[sp_id] = old_record["specimens"][sp_id]
+    missing = [sp_id for sp_id in specimen_ids if sp_id not in record_specimens]
+    if missing:
+        print(f"WARNING: {len(missing)} specimens have no feature rows, e.g. {missing[:10]}")
+
+    write_feature_record(record_file, {
+        "params_hash": params_hash,
+        "long_file_fingerprint": file_fingerprint(output_file),
+        "specimens": record_specimens,
+    })
+    print(f"Recorded {len(record_specimens)} specimens in {record_file} ({time.time() - start_time:.1f}s)")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
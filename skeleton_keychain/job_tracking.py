@@ -0,0 +1,463 @@
+from datetime import datetime
+import subprocess
+import sqlite3
+import json
+import time
+import os
+import argschema as ags
+from skeleton_keychain.executors import parse_memory_mb, parse_array_spec
+
+JOB_DATABASE_FILE_NAME = "run_jobs.sqlite"
+LOCAL_ACCOUNTING_FILE_NAME = "local_job_accounting.jsonl"
+STATUS_FILE_NAME = "run_status.json"
+STATUS_HISTORY_FILE_NAME = "run_status_history.jsonl"
+
+FINISHED_STATES = ["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED",
+                   "BOOT_FAIL", "DEADLINE"]
+
+
+class IO_Schema(ags.ArgSchema):
+    output_dir = ags.fields.InputDir(description="run_features output directory")
+    run_id = ags.fields.Int(default=None, allow_none=True, description="Run to report on, defaults to the latest run")
+    update = ags.fields.Boolean(default=True, description="If true, poll sacct (or read the local executor's "
+                                                          "accounting file) before reporting")
+    summary_file = ags.fields.Str(default=None, allow_none=True,
+                                  description="Where to write the json summary, defaults to output_dir/run_status.json")
+
+
+class JobDatabase:
+    """
+    sqlite database in a run_features output directory with every job that was submitted (stage, specimens,
+    resources, job id) and the accounting information collected for those jobs afterwards
+    """
+
+    def __init__(self, output_dir):
+        self.db_file = os.path.join(output_dir, JOB_DATABASE_FILE_NAME)
+        self.connection = sqlite3.connect(self.db_file)
+        self.connection.executescript("""
+            create table if not exists runs (
+                run_id integer primary key autoincrement,
+                started_at real,
+                executor text,
+                n_specimens integer
+            );
+            create table if not exists jobs (
+                run_id integer,
+                node_id integer,
+                job_id text,
+                stage text,
+                name text,
+                job_file text,
+                parent_job_ids text,
+                start_condition text,
+                cpus integer,
+                mem_mb integer,
+                time_limit text,
+                n_tasks integer,
+                task_specimen_ids text,
+                submitted_at real,
+                task_input_bytes text,
+                primary key (run_id, node_id)
+            );
+            create table if not exists accounting (
+                job_id text primary key,
+                parent_job_id text,
+                task_id integer,
+                state text,
+                submit_time real,
+                start_time real,
+                end_time real,
+                elapsed_s real,
+                max_rss_mb real,
+                exit_code text,
+                updated_at real
+            );
+            create index if not exists accounting_parent_job_id on accounting (parent_job_id);
+            create table if not exists schedule_plans (
+                run_id integer,
+                stage text,
+                cost_unit text,
+                n_units integer,
+                max_unit_cost real,
+                mean_unit_cost real,
+                predicted_makespan_s real,
+                primary key (run_id, stage)
+            );
+        """)
+        job_columns = [row[1] for row in self.connection.execute("pragma table_info(jobs)").fetchall()]
+        if "task_input_bytes" not in job_columns:
+            self.connection.execute("alter table jobs add column task_input_bytes text")
+        self.connection.commit()
+
+    def start_run(self, executor_name, n_specimens):
+        """
+        :return: (int) id of the new run
+        """
+        cursor = self.connection.execute("insert into runs (started_at, executor, n_specimens) values (?, ?, ?)",
+                                         (time.time(), executor_name, n_specimens))
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def latest_run_id(self):
+        row = self.connection.execute("select max(run_id) from runs").fetchone()
+        return row[0]
+
+    def get_run(self, run_id):
+        row = self.connection.execute("select run_id, started_at, executor, n_specimens from runs where run_id = ?",
+                                      (run_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"No run {run_id} in {self.db_file}")
+        return dict(zip(["run_id", "started_at", "executor", "n_specimens"], row))
+
+    def record_jobs(self, run_id, workflow):
+        """
+        Record every submitted node of a Slurm_DAG. Nodes may carry a stage and either specimen_ids (one list for
+        the whole job) or task_specimen_ids (one list per array task), and likewise input_bytes or task_input_bytes
+        (total size of the input files, used by the resource model)
+
+        :param run_id: (int): see start_run
+        :param workflow: Slurm_DAG after submit_dag_to_scheduler
+        :return: None
+        """
+        rows = []
+        for node in workflow.nodes:
+            if node['id'] not in workflow.job_ids:
+                continue
+            slurm_kwargs = node.get('slurm_kwargs', {})
+            task_specimen_ids = node.get('task_specimen_ids', [node.get('specimen_ids', [])])
+            task_input_bytes = node.get('task_input_bytes', [node.get('input_bytes')] * len(task_specimen_ids))
+            rows.append((
+                run_id,
+                node['id'],
+                str(workflow.job_ids[node['id']]),
+                node.get('stage', node.get('name')),
+                node.get('name'),
+                node['job_file'],
+                json.dumps([str(workflow.job_ids[p]) for p in workflow.parent_index[node['id']]]),
+                node.get('start_condition', 'afterany'),
+                int(slurm_kwargs.get('--cpus-per-task', 1)),
+                parse_memory_mb(slurm_kwargs.get('--mem', 0)),
+                slurm_kwargs.get('--time'),
+                len(task_specimen_ids),
+                json.dumps([[str(sp_id) for sp_id in task] for task in task_specimen_ids]),
+                time.time(),
+                json.dumps(task_input_bytes),
+            ))
+        self.connection.executemany("insert or replace into jobs values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    rows)
+        self.connection.commit()
+
+    def record_plans(self, run_id, plans):
+        """
+        :param plans: (list) of dict, see planning.schedule_plan
+        """
+        columns = ["stage", "cost_unit", "n_units", "max_unit_cost", "mean_unit_cost", "predicted_makespan_s"]
+        self.connection.executemany("insert or replace into schedule_plans values (?, ?, ?, ?, ?, ?, ?)",
+                                    [[run_id] + [plan[c] for c in columns] for plan in plans])
+        self.connection.commit()
+
+    def get_plans(self, run_id):
+        """
+        :return: (dict) stage -> schedule plan of the run
+        """
+        cursor = self.connection.execute("select * from schedule_plans where run_id = ?", (run_id,))
+        columns = [c[0] for c in cursor.description]
+        return {row[1]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+    def get_jobs(self, run_id):
+        """
+        :return: (list) of dict, one per job of the run
+        """
+        cursor = self.connection.execute("select * from jobs where run_id = ? order by node_id", (run_id,))
+        columns = [c[0] for c in cursor.description]
+        jobs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for job in jobs:
+            job["parent_job_ids"] = json.loads(job["parent_job_ids"])
+            job["task_specimen_ids"] = json.loads(job["task_specimen_ids"])
+            job["task_input_bytes"] = json.loads(job["task_input_bytes"]) if job["task_input_bytes"] else None
+        return jobs
+
+    def update_accounting(self, records):
+        """
+        :param records: (list) of dict with keys job_id, parent_job_id, task_id, state, submit_time, start_time,
+        end_time, elapsed_s, max_rss_mb, exit_code
+        """
+        columns = ["job_id", "parent_job_id", "task_id", "state", "submit_time", "start_time", "end_time",
+                   "elapsed_s", "max_rss_mb", "exit_code"]
+        self.connection.executemany(
+            f"insert or replace into accounting values ({', '.join(['?'] * (len(columns) + 1))})",
+            [[r.get(c) for c in columns] + [time.time()] for r in records])
+        self.connection.commit()
+
+    def get_accounting(self, parent_job_ids):
+        """
+        :return: (dict) parent job id -> list of accounting dicts (one per job, or per task for job arrays)
+        """
+        accounting = {str(j): [] for j in parent_job_ids}
+        job_id_list = list(accounting)
+        for batch_start in range(0, len(job_id_list), 500):
+            batch = job_id_list[batch_start:batch_start + 500]
+            cursor = self.connection.execute("select * from accounting where parent_job_id in ({})".format(
+                ", ".join("?" * len(batch))), batch)
+            columns = [c[0] for c in cursor.description]
+            for row in cursor.fetchall():
+                record = dict(zip(columns, row))
+                accounting[record["parent_job_id"]].append(record)
+        return accounting
+
+    def close(self):
+        self.connection.close()
+
+
+def _parse_sacct_time(value):
+    if value in ["", "Unknown", "None", None]:
+        return None
+    return datetime.fromisoformat(value).timestamp()
+
+
+def split_job_id(job_id):
+    """
+    :param job_id: (str): slurm job id, e.g. 123, 123_4 or 123.batch
+    :return: (str) parent job id, (int) or None array task id, (str) or None step name
+    """
+    job_id, _, step = job_id.partition(".")
+    parent_job_id, _, task_id = job_id.partition("_")
+    task_id = int(task_id) if task_id.isdigit() else None
+    return parent_job_id, task_id, (step or None)
+
+
+def query_sacct(job_ids, batch_size=500):
+    """
+    Accounting of slurm jobs (and every task of job arrays). MaxRSS is only reported on job steps, the largest step
+    value is used for each job.
+
+    :param job_ids: (list): slurm job ids
+    :param batch_size: (int): job ids per sacct call
+    :return: (list) of accounting dicts, see JobDatabase.update_accounting
+    """
+    fields = ["JobID", "State", "Submit", "Start", "End", "ElapsedRaw", "MaxRSS", "ExitCode"]
+    records = {}
+    job_ids = [str(j) for j in job_ids]
+    for batch_start in range(0, len(job_ids), batch_size):
+        command = ["sacct", "--parsable2", "--noheader", "--format={}".format(",".join(fields)),
+                   "-j", ",".join(job_ids[batch_start:batch_start + batch_size])]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"sacct failed: {result.stderr.strip()}")
+
+        for line in result.stdout.splitlines():
+            values = dict(zip(fields, line.split("|")))
+            if len(values) != len(fields):
+                continue
+            # pending tasks of job arrays are reported as one line, e.g. 123_[4-10%2]
+            if "[" in values["JobID"]:
+                parent_job_id, _, array_spec = values["JobID"].partition("_")
+                for task_id in parse_array_spec(array_spec.strip("[]"))[0]:
+                    records[f"{parent_job_id}_{task_id}"] = {
+                        "job_id": f"{parent_job_id}_{task_id}", "parent_job_id": parent_job_id, "task_id": task_id,
+                        "state": values["State"].split(" ")[0], "submit_time": _parse_sacct_time(values["Submit"]),
+                        "start_time": None, "end_time": None, "elapsed_s": None, "max_rss_mb": None,
+                        "exit_code": values["ExitCode"]}
+                continue
+            parent_job_id, task_id, step = split_job_id(values["JobID"])
+            job_key = values["JobID"].split(".")[0]
+            record = records.setdefault(job_key, {"job_id": job_key, "parent_job_id": parent_job_id,
+                                                  "task_id": task_id, "max_rss_mb": None})
+            if step is None:
+                record.update({
+                    "state": values["State"].split(" ")[0],
+                    "submit_time": _parse_sacct_time(values["Submit"]),
+                    "start_time": _parse_sacct_time(values["Start"]),
+                    "end_time": _parse_sacct_time(values["End"]),
+                    "elapsed_s": float(values["ElapsedRaw"]) if values["ElapsedRaw"] else None,
+                    "exit_code": values["ExitCode"],
+                })
+            elif values["MaxRSS"]:
+                rss_mb = parse_memory_mb(values["MaxRSS"])
+                record["max_rss_mb"] = max(record["max_rss_mb"] or 0, rss_mb)
+
+    return [r for r in records.values() if "state" in r]
+
+
+def read_local_accounting(accounting_file):
+    """
+    :param accounting_file: (str): jsonl written by LocalExecutor, the local stand-in for sacct
+    :return: (list) of accounting dicts, see JobDatabase.update_accounting
+    """
+    if not os.path.exists(accounting_file):
+        return []
+    with open(accounting_file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def update_job_status(job_db, run_id, output_dir):
+    """
+    Collect accounting for every job of a run, from sacct for slurm runs or the local accounting file
+
+    :return: None
+    """
+    run = job_db.get_run(run_id)
+    if run["executor"] == "local":
+        records = read_local_accounting(os.path.join(output_dir, LOCAL_ACCOUNTING_FILE_NAME))
+    else:
+        records = query_sacct([job["job_id"] for job in job_db.get_jobs(run_id)])
+    job_db.update_accounting(records)
+
+
+def unfinished_job_ids(jobs, accounting):
+    """
+    :param jobs: (list): jobs of a run, see JobDatabase.get_jobs
+    :param accounting: (dict): their accounting, see JobDatabase.get_accounting
+    :return: (list) ids of the jobs with a task that has no accounting yet or is not in one of FINISHED_STATES
+    """
+    job_ids = []
+    for job in jobs:
+        task_states = {r["task_id"]: r["state"] for r in accounting[job["job_id"]]}
+        if any(task_id is not None for task_id in task_states):
+            task_ids = range(len(job["task_specimen_ids"]))
+        else:
+            task_ids = [None]
+        if any(task_states.get(task_id) not in FINISHED_STATES for task_id in task_ids):
+            job_ids.append(job["job_id"])
+    return job_ids
+
+
+def _mean(values):
+    return float(sum(values) / len(values)) if values else None
+
+
+def summarize_run(job_db, run_id):
+    """
+    Per stage job counts, states, queue/run times, max RSS and throughput of a run
+
+    :return: (dict) json serializable summary
+    """
+    run = job_db.get_run(run_id)
+    jobs = job_db.get_jobs(run_id)
+    accounting = job_db.get_accounting([job["job_id"] for job in jobs])
+
+    stages = {}
+    failed_specimens = {}
+    for job in jobs:
+        stage = stages.setdefault(job["stage"], {"jobs": 0, "tasks": 0, "states": {}, "specimens": 0,
+                                                 "specimens_completed": 0, "queue_s": [], "run_s": [],
+                                                 "max_rss_mb": [], "requested_mem_mb": job["mem_mb"],
+                                                 "requested_cpus": job["cpus"], "requested_time": job["time_limit"],
+                                                 "first_start": None, "last_end": None})
+        stage["jobs"] += 1
+        stage["tasks"] += job["n_tasks"]
+        task_records = {r["task_id"]: r for r in accounting[job["job_id"]]}
+        is_array = any(task_id is not None for task_id in task_records)
+
+        for task_idx, task_specimen_ids in enumerate(job["task_specimen_ids"]):
+            record = task_records.get(task_idx if is_array else None)
+            state = "UNKNOWN" if record is None else record["state"]
+            stage["states"][state] = stage["states"].get(state, 0) + 1
+            stage["specimens"] += len(task_specimen_ids)
+            if state == "COMPLETED":
+                stage["specimens_completed"] += len(task_specimen_ids)
+            elif state in FINISHED_STATES:
+                for sp_id in task_specimen_ids:
+                    failed_specimens.setdefault(sp_id, []).append(f"{job['stage']} ({state}, job {record['job_id']})")
+
+            if record is None:
+                continue
+            if record["start_time"] is not None and record["submit_time"] is not None:
+                stage["queue_s"].append(record["start_time"] - record["submit_time"])
+            if record["elapsed_s"] is not None and state in FINISHED_STATES:
+                stage["run_s"].append(record["elapsed_s"])
+            if record["max_rss_mb"] is not None:
+                stage["max_rss_mb"].append(record["max_rss_mb"])
+            if record["start_time"] is not None:
+                stage["first_start"] = min(filter(None, [stage["first_start"], record["start_time"]]))
+            if record["end_time"] is not None and state in FINISHED_STATES:
+                stage["last_end"] = max(filter(None, [stage["last_end"], record["end_time"]]))
+
+    plans = job_db.get_plans(run_id)
+    for stage_name, stage in stages.items():
+        queue_s, run_s, max_rss_mb = stage.pop("queue_s"), stage.pop("run_s"), stage.pop("max_rss_mb")
+        first_start, last_end = stage.pop("first_start"), stage.pop("last_end")
+        wall_s = (last_end - first_start) if (first_start is not None and last_end is not None) else None
+        stage.update({
+            "mean_queue_s": _mean(queue_s),
+            "max_queue_s": max(queue_s) if queue_s else None,
+            "mean_run_s": _mean(run_s),
+            "max_run_s": max(run_s) if run_s else None,
+            "total_run_s": float(sum(run_s)),
+            "mean_max_rss_mb": _mean(max_rss_mb),
+            "max_rss_mb": max(max_rss_mb) if max_rss_mb else None,
+            "wall_s": wall_s,
+            "specimens_per_hour": (3600 * stage["specimens_completed"] / wall_s) if wall_s else None,
+            # wall time of stages that were spread over their jobs by estimated cost, see planning
+            "predicted_makespan_s": plans[stage_name]["predicted_makespan_s"] if stage_name in plans else None,
+        })
+
+    return {
+        "run_id": run_id,
+        "executor": run["executor"],
+        "started_at": run["started_at"],
+        "n_specimens": run["n_specimens"],
+        "generated_at": time.time(),
+        "stages": stages,
+        "failed_specimens": failed_specimens,
+    }
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    return time.strftime("%H:%M:%S", time.gmtime(seconds)) if seconds < 86400 else f"{seconds / 3600:.1f}h"
+
+
+def print_summary(summary):
+    print(f"Run {summary['run_id']} ({summary['executor']}), {summary['n_specimens']} specimens")
+    header = f"{'stage':<18}{'jobs':>6}{'tasks':>7}{'mean queue':>12}{'mean run':>10}{'max run':>10}" \
+             f"{'max rss (mb)':>14}{'specimens/h':>13}  states"
+    print(header)
+    for stage_name, stage in summary["stages"].items():
+        max_rss = "-" if stage["max_rss_mb"] is None else f"{stage['max_rss_mb']:.0f}"
+        throughput = "-" if stage["specimens_per_hour"] is None else f"{stage['specimens_per_hour']:.1f}"
+        states = ", ".join([f"{s}: {n}" for s, n in sorted(stage["states"].items())])
+        print(f"{stage_name:<18}{stage['jobs']:>6}{stage['tasks']:>7}{_format_seconds(stage['mean_queue_s']):>12}"
+              f"{_format_seconds(stage['mean_run_s']):>10}{_format_seconds(stage['max_run_s']):>10}{max_rss:>14}"
+              f"{throughput:>13}  {states}")
+    for stage_name, stage in summary["stages"].items():
+        if stage.get("predicted_makespan_s") is not None:
+            print(f"{stage_name} makespan: predicted {_format_seconds(stage['predicted_makespan_s'])}, actual "
+                  f"{_format_seconds(stage['wall_s'])} (first start to last end)")
+    if summary["failed_specimens"]:
+        print(f"{len(summary['failed_specimens'])} specimens in jobs that did not complete")
+
+
+def main(output_dir, run_id, update, summary_file, **kwargs):
+    """
+    Report queue time, run time, max RSS, exit state and throughput per stage for a run_features run
+    """
+    job_db = JobDatabase(output_dir)
+    if run_id is None:
+        run_id = job_db.latest_run_id()
+        if run_id is None:
+            raise ValueError(f"No runs recorded in {job_db.db_file}")
+
+    if update:
+        update_job_status(job_db, run_id, output_dir)
+    summary = summarize_run(job_db, run_id)
+    job_db.close()
+    print_summary(summary)
+
+    if summary_file is None:
+        summary_file = os.path.join(output_dir, STATUS_FILE_NAME)
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2)
+    with open(os.path.join(output_dir, STATUS_HISTORY_FILE_NAME), "a") as f:
+        f.write(json.dumps(summary) + "\n")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
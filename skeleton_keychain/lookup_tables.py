@@ -0,0 +1,350 @@
+import shutil
+import json
+import mmap
+import sys
+import os
+import argschema as ags
+import numpy as np
+from skeleton_keychain.swc_cache import content_digest
+
+LOOKUP_INDEX_FILE_NAME = "index.json"
+# datasets are copied and compared in blocks of rows of about this size
+CONVERSION_BLOCK_BYTES = 256 * 1024 ** 2
+
+
+class IO_Schema(ags.ArgSchema):
+    action = ags.fields.Str(default="convert",
+                            description="convert: write memory mappable tables of the HDF5 files (if not there yet), "
+                                        "verify: compare existing tables with their HDF5 files")
+    h5_files = ags.fields.List(ags.fields.InputFile, cli_as_single_argument=True,
+                               description="HDF5 lookup files, e.g. the surface paths and closest surface voxel files")
+    table_dir = ags.fields.Str(description="directory converted tables are kept in, one sub directory per HDF5 file")
+
+
+def lookup_table_path(h5_file, table_dir):
+    """
+    Directory the converted tables of an HDF5 file live in. It is named after the digest of the file's whole content
+    (see swc_cache.content_digest, remembered in table_dir), so a changed lookup file gets new tables even when its
+    size did not change, and tables found under this name can be used without verifying them again.
+
+    :return: (str) directory
+    """
+    name = os.path.splitext(os.path.basename(h5_file))[0]
+    return os.path.join(table_dir, f"{name}-{content_digest(h5_file, memo_dir=table_dir)[:16]}")
+
+
+def find_lookup_tables(h5_file, table_dir):
+    """:return: (str) directory of the converted tables of h5_file, or None when it was not converted"""
+    tables = lookup_table_path(h5_file, table_dir)
+    if os.path.exists(os.path.join(tables, LOOKUP_INDEX_FILE_NAME)):
+        return tables
+    return None
+
+
+def _json_attrs(attrs):
+    json_attrs = {}
+    for k, v in attrs.items():
+        if isinstance(v, bytes):
+            v = v.decode("utf-8")
+        elif isinstance(v, (np.ndarray, np.generic)):
+            v = v.tolist()
+        json_attrs[k] = v
+    return json_attrs
+
+
+def _h5_contents(h5_f):
+    """(dict) dataset name -> dataset, (dict) group name -> attrs of every dataset and group in an open HDF5 file"""
+    import h5py
+
+    datasets = {}
+    groups = {"": _json_attrs(h5_f.attrs)}
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            datasets[name] = obj
+        else:
+            groups[name] = _json_attrs(obj.attrs)
+
+    h5_f.visititems(visit)
+    return datasets, groups
+
+
+def _row_blocks(shape, itemsize):
+    """Slices along the first axis of about CONVERSION_BLOCK_BYTES each"""
+    if len(shape) == 0:
+        return [()]
+    row_bytes = max(int(np.prod(shape[1:])) * itemsize, 1)
+    rows_per_block = max(CONVERSION_BLOCK_BYTES // row_bytes, 1)
+    return [slice(start, start + rows_per_block) for start in range(0, shape[0], rows_per_block)]
+
+
+def convert_lookup_tables(h5_file, table_dir, verify=True):
+    """
+    Write every dataset of an HDF5 file as an uncompressed .npy file plus an index.json describing the datasets,
+    groups and attributes, unless that was done before. Tables are written to a temporary directory and renamed into
+    place, so concurrent conversions of the same file are safe.
+
+    :param h5_file: (str): HDF5 lookup file
+    :param table_dir: (str): directory converted tables are kept in
+    :param verify: (bool): compare the written tables with the HDF5 file before they are used
+    :return: (str) directory of the converted tables
+    """
+    import h5py
+
+    tables = find_lookup_tables(h5_file, table_dir)
+    if tables is not None:
+        return tables
+
+    tables = lookup_table_path(h5_file, table_dir)
+    tmp_dir = f"{tables}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir)
+    index = {"source": os.path.abspath(h5_file), "datasets": {}, "groups": {}}
+    try:
+        with h5py.File(h5_file, "r") as h5_f:
+            datasets, index["groups"] = _h5_contents(h5_f)
+            for dataset_idx, (name, dataset) in enumerate(datasets.items()):
+                if dataset.dtype.kind not in "biufc":
+                    raise ValueError(f"{h5_file} dataset {name} has dtype {dataset.dtype}, only numeric datasets can "
+                                     f"be memory mapped")
+                table_file = f"{dataset_idx}.npy"
+                if dataset.size == 0:
+                    np.save(os.path.join(tmp_dir, table_file), np.empty(dataset.shape, dtype=dataset.dtype))
+                else:
+                    table = np.lib.format.open_memmap(os.path.join(tmp_dir, table_file), mode="w+",
+                                                      dtype=dataset.dtype, shape=dataset.shape)
+                    for block in _row_blocks(dataset.shape, dataset.dtype.itemsize):
+                        table[block] = dataset[block]
+                    table.flush()
+                    del table
+                index["datasets"][name] = {"file": table_file, "shape": list(dataset.shape),
+                                           "dtype": dataset.dtype.str, "attrs": _json_attrs(dataset.attrs)}
+
+        with open(os.path.join(tmp_dir, LOOKUP_INDEX_FILE_NAME), "w") as f:
+            json.dump(index, f, indent=2)
+
+        if verify:
+            mismatches = verify_lookup_tables(h5_file, tmp_dir)
+            if mismatches:
+                raise RuntimeError(f"Converted tables of {h5_file} do not match it: {mismatches}")
+
+        try:
+            os.rename(tmp_dir, tables)
+        except OSError:
+            # converted by another process meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    print(f"Converted {h5_file} to memory mappable tables in {tables}")
+    return tables
+
+
+def verify_lookup_tables(h5_file, tables):
+    """
+    Compare converted tables with their HDF5 file, dataset by dataset and block by block
+
+    :param h5_file: (str): HDF5 lookup file
+    :param tables: (str): directory of its converted tables
+    :return: (list) of str mismatches, empty when the tables match
+    """
+    import h5py
+
+    lookup = MemmapLookup(tables)
+    mismatches = []
+    with h5py.File(h5_file, "r") as h5_f:
+        datasets, groups = _h5_contents(h5_f)
+        converted = set(lookup.dataset_names())
+        for name in sorted(set(datasets) ^ converted):
+            mismatches.append(f"{name} only in {'the HDF5 file' if name in datasets else 'the tables'}")
+        for name in sorted(set(datasets) & converted):
+            dataset, table = datasets[name], lookup[name]
+            if (dataset.shape != table.shape) or (dataset.dtype != table.dtype):
+                mismatches.append(f"{name}: {dataset.shape} {dataset.dtype} != {table.shape} {table.dtype}")
+                continue
+            if dataset.size == 0:
+                continue
+            equal_nan = dataset.dtype.kind in "fc"
+            for block in _row_blocks(dataset.shape, dataset.dtype.itemsize):
+                if not np.array_equal(dataset[block], table[block], equal_nan=equal_nan):
+                    mismatches.append(f"{name}: values differ in rows {block}")
+                    break
+            if _json_attrs(dataset.attrs) != table.attrs:
+                mismatches.append(f"{name}: attributes differ")
+        if groups != lookup.group_attrs:
+            mismatches.append("group attributes differ")
+    return mismatches
+
+
+def localize_lookup_tables(tables, local_dir):
+    """
+    Copy converted tables to node local storage once per node, later calls (from any process) reuse the copy. Falls
+    back to the shared tables when local_dir does not have the space.
+
+    :param tables: (str): directory of converted tables
+    :param local_dir: (str): node local directory, e.g. $TMPDIR
+    :return: (str) directory of the tables to use
+    """
+    local_tables = os.path.join(local_dir, os.path.basename(tables))
+    if os.path.exists(os.path.join(local_tables, LOOKUP_INDEX_FILE_NAME)):
+        return local_tables
+
+    os.makedirs(local_dir, exist_ok=True)
+    with os.scandir(tables) as entries:
+        needed_bytes = sum(entry.stat().st_size for entry in entries if entry.is_file())
+    if shutil.disk_usage(local_dir).free < 1.1 * needed_bytes:
+        print(f"Not enough space in {local_dir} for {tables}, using the shared tables")
+        return tables
+
+    tmp_dir = f"{local_tables}.{os.getpid()}.tmp"
+    try:
+        shutil.copytree(tables, tmp_dir)
+        os.rename(tmp_dir, local_tables)
+    except OSError:
+        # copied by another process on this node meanwhile, or the copy failed
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(local_tables, LOOKUP_INDEX_FILE_NAME)):
+            return tables
+    return local_tables
+
+
+class LookupArray(np.ndarray):
+    """A memory mapped dataset with the h5py style attrs of the dataset it was converted from"""
+
+    def __array_finalize__(self, obj):
+        self.attrs = getattr(obj, "attrs", {})
+
+
+class MemmapLookup:
+    """
+    Read only stand-in for an open h5py.File (or group) of converted lookup tables. Datasets are numpy arrays that
+    memory map the .npy files, so every process on a node shares the same page cache pages and reading a whole
+    dataset (dataset[:]) does not copy it. Every read maps the table copy-on-write: code that modifies what it read
+    gets private pages, the tables and later reads are not affected.
+    """
+
+    def __init__(self, tables, group="", _store=None):
+        """
+        :param tables: (str): directory of converted tables (see convert_lookup_tables)
+        :param group: (str): group within the tables this object represents, "" for the root
+        """
+        if _store is None:
+            with open(os.path.join(tables, LOOKUP_INDEX_FILE_NAME), "r") as f:
+                index = json.load(f)
+            _store = {"index": index, "table_files": {}}
+        self.tables = tables
+        self.filename = _store["index"]["source"]
+        self.name = "/" + group
+        self._group = group
+        self._store = _store
+        self.group_attrs = _store["index"]["groups"]
+        self.attrs = self.group_attrs.get(group, {})
+
+    def dataset_names(self):
+        """(list) full names of every dataset in the tables"""
+        return list(self._store["index"]["datasets"].keys())
+
+    def _full_name(self, name):
+        name = name.strip("/")
+        return f"{self._group}/{name}" if self._group else name
+
+    def _array(self, full_name):
+        entry = self._store["index"]["datasets"][full_name]
+        table_files = self._store["table_files"]
+        if full_name not in table_files:
+            # the file stays open, later reads only map it again
+            f = open(os.path.join(self.tables, entry["file"]), "rb")
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            table_files[full_name] = (f, f.tell(), shape, fortran_order, dtype)
+        f, offset, shape, fortran_order, dtype = table_files[full_name]
+
+        if int(np.prod(shape)) == 0:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            # every read gets its own copy-on-write mapping, like every h5py read returns a new array
+            table_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            array = np.ndarray(shape, dtype=dtype, buffer=table_map, offset=offset,
+                               order="F" if fortran_order else "C")
+        array = array.view(LookupArray)
+        array.attrs = entry["attrs"]
+        return array
+
+    def __getitem__(self, name):
+        full_name = self._full_name(name)
+        if full_name in self._store["index"]["datasets"]:
+            return self._array(full_name)
+        if full_name in self.group_attrs:
+            return MemmapLookup(self.tables, full_name, _store=self._store)
+        raise KeyError(f"{name} is not in {self.filename}")
+
+    def __contains__(self, name):
+        full_name = self._full_name(name)
+        return (full_name in self._store["index"]["datasets"]) or (full_name in self.group_attrs)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        prefix = f"{self._group}/" if self._group else ""
+        names = list(self._store["index"]["datasets"].keys()) + [g for g in self.group_attrs if g]
+        children = []
+        for name in names:
+            if name.startswith(prefix) and ("/" not in name[len(prefix):]) and (name[len(prefix):] not in children):
+                children.append(name[len(prefix):])
+        return children
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def close(self):
+        """The tables stay open for the next user, see close_tables"""
+        pass
+
+    def close_tables(self):
+        for f, *_ in self._store["table_files"].values():
+            f.close()
+        self._store["table_files"].clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def main(action, h5_files, table_dir, **kwargs):
+    if action not in ["convert", "verify"]:
+        raise ValueError(f"{action} not in accepted actions ['convert', 'verify']")
+    failed = False
+    for h5_file in h5_files:
+        if action == "convert":
+            convert_lookup_tables(h5_file, table_dir)
+            continue
+        tables = find_lookup_tables(h5_file, table_dir)
+        if tables is None:
+            print(f"{h5_file} has not been converted in {table_dir}")
+            failed = True
+            continue
+        mismatches = verify_lookup_tables(h5_file, tables)
+        print(f"{h5_file}: {'matches' if not mismatches else 'MISMATCH'} {tables}")
+        for mismatch in mismatches:
+            print(f"  {mismatch}")
+        failed = failed or bool(mismatches)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
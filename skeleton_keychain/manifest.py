@@ -0,0 +1,121 @@
+import hashlib
+import json
+import time
+import os
+
+MANIFEST_FILE_NAME = "run_manifest.json"
+
+
+def file_fingerprint(file_path):
+    """
+    Cheap fingerprint of a file based on its size and modification time
+
+    :param file_path: (str): path to file
+    :return: (list) [size, mtime_ns] or None if the file does not exist
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def hash_parameters(params):
+    """
+    :param params: (dict): json serializable (or str-able) parameters
+    :return: (str) hex digest of the parameters
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def fingerprint_files(file_paths):
+    """
+    Combined fingerprint of a list of files (order independent), missing files are part of the fingerprint
+
+    :param file_paths: (list): paths to files, None entries are ignored
+    :return: (str) hex digest
+    """
+    file_paths = sorted(os.path.abspath(f) for f in file_paths if f is not None)
+    digest = hashlib.sha1()
+    for f in file_paths:
+        digest.update(f"{f}:{file_fingerprint(f)}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """
+    Record of what was submitted for each specimen (or group of specimens) and stage in an output directory. A stage
+    is considered current when its parameters and input fingerprints match what was recorded at submission and all of
+    its outputs were written after that submission, or for outputs restored from the swc cache, still have the
+    fingerprints recorded when they were restored.
+    """
+
+    def __init__(self, output_dir):
+        self.manifest_file = os.path.join(output_dir, MANIFEST_FILE_NAME)
+        self.entries = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                self.entries = json.load(f)["entries"]
+
+    def get_entry(self, stage, key):
+        return self.entries.get(stage, {}).get(str(key))
+
+    def is_current(self, stage, key, input_files, params, output_files):
+        """
+        :param stage: (str): pipeline stage name (e.g. file_gen)
+        :param key: (str): specimen id or other identifier within the stage
+        :param input_files: (list): files the stage reads
+        :param params: (dict): parameters that affect the stage's outputs
+        :param output_files: (list): files the stage writes
+        :return: (bool) True if the stage does not need to be run again
+        """
+        entry = self.get_entry(stage, key)
+        if entry is None:
+            return False
+
+        if entry["params_hash"] != hash_parameters(params):
+            return False
+
+        output_fingerprints = [file_fingerprint(f) for f in output_files]
+        if any(fp is None for fp in output_fingerprints):
+            return False
+        oldest_output_ns = min(fp[1] for fp in output_fingerprints)
+        if entry.get("output_fingerprints") is not None:
+            if output_fingerprints != entry["output_fingerprints"]:
+                return False
+        elif oldest_output_ns < entry["submitted_at_ns"]:
+            return False
+
+        if entry["inputs_fingerprint"] is not None:
+            return entry["inputs_fingerprint"] == fingerprint_files(input_files)
+
+        # inputs were still being generated upstream when this stage was submitted, so fall back to checking that
+        # none of them changed after the outputs were written
+        input_fingerprints = [file_fingerprint(f) for f in input_files if f is not None]
+        if any(fp is None for fp in input_fingerprints):
+            return False
+        return all(fp[1] <= oldest_output_ns for fp in input_fingerprints)
+
+    def record(self, stage, key, input_files, params, output_files, inputs_pending=False, outputs_restored=False):
+        """
+        Record that a stage was submitted
+
+        :param inputs_pending: (bool): True when the inputs are produced by upstream jobs submitted in the same run,
+        in which case they can not be fingerprinted yet
+        :param outputs_restored: (bool): True when the outputs were just put in place (e.g. linked from the swc cache)
+        instead of written by a job, they keep the modification time they were first written at and are checked
+        against their current fingerprints instead
+        """
+        self.entries.setdefault(stage, {})[str(key)] = {
+            "inputs_fingerprint": None if inputs_pending else fingerprint_files(input_files),
+            "params_hash": hash_parameters(params),
+            "outputs": [os.path.abspath(f) for f in output_files],
+            "output_fingerprints": [file_fingerprint(f) for f in output_files] if outputs_restored else None,
+            "submitted_at_ns": time.time_ns(),
+        }
+
+    def save(self):
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"entries": self.entries}, f)
+        os.replace(tmp_file, self.manifest_file)
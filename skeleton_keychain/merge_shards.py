@@ -0,0 +1,59 @@
+import os
+import shutil
+import argschema as ags
+
+
+class IO_Schema(ags.ArgSchema):
+    input_files = ags.fields.List(ags.fields.InputFile, cli_as_single_argument=True,
+                                  description="csv shards to merge, e.g. \"['shard_0.csv', 'shard_1.csv']\"")
+    output_file = ags.fields.OutputFile(description="merged csv")
+
+
+def merge_csv_files(input_files, output_file, buffer_size=16 * 1024 ** 2):
+    """
+    Concatenate csv files that share a header into one csv. Files are streamed in blocks so memory use does not grow
+    with the size of the shards, and the output is only moved into place once every shard was copied.
+
+    :param input_files: (list): csv files, all with the same header line
+    :param output_file: (str): merged csv
+    :param buffer_size: (int): bytes copied at a time
+    :return: None
+    """
+    if not input_files:
+        raise ValueError("No input files to merge")
+
+    tmp_file = output_file + ".tmp"
+    header = None
+    with open(tmp_file, "wb") as out_f:
+        for input_file in input_files:
+            with open(input_file, "rb") as in_f:
+                file_header = in_f.readline().rstrip(b"\r\n")
+                if header is None:
+                    header = file_header
+                    out_f.write(header + b"\n")
+                elif file_header != header:
+                    raise ValueError(f"Header of {input_file} does not match the header of {input_files[0]}")
+                data_start = in_f.tell()
+                shutil.copyfileobj(in_f, out_f, buffer_size)
+
+                # keep the next shard's first row off the last line of a shard without a trailing newline
+                if in_f.tell() > data_start:
+                    in_f.seek(-1, os.SEEK_END)
+                    if in_f.read(1) != b"\n":
+                        out_f.write(b"\n")
+    os.replace(tmp_file, output_file)
+    print(f"Merged {len(input_files)} files into {output_file}")
+
+
+def main(input_files, output_file, **kwargs):
+    merge_csv_files(input_files, output_file)
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
@@ -0,0 +1,176 @@
+import heapq
+import os
+import numpy as np
+
+
+def specimen_input_bytes(specimen_ids, swc_dir):
+    """
+    :param specimen_ids: (list): specimen ids
+    :param swc_dir: (str): directory with <specimen id>.swc files, or None
+    :return: (dict) specimen id -> size of its swc file in bytes, specimens without a file are left out
+    """
+    sizes = {}
+    if swc_dir is None:
+        return sizes
+    for sp_id in specimen_ids:
+        try:
+            sizes[str(sp_id)] = os.path.getsize(os.path.join(swc_dir, f"{sp_id}.swc"))
+        except OSError:
+            continue
+    return sizes
+
+
+def specimen_runtimes(history, stage):
+    """
+    :param history: (list): see resource_model.load_job_history
+    :param stage: (str): stage name
+    :return: (dict) specimen id -> longest completed run time in seconds of a single specimen job of the stage
+    """
+    runtimes = {}
+    for record in history:
+        if (record["stage"] == stage) and (len(record.get("specimen_ids", [])) == 1):
+            sp_id = str(record["specimen_ids"][0])
+            runtimes[sp_id] = max(runtimes.get(sp_id, 0.0), record["elapsed_s"])
+    return runtimes
+
+
+def stage_time_model(resource_model, stage):
+    """
+    :return: (float) seconds per job, (float) seconds per input byte of the stage's fitted run time, or None when
+    the resource model has no size based model for the stage
+    """
+    if (resource_model is None) or ((stage, "input_bytes") not in resource_model.models):
+        return None
+    fit = resource_model.models[(stage, "input_bytes")]["elapsed_s"]
+    if fit["slope"] <= 0:
+        return None
+    return fit["intercept"], fit["slope"]
+
+
+def estimate_specimen_costs(specimen_ids, input_bytes, time_model=None, runtimes=None):
+    """
+    Estimate how long each specimen takes in a stage. Historic run times of the specimen are used where there are
+    any, otherwise its swc size is converted to seconds with the stage's fitted run time (or the median seconds per
+    byte of the specimens with history). Without either the costs are swc sizes, which only order and balance
+    specimens. Specimens with no estimate get the median of the others
+
+    :param specimen_ids: (list): specimen ids
+    :param input_bytes: (dict): specimen id -> swc size, see specimen_input_bytes
+    :param time_model: (tuple): see stage_time_model
+    :param runtimes: (dict): specimen id -> seconds, see specimen_runtimes
+    :return: (dict) specimen id -> cost and (str) the unit of the costs (s or bytes), or None, None when nothing is
+    known about any specimen
+    """
+    specimen_ids = [str(sp_id) for sp_id in specimen_ids]
+    runtimes = runtimes or {}
+    seconds_per_byte = None
+    if time_model is not None:
+        # the fitted run time includes the start up of a job, which is not part of the specimen's cost
+        runtimes = {sp_id: max(runtime - time_model[0], 0.0) for sp_id, runtime in runtimes.items()}
+        seconds_per_byte = time_model[1]
+    else:
+        ratios = [runtimes[sp_id] / input_bytes[sp_id] for sp_id in specimen_ids
+                  if (sp_id in runtimes) and input_bytes.get(sp_id)]
+        if ratios:
+            seconds_per_byte = float(np.median(ratios))
+
+    costs = {}
+    if (seconds_per_byte is not None) or runtimes:
+        unit = "s"
+        for sp_id in specimen_ids:
+            if sp_id in runtimes:
+                costs[sp_id] = float(runtimes[sp_id])
+            elif (seconds_per_byte is not None) and (sp_id in input_bytes):
+                costs[sp_id] = input_bytes[sp_id] * seconds_per_byte
+    else:
+        unit = "bytes"
+        costs = {sp_id: float(input_bytes[sp_id]) for sp_id in specimen_ids if sp_id in input_bytes}
+    if not costs:
+        return None, None
+
+    default_cost = float(np.median(list(costs.values())))
+    return {sp_id: costs.get(sp_id, default_cost) for sp_id in specimen_ids}, unit
+
+
+def largest_first(specimen_ids, costs):
+    """
+    :return: (list) specimen ids by decreasing cost, specimens with equal cost keep their order
+    """
+    return sorted(specimen_ids, key=lambda sp_id: -costs[str(sp_id)])
+
+
+def pack_specimens(specimen_ids, costs, n_bins):
+    """
+    Greedy longest processing time first packing: every specimen, largest first, goes to the bin with the smallest
+    total cost so far. The largest bin is at most 4/3 of the best possible packing
+
+    :param specimen_ids: (list): specimen ids
+    :param costs: (dict): specimen id -> cost
+    :param n_bins: (int): number of bins (jobs or shards)
+    :return: (list) of lists of specimen ids, bins by decreasing total cost and specimens within a bin in their input
+    order. Empty bins are left out
+    """
+    n_bins = max(1, min(n_bins, len(specimen_ids)))
+    bins = [[] for _ in range(n_bins)]
+    loads = [(0.0, bin_idx) for bin_idx in range(n_bins)]
+    for sp_id in largest_first(specimen_ids, costs):
+        load, bin_idx = heapq.heappop(loads)
+        bins[bin_idx].append(sp_id)
+        heapq.heappush(loads, (load + costs[str(sp_id)], bin_idx))
+    input_order = {str(sp_id): idx for idx, sp_id in enumerate(specimen_ids)}
+    bins = [sorted(b, key=lambda sp_id: input_order[str(sp_id)]) for b in bins]
+    bin_costs = [sum(costs[str(sp_id)] for sp_id in b) for b in bins]
+    order = sorted(range(n_bins), key=lambda bin_idx: -bin_costs[bin_idx])
+    return [bins[bin_idx] for bin_idx in order if bins[bin_idx]]
+
+
+def predicted_makespan(unit_costs, concurrency=None):
+    """
+    Time from the first to the last job of a stage when jobs start in the given order as soon as one of concurrency
+    slots is free, queue waits are not included
+
+    :param unit_costs: (list): predicted run time of each job, in submission order
+    :param concurrency: (int): number of jobs that run at once, None for all of them
+    :return: (float)
+    """
+    if not unit_costs:
+        return 0.0
+    if (concurrency is None) or (concurrency >= len(unit_costs)):
+        return float(max(unit_costs))
+    slots = [0.0] * concurrency
+    for cost in unit_costs:
+        heapq.heappush(slots, heapq.heappop(slots) + cost)
+    return float(max(slots))
+
+
+def schedule_plan(stage, units, costs, unit, job_overhead_s=0.0, concurrency=None):
+    """
+    Summary of how a stage's specimens were spread over its jobs, recorded with the run so run_status can compare the
+    predicted makespan with the actual one
+
+    :param units: (list): specimen ids of each job (or array task), in submission order
+    :param costs: (dict): specimen id -> cost, see estimate_specimen_costs
+    :param unit: (str): unit of the costs, a makespan is only predicted for costs in seconds
+    :param job_overhead_s: (float): run time of a job on top of its specimens' costs
+    :param concurrency: (int): see predicted_makespan
+    :return: (dict) with keys stage, cost_unit, n_units, max_unit_cost, mean_unit_cost and predicted_makespan_s
+    """
+    unit_costs = [job_overhead_s + sum(costs[str(sp_id)] for sp_id in unit_specimen_ids)
+                  for unit_specimen_ids in units]
+    makespan = predicted_makespan(unit_costs, concurrency) if unit == "s" else None
+    return {
+        "stage": stage,
+        "cost_unit": unit,
+        "n_units": len(units),
+        "max_unit_cost": float(max(unit_costs)) if unit_costs else None,
+        "mean_unit_cost": float(np.mean(unit_costs)) if unit_costs else None,
+        "predicted_makespan_s": makespan,
+    }
+
+
+def print_plan(plan):
+    balance = "-" if not plan["mean_unit_cost"] else f"{plan['max_unit_cost'] / plan['mean_unit_cost']:.2f}"
+    makespan = "" if plan["predicted_makespan_s"] is None else \
+        f", predicted makespan {plan['predicted_makespan_s'] / 60:.1f} min"
+    print(f"Size aware {plan['stage']}: {plan['n_units']} jobs largest first, largest/mean job cost {balance}"
+          f"{makespan}")
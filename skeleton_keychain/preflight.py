@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import os
+import argschema as ags
+import numpy as np
+
+PREFLIGHT_REPORT_FILE_NAME = "preflight_report.txt"
+PREFLIGHT_ACTIONS = ["abort", "exclude", "off"]
+
+# header lines of an swc file are scanned up to this many bytes for the first node
+MAX_SWC_HEADER_BYTES = 1024 ** 2
+PREFLIGHT_BATCH_SIZE = 64
+
+
+class IO_Schema(ags.ArgSchema):
+    specimen_id_file = ags.fields.InputFile(description="txt file with the specimen ids to check")
+    raw_orientation_swc_dir = ags.fields.Str(default=None, allow_none=True,
+                                             description="directory expected to hold <specimen id>.swc")
+    polygon_json_dir = ags.fields.Str(default=None, allow_none=True,
+                                      description="directory expected to hold <specimen id>.json")
+    aligned_swc_dir = ags.fields.Str(default=None, allow_none=True,
+                                     description="directory expected to hold <specimen id>.swc")
+    upright_swc_dir = ags.fields.Str(default=None, allow_none=True,
+                                     description="directory expected to hold <specimen id>.swc")
+    layer_depths_file = ags.fields.Str(default=None, allow_none=True, description="json that has to parse")
+    check_contents = ags.fields.Boolean(default=True,
+                                        description="If false, only check the files exist and are not empty")
+    n_workers = ags.fields.Int(default=32, description="number of files read at once")
+    report_file = ags.fields.OutputFile(default=None, allow_none=True,
+                                        description="tab separated per specimen report to write")
+
+
+class DirectoryIndex:
+    """
+    Names and sizes of the files in a directory, read with a single scandir pass so checking thousands of specimens
+    does not stat every expected path on a network filesystem
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError(f"Input directory {directory} does not exist")
+        self.directory = directory
+        self.files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self.files[entry.name] = entry
+
+    def __len__(self):
+        return len(self.files)
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def size(self, file_name):
+        """(int) file size or None when the file is not in the directory"""
+        entry = self.files.get(file_name)
+        if entry is None:
+            return None
+        return entry.stat().st_size
+
+
+def check_swc_header(swc_file):
+    """
+    Check the first node line of an swc file: seven columns of id, type, x, y, z, radius and parent id
+
+    :return: (str) problem or None
+    """
+    n_bytes = 0
+    with open(swc_file, "rb") as f:
+        for line in f:
+            n_bytes += len(line)
+            line = line.strip()
+            if (not line) or line.startswith(b"#"):
+                if n_bytes > MAX_SWC_HEADER_BYTES:
+                    return f"no node line in the first {MAX_SWC_HEADER_BYTES} bytes"
+                continue
+            columns = line.split()
+            if len(columns) < 7:
+                return f"first node line has {len(columns)} columns, expected 7"
+            try:
+                int(columns[0])
+                [float(c) for c in columns[1:6]]
+                int(columns[6])
+            except ValueError:
+                return f"first node line is not numeric: {line[:80].decode(errors='replace')}"
+            return None
+    return "no node lines"
+
+
+def check_json(json_file):
+    """:return: (str) problem or None"""
+    try:
+        with open(json_file, "r") as f:
+            json.load(f)
+    except ValueError as e:
+        return f"invalid json ({e})"
+    return None
+
+
+CONTENT_CHECKS = {"swc": check_swc_header, "json": check_json}
+
+
+def _check_file(directory_index, file_name, kind, check_contents):
+    """:return: (str) problem or None"""
+    size = directory_index.size(file_name)
+    if size is None:
+        return f"missing {directory_index.path(file_name)}"
+    if size == 0:
+        return f"empty {directory_index.path(file_name)}"
+    if not check_contents:
+        return None
+    try:
+        problem = CONTENT_CHECKS[kind](directory_index.path(file_name))
+    except OSError as e:
+        problem = f"unreadable ({e})"
+    if problem is not None:
+        return f"{directory_index.path(file_name)}: {problem}"
+    return None
+
+
+def preflight_specimens(specimen_ids, required_inputs, check_contents=True, n_workers=32):
+    """
+    Check every specimen has its input files before any job is submitted
+
+    :param specimen_ids: (list): specimen ids
+    :param required_inputs: (list): (directory, file suffix, kind) tuples, every specimen needs
+    directory/<specimen id><suffix>. kind (swc or json) selects the content check
+    :param check_contents: (bool): if false only check the files exist and are not empty
+    :param n_workers: (int): number of files read at once
+    :return: (dict) specimen id -> list of problems, empty for specimens whose inputs are fine
+    """
+    specimen_ids = [str(sp_id) for sp_id in specimen_ids]
+    indexes = [(DirectoryIndex(directory), suffix, kind) for directory, suffix, kind in required_inputs]
+
+    def check_batch(batch_specimen_ids):
+        batch_problems = {}
+        for sp_id in batch_specimen_ids:
+            sp_problems = [_check_file(directory_index, f"{sp_id}{suffix}", kind, check_contents)
+                           for directory_index, suffix, kind in indexes]
+            batch_problems[sp_id] = [p for p in sp_problems if p is not None]
+        return batch_problems
+
+    # specimens are checked in batches, one future per file costs more than checking a small local file
+    problems = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        batches = [specimen_ids[i:i + PREFLIGHT_BATCH_SIZE] for i in range(0, len(specimen_ids), PREFLIGHT_BATCH_SIZE)]
+        for batch_problems in pool.map(check_batch, batches):
+            problems.update(batch_problems)
+    return problems
+
+
+def check_shared_inputs(shared_files):
+    """
+    :param shared_files: (dict): description -> file (None entries are skipped), json files have to parse
+    :return: None
+    """
+    for description, shared_file in shared_files.items():
+        if shared_file is None:
+            continue
+        if not os.path.isfile(shared_file):
+            raise ValueError(f"{description} {shared_file} does not exist")
+        if shared_file.endswith(".json"):
+            problem = check_json(shared_file)
+            if problem is not None:
+                raise ValueError(f"{description} {shared_file}: {problem}")
+
+
+def write_preflight_report(report_file, problems):
+    with open(report_file, "w") as f:
+        f.write("specimen_id\tstatus\tproblems\n")
+        for sp_id, sp_problems in problems.items():
+            f.write(f"{sp_id}\t{'failed' if sp_problems else 'ok'}\t{'; '.join(sp_problems)}\n")
+
+
+def run_preflight(specimen_ids, required_inputs, shared_files=None, action="abort", report_file=None,
+                  check_contents=True, n_workers=32):
+    """
+    Check the shared and per specimen inputs of a run, print a summary and write the per specimen report
+
+    :param action: (str): abort raises a ValueError when any specimen failed, exclude leaves failed specimens out
+    :return: (list) specimen ids that passed, in their original order
+    """
+    if action not in PREFLIGHT_ACTIONS:
+        raise ValueError(f"{action} not in accepted preflight actions {PREFLIGHT_ACTIONS}")
+    specimen_ids = [str(sp_id) for sp_id in specimen_ids]
+    if action == "off":
+        return specimen_ids
+
+    start_time = time.time()
+    check_shared_inputs(shared_files or {})
+    problems = preflight_specimens(specimen_ids, required_inputs, check_contents=check_contents,
+                                   n_workers=n_workers)
+    failed = {sp_id: sp_problems for sp_id, sp_problems in problems.items() if sp_problems}
+    print(f"Preflight: {len(specimen_ids) - len(failed)} of {len(specimen_ids)} specimens have valid inputs "
+          f"({time.time() - start_time:.1f}s)")
+    if report_file is not None:
+        write_preflight_report(report_file, problems)
+    for sp_id, sp_problems in list(failed.items())[:20]:
+        print(f"  {sp_id}: {'; '.join(sp_problems)}")
+    if len(failed) > 20:
+        print(f"  ... and {len(failed) - 20} more" + ("" if report_file is None else f", see {report_file}"))
+
+    if failed and (action == "abort"):
+        raise ValueError(f"{len(failed)} specimens have missing or invalid inputs, nothing was submitted. Fix them "
+                         f"or rerun with --preflight exclude to leave them out")
+    if failed:
+        print(f"Excluding {len(failed)} specimens with missing or invalid inputs")
+    return [sp_id for sp_id in specimen_ids if sp_id not in failed]
+
+
+def main(specimen_id_file, raw_orientation_swc_dir, polygon_json_dir, aligned_swc_dir, upright_swc_dir,
+         layer_depths_file, check_contents, n_workers, report_file, **kwargs):
+    specimen_ids = np.loadtxt(specimen_id_file, dtype=str, ndmin=1)
+    required_inputs = [(directory, suffix, kind) for directory, suffix, kind in [
+        (raw_orientation_swc_dir, ".swc", "swc"),
+        (polygon_json_dir, ".json", "json"),
+        (aligned_swc_dir, ".swc", "swc"),
+        (upright_swc_dir, ".swc", "swc"),
+    ] if directory is not None]
+    run_preflight(specimen_ids, required_inputs, shared_files={"layer_depths_file": layer_depths_file},
+                  action="abort", report_file=report_file, check_contents=check_contents, n_workers=n_workers)
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
@@ -0,0 +1,174 @@
+import sys
+import time
+import traceback
+from importlib.metadata import entry_points
+import argschema as ags
+import numpy as np
+from skeleton_keychain.file_generation import file_gen_command_args
+from skeleton_keychain.swc_cache import SwcCache, store_generated_files
+
+
+class IO_Schema(ags.ArgSchema):
+    specimen_id_file = ags.fields.InputFile(description="txt file with the specimen ids in this chunk")
+    swc_sidecars = ags.fields.Boolean(default=False,
+                                      description="If true, also write binary sidecars (.swc.npy) of the upright "
+                                                  "and layer-aligned swc files")
+    upright_swc_dir = ags.fields.Str(description="Directory to write upright swc files to")
+    aligned_swc_dir = ags.fields.Str(description="Directory to write layer-aligned swc files to")
+    qc_image_dir = ags.fields.Str(description="Directory to write qc images to")
+    raw_orientation_swc_dir = ags.fields.Str(default=None, allow_none=True, description="Raw Orientation Directory")
+    polygon_json_dir = ags.fields.Str(default=None, allow_none=True, description="Layers polygon directory")
+    layer_depths_file = ags.fields.Str(default=None, allow_none=True,
+                                       description="Json with average cortical layer depths")
+    surface_paths_file = ags.fields.Str(default=None, allow_none=True,
+                                        description="Surface paths (streamlines) HDF5 file for slice angle calculation")
+    closest_surface_voxel_file = ags.fields.Str(default=None, allow_none=True,
+                                                description="Closest surface voxel reference HDF5 file for slice "
+                                                            "angle calculation")
+    shrinkage_correction = ags.fields.Boolean(description="If true, correct for shrinkage")
+    slice_angle_tilt_correction = ags.fields.Boolean(description="If true, correct for slice angle tilt")
+    layer_list = ags.fields.Str(default="None", description="layer list passed to skelekeys-layer-aligned-swc")
+    align_morph_to_layer_drawings = ags.fields.Bool(default=None, allow_none=True,
+                                                    description="see skeleton_keys.layer_aligned_swc")
+    failure_log_file = ags.fields.Str(default=None, allow_none=True,
+                                      description="File to append specimen ids (and the error) that failed to")
+    swc_cache_dir = ags.fields.Str(default=None, allow_none=True,
+                                   description="swc cache to add the generated files of successful specimens to")
+    swc_cache_key_file = ags.fields.Str(default=None, allow_none=True,
+                                        description="specimen id to cache key file written by run_features")
+    max_swc_cache_gb = ags.fields.Float(default=None, allow_none=True,
+                                        description="least recently used cache entries are evicted beyond this size")
+
+
+_console_scripts = {}
+
+
+def load_console_script(script_name):
+    """
+    Import the function behind an installed console script, imports only happen the first time a script is loaded
+
+    :param script_name: (str): console script name, e.g. skelekeys-upright-corrected-swc
+    :return: callable
+    """
+    if script_name not in _console_scripts:
+        eps = entry_points()
+        if hasattr(eps, "select"):
+            matches = list(eps.select(group="console_scripts", name=script_name))
+        else:
+            matches = [ep for ep in eps.get("console_scripts", []) if ep.name == script_name]
+        if not matches:
+            raise ValueError(f"Could not find an installed console script named {script_name}")
+        _console_scripts[script_name] = matches[0].load()
+    return _console_scripts[script_name]
+
+
+def run_console_script(script_name, argv):
+    """
+    Run an (argschema based) console script in this python process as if it was called from the shell
+
+    :param script_name: (str): console script name
+    :param argv: (list): command line arguments, see file_generation.command_argv
+    :return: None
+    """
+    script_function = load_console_script(script_name)
+    original_argv = sys.argv
+    sys.argv = [script_name] + list(argv)
+    try:
+        script_function()
+    except SystemExit as e:
+        if e.code not in [None, 0]:
+            raise RuntimeError(f"{script_name} exited with code {e.code}")
+    finally:
+        sys.argv = original_argv
+
+
+def main(specimen_id_file,
+         upright_swc_dir,
+         aligned_swc_dir,
+         qc_image_dir,
+         raw_orientation_swc_dir,
+         polygon_json_dir,
+         layer_depths_file,
+         surface_paths_file,
+         closest_surface_voxel_file,
+         shrinkage_correction,
+         slice_angle_tilt_correction,
+         layer_list,
+         align_morph_to_layer_drawings,
+         failure_log_file,
+         swc_cache_dir=None,
+         swc_cache_key_file=None,
+         max_swc_cache_gb=None,
+         swc_sidecars=False,
+         **kwargs):
+    """
+    Generate layer-aligned, upright and qc image files for every specimen in a chunk within a single python process,
+    so environment activation and imports are paid once per chunk instead of once per specimen and command. A failing
+    specimen is logged and skipped, the remaining specimens are still processed. With an swc cache, the files of every
+    successful specimen are added to it.
+    """
+    file_gen_kwargs = {
+        "upright_swc_dir": upright_swc_dir,
+        "aligned_swc_dir": aligned_swc_dir,
+        "qc_image_dir": qc_image_dir,
+        "raw_orientation_swc_dir": raw_orientation_swc_dir,
+        "polygon_json_dir": polygon_json_dir,
+        "layer_depths_file": layer_depths_file,
+        "surface_paths_file": surface_paths_file,
+        "closest_surface_voxel_file": closest_surface_voxel_file,
+        "shrinkage_correction": shrinkage_correction,
+        "slice_angle_tilt_correction": slice_angle_tilt_correction,
+        "layer_list": layer_list,
+        "align_morph_to_layer_drawings": align_morph_to_layer_drawings,
+    }
+
+    specimen_ids = [str(sp_id) for sp_id in np.loadtxt(specimen_id_file, dtype=str, ndmin=1)]
+    print("Number of Specimens in chunk: {}".format(len(specimen_ids)))
+
+    swc_cache = None
+    if (swc_cache_dir is not None) and (swc_cache_key_file is not None):
+        swc_cache = SwcCache(swc_cache_dir,
+                             max_bytes=None if max_swc_cache_gb is None else int(max_swc_cache_gb * 1024 ** 3))
+
+    failed_specimen_ids = []
+    for sp_id in specimen_ids:
+        start_time = time.time()
+        print(f"Specimen ID: {sp_id}")
+        try:
+            for script_name, argv in file_gen_command_args(sp_id, swc_sidecars=swc_sidecars, **file_gen_kwargs):
+                run_console_script(script_name, argv)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"FAILED {sp_id} after {time.time() - start_time:.1f}s")
+            failed_specimen_ids.append(sp_id)
+            if failure_log_file is not None:
+                with open(failure_log_file, "a") as f:
+                    f.write(f"{sp_id}\t{type(e).__name__}: {e}\n")
+        else:
+            print(f"Finished {sp_id} in {time.time() - start_time:.1f}s")
+            if swc_cache is not None:
+                try:
+                    store_generated_files(swc_cache, swc_cache_key_file, [sp_id], upright_swc_dir, aligned_swc_dir,
+                                          qc_image_dir)
+                except Exception:
+                    # a specimen that could not be cached was still generated
+                    traceback.print_exc()
+                    print(f"Could not add {sp_id} to the swc cache")
+
+    if swc_cache is not None:
+        swc_cache.close()
+
+    print(f"{len(specimen_ids) - len(failed_specimen_ids)} of {len(specimen_ids)} specimens succeeded")
+    if failed_specimen_ids:
+        print(f"Failed specimens: {failed_specimen_ids}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
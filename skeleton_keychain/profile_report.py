@@ -0,0 +1,239 @@
+from collections import defaultdict
+import json
+import time
+import os
+import argschema as ags
+from skeleton_keychain.job_tracking import JobDatabase, JOB_DATABASE_FILE_NAME
+from skeleton_keychain.profiling import PROFILE_RECORD_SUFFIX
+
+PROFILE_REPORT_FILE_NAME = "profile_report.json"
+
+# self time in functions whose file path contains one of these fragments is summed per category, so the report shows
+# whether parsing, HDF5 lookups or plotting dominates a stage
+HOT_SPOT_CATEGORIES = {
+    "hdf5 lookups": ["h5py", "lookup_tables.py"],
+    "swc parsing": ["swc_io", "swc_arrays.py", "npyio", "_load_from_filelike"],
+    "plotting": ["matplotlib", "PIL", "quality_control_swc_files.py", "visuals"],
+    "database queries": ["psycopg2", "database_queries"],
+}
+
+
+class IO_Schema(ags.ArgSchema):
+    output_dir = ags.fields.InputDir(description="run_features output directory, profile records are collected from "
+                                                 "every directory below output_dir/JobFiles")
+    top_n = ags.fields.Int(default=10, description="number of slowest jobs, memory peaks and functions per stage")
+    report_file = ags.fields.Str(default=None, allow_none=True,
+                                 description="Where to write the json report, defaults to "
+                                             "output_dir/profile_report.json")
+
+
+def find_profile_records(job_dir):
+    """:return: (list) profile record dicts written by profile_command anywhere below job_dir"""
+    records = []
+    for dirpath, _, file_names in os.walk(job_dir):
+        for file_name in file_names:
+            if file_name.endswith(PROFILE_RECORD_SUFFIX):
+                with open(os.path.join(dirpath, file_name), "r") as f:
+                    records.append(json.load(f))
+    return records
+
+
+def job_specimen_index(output_dir):
+    """:return: (dict) (job id, task id) -> specimen ids, for every job recorded in the run database"""
+    index = {}
+    if not os.path.exists(os.path.join(output_dir, JOB_DATABASE_FILE_NAME)):
+        return index
+    job_db = JobDatabase(output_dir)
+    latest_run_id = job_db.latest_run_id() or 0
+    for run_id in range(1, latest_run_id + 1):
+        for job in job_db.get_jobs(run_id):
+            # array tasks are looked up by their task id, other jobs have none
+            for task_idx, specimen_ids in enumerate(job["task_specimen_ids"]):
+                index[(job["job_id"], str(task_idx))] = specimen_ids
+            index[(job["job_id"], None)] = [sp_id for task in job["task_specimen_ids"] for sp_id in task]
+    job_db.close()
+    return index
+
+
+def categorize(file_name):
+    for category, fragments in HOT_SPOT_CATEGORIES.items():
+        if any(fragment in file_name for fragment in fragments):
+            return category
+    return "other"
+
+
+def _short_path(file_name):
+    return "/".join(file_name.replace("\\", "/").split("/")[-2:])
+
+
+def cprofile_hot_spots(profile_files, top_n):
+    """
+    Combine pstats files into the functions with the most self time
+
+    :return: (dict) with keys categories (category -> fraction of self time) and functions
+    """
+    import pstats
+    stats = pstats.Stats(profile_files[0])
+    for profile_file in profile_files[1:]:
+        stats.add(profile_file)
+    entries = [(file_name, line, function, tt, ct) for (file_name, line, function), (_, _, tt, ct, _)
+               in stats.stats.items()]
+    total_self_s = sum(entry[3] for entry in entries) or 1.0
+    categories = defaultdict(float)
+    for file_name, _, function, tt, _ in entries:
+        # built-in functions have no file, their names carry the module (e.g. numpy._core...)
+        categories[categorize(f"{file_name} {function}")] += tt / total_self_s
+    functions = [{"function": f"{function} ({_short_path(file_name)}:{line})", "self_s": tt,
+                  "self_fraction": tt / total_self_s, "cumulative_s": ct}
+                 for file_name, line, function, tt, ct in sorted(entries, key=lambda e: e[3], reverse=True)[:top_n]]
+    return {"source": "cprofile", "profiles": len(profile_files), "categories": dict(categories),
+            "functions": functions}
+
+
+def py_spy_hot_spots(profile_files, top_n):
+    """
+    Combine py-spy raw (collapsed stack) files into the functions sampled most often at the top of the stack
+
+    :return: (dict) with keys categories (category -> fraction of samples) and functions
+    """
+    self_samples = defaultdict(int)
+    total_samples = defaultdict(int)
+    n_samples = 0
+    for profile_file in profile_files:
+        with open(profile_file, "r") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if not stack or not count.isdigit():
+                    continue
+                count = int(count)
+                frames = stack.split(";")
+                n_samples += count
+                self_samples[frames[-1]] += count
+                for frame in set(frames):
+                    total_samples[frame] += count
+    n_samples = n_samples or 1
+    categories = defaultdict(float)
+    for frame, count in self_samples.items():
+        categories[categorize(frame)] += count / n_samples
+    functions = [{"function": frame, "self_samples": count, "self_fraction": count / n_samples,
+                  "total_fraction": total_samples[frame] / n_samples}
+                 for frame, count in sorted(self_samples.items(), key=lambda item: item[1], reverse=True)[:top_n]]
+    return {"source": "py-spy", "profiles": len(profile_files), "categories": dict(categories),
+            "functions": functions}
+
+
+def summarize_profiles(records, specimen_index, top_n=10):
+    """
+    Per stage totals, per program breakdown, slowest jobs, memory peaks and hot spots of profile records
+
+    :return: (dict) json serializable report
+    """
+    by_stage = defaultdict(list)
+    for record in records:
+        by_stage[record["stage"]].append(record)
+
+    stages = {}
+    for stage_name, stage_records in sorted(by_stage.items()):
+        for record in stage_records:
+            record["cpu_s"] = record["user_s"] + record["system_s"]
+            record["specimen_ids"] = specimen_index.get((record["job_id"], record["task_id"]))
+        programs = defaultdict(list)
+        for record in stage_records:
+            programs[record["program"]].append(record)
+
+        def job_summary(record):
+            return {k: record[k] for k in ["program", "wall_s", "cpu_s", "max_rss_mb", "return_code", "job_id",
+                                           "task_id", "specimen_ids", "host"]}
+
+        wall_s = [r["wall_s"] for r in stage_records]
+        stage = {
+            "commands": len(stage_records),
+            "failed": sum(1 for r in stage_records if r["return_code"] != 0),
+            "wall_s_total": float(sum(wall_s)),
+            "cpu_s_total": float(sum(r["cpu_s"] for r in stage_records)),
+            "mean_wall_s": float(sum(wall_s) / len(wall_s)),
+            "max_wall_s": max(wall_s),
+            "max_rss_mb": max(r["max_rss_mb"] for r in stage_records),
+            "programs": {program: {"commands": len(program_records),
+                                   "wall_s_total": float(sum(r["wall_s"] for r in program_records)),
+                                   "mean_wall_s": float(sum(r["wall_s"] for r in program_records) /
+                                                        len(program_records)),
+                                   "max_rss_mb": max(r["max_rss_mb"] for r in program_records)}
+                         for program, program_records in sorted(programs.items())},
+            "slowest": [job_summary(r) for r in sorted(stage_records, key=lambda r: r["wall_s"], reverse=True)[:top_n]],
+            "memory_peaks": [job_summary(r) for r in
+                             sorted(stage_records, key=lambda r: r["max_rss_mb"], reverse=True)[:top_n]],
+            "hot_spots": [],
+        }
+        for mode, hot_spots in [("cprofile", cprofile_hot_spots), ("py-spy", py_spy_hot_spots)]:
+            profile_files = [r["profile_file"] for r in stage_records
+                             if (r["mode"] == mode) and r["profile_file"] and os.path.exists(r["profile_file"])]
+            if profile_files:
+                stage["hot_spots"].append(hot_spots(profile_files, top_n))
+        stages[stage_name] = stage
+
+    return {"generated_at": time.time(), "n_records": len(records), "stages": stages}
+
+
+def _format_specimens(specimen_ids):
+    if not specimen_ids:
+        return "-"
+    if len(specimen_ids) <= 3:
+        return ",".join(specimen_ids)
+    return f"{','.join(specimen_ids[:3])},... ({len(specimen_ids)})"
+
+
+def print_report(report, n_rows=5):
+    print(f"{report['n_records']} profiled commands")
+    for stage_name, stage in report["stages"].items():
+        print(f"\n{stage_name}: {stage['commands']} commands, {stage['failed']} failed, "
+              f"wall {stage['wall_s_total']:.0f}s total / {stage['mean_wall_s']:.1f}s mean / "
+              f"{stage['max_wall_s']:.1f}s max, cpu {stage['cpu_s_total']:.0f}s, max rss {stage['max_rss_mb']:.0f} MB")
+        for program, program_summary in stage["programs"].items():
+            print(f"  {program:<32}{program_summary['commands']:>6} x {program_summary['mean_wall_s']:>8.1f}s"
+                  f"{program_summary['max_rss_mb']:>10.0f} MB")
+        print("  slowest:")
+        for job in stage["slowest"][:n_rows]:
+            print(f"    {job['wall_s']:>8.1f}s {job['max_rss_mb']:>8.0f} MB  {job['program']} job {job['job_id']}"
+                  f"{'' if job['task_id'] is None else '_' + job['task_id']} specimens "
+                  f"{_format_specimens(job['specimen_ids'])}")
+        print("  memory peaks:")
+        for job in stage["memory_peaks"][:n_rows]:
+            print(f"    {job['max_rss_mb']:>8.0f} MB {job['wall_s']:>8.1f}s  {job['program']} job {job['job_id']}"
+                  f"{'' if job['task_id'] is None else '_' + job['task_id']} specimens "
+                  f"{_format_specimens(job['specimen_ids'])}")
+        for hot_spots in stage["hot_spots"]:
+            categories = ", ".join(f"{category} {fraction:.0%}" for category, fraction in
+                                   sorted(hot_spots["categories"].items(), key=lambda item: item[1], reverse=True))
+            print(f"  hot spots ({hot_spots['source']}, {hot_spots['profiles']} profiles): {categories}")
+            for function in hot_spots["functions"][:n_rows]:
+                print(f"    {function['self_fraction']:>6.1%}  {function['function']}")
+
+
+def main(output_dir, top_n, report_file, **kwargs):
+    """
+    Aggregate the records profile_command wrote for a run_features run (see --profile) into a per stage report of
+    the slowest jobs, memory peaks and the functions that take the most time
+    """
+    records = find_profile_records(os.path.join(output_dir, "JobFiles"))
+    if not records:
+        raise ValueError(f"No profile records below {os.path.join(output_dir, 'JobFiles')}, run run_features with "
+                         f"--profile time, cprofile or py-spy")
+    report = summarize_profiles(records, job_specimen_index(output_dir), top_n=top_n)
+    print_report(report)
+
+    if report_file is None:
+        report_file = os.path.join(output_dir, PROFILE_REPORT_FILE_NAME)
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {report_file}")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
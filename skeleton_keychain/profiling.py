@@ -0,0 +1,205 @@
+import subprocess
+import argparse
+import shutil
+import socket
+import shlex
+import json
+import time
+import sys
+import os
+
+PROFILE_MODES = ["off", "time", "cprofile", "py-spy"]
+PROFILE_DIR_NAME = "Profiles"
+PROFILE_RECORD_SUFFIX = ".profile.json"
+PY_SPY_RATE = 100
+
+# lines of a job file that set up the shell rather than run a program, these are not measured
+SHELL_SETUP_COMMANDS = ["source", "conda", "cd", "echo", "export", "set", "module"]
+
+
+def _is_profilable(command):
+    tokens = command.split(maxsplit=1)
+    if not tokens:
+        return False
+    program = tokens[0]
+    # variable assignments (SPECIMEN_ID=$(sed ...)) and shell syntax are left alone
+    return (program not in SHELL_SETUP_COMMANDS) and ("=" not in program) and program.replace("-", "_").replace(
+        ".", "_").replace("/", "_").isidentifier()
+
+
+def profile_job_commands(commands, mode, profile_dir, stage):
+    """
+    Wrap the program lines of a job file with profile_command so each one records its wall time, cpu time and peak
+    memory (and with mode cprofile or py-spy a profile of the python process) in profile_dir
+
+    :param commands: (list): job file command lines
+    :param mode: (str): one of PROFILE_MODES
+    :param profile_dir: (str): where records are written, see profile_report
+    :param stage: (str): stage the records are grouped by
+    :return: (list) command lines
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"{mode} not in accepted profile modes {PROFILE_MODES}")
+    if mode == "off":
+        return list(commands)
+    prefix = f"profile_command --mode {mode} --stage {stage} --profile_dir {profile_dir} --"
+    return [f"{prefix} {command}" if _is_profilable(command) else command for command in commands]
+
+
+def _python_script(program):
+    """:return: (str) path of a console script that runs with python, or None"""
+    script = shutil.which(program)
+    if script is None:
+        return None
+    try:
+        with open(script, "rb") as f:
+            first_line = f.readline()
+    except OSError:
+        return None
+    if first_line.startswith(b"#!") and b"python" in first_line:
+        return script
+    return None
+
+
+def run_profiled_script():
+    """
+    Entry point of the child process that runs a console script in-process: python -c <this> <mode> <out file>
+    <script> [args]. With mode cprofile out file gets the pstats of the script, with mode py-spy (which samples this
+    process from outside) it gets the exit code, which py-spy does not pass on
+    """
+    import runpy
+    mode, out_file, script = sys.argv[1:4]
+    sys.argv = sys.argv[3:]
+    profiler = None
+    if mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return_code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            return_code = 0
+        elif isinstance(e.code, int):
+            return_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            return_code = 1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(out_file)
+        else:
+            with open(out_file, "w") as f:
+                f.write(str(return_code))
+    sys.exit(return_code)
+
+
+def _job_key():
+    if os.environ.get("SLURM_ARRAY_JOB_ID") is not None:
+        return f"{os.environ['SLURM_ARRAY_JOB_ID']}_{os.environ.get('SLURM_ARRAY_TASK_ID')}"
+    return os.environ.get("SLURM_JOB_ID", "nojob")
+
+
+def profile_command(command, mode, stage, profile_dir):
+    """
+    Run a command and write a json record of its wall time, user/system cpu time and max RSS (of the command and
+    every process it waited on) to profile_dir/stage. The command's own exit code is returned, profiling problems
+    only cost the profile
+
+    :param command: (list): program and arguments
+    :param mode: (str): time, cprofile (pstats of the python process) or py-spy (sampled stacks of the python process
+    and its subprocesses, needs py-spy on the PATH)
+    :return: (int) exit code of the command
+    """
+    stage_dir = os.path.join(profile_dir, stage)
+    os.makedirs(stage_dir, exist_ok=True)
+    program = os.path.basename(command[0])
+    record_base = os.path.join(stage_dir, f"{_job_key()}_{program}_{os.getpid()}")
+
+    profile_file = None
+    return_code_file = None
+    note = None
+    run_command = list(command)
+    if mode in ["cprofile", "py-spy"]:
+        script = _python_script(command[0])
+        if script is None:
+            note = f"{command[0]} is not a python console script, only timed"
+        elif (mode == "py-spy") and (shutil.which("py-spy") is None):
+            note = "py-spy is not installed, only timed"
+        else:
+            bootstrap = "from skeleton_keychain.profiling import run_profiled_script; run_profiled_script()"
+            if mode == "cprofile":
+                profile_file = record_base + ".prof"
+                run_command = [sys.executable, "-c", bootstrap, "cprofile", profile_file, script] + command[1:]
+            else:
+                profile_file = record_base + ".pyspy.txt"
+                return_code_file = record_base + ".returncode"
+                run_command = ["py-spy", "record", "--format", "raw", "--rate", str(PY_SPY_RATE), "--subprocesses",
+                               "--output", profile_file, "--", sys.executable, "-c", bootstrap, "py-spy",
+                               return_code_file, script] + command[1:]
+
+    start = time.time()
+    try:
+        process = subprocess.Popen(run_command)
+    except FileNotFoundError:
+        print(f"[profile] {command[0]}: command not found", file=sys.stderr, flush=True)
+        return 127
+    _, status, rusage = os.wait4(process.pid, 0)
+    end = time.time()
+    return_code = os.waitstatus_to_exitcode(status)
+    if return_code_file is not None:
+        try:
+            with open(return_code_file, "r") as f:
+                return_code = int(f.read())
+            os.remove(return_code_file)
+        except (OSError, ValueError):
+            return_code = return_code or 1
+            note = "the profiled process did not report its exit code"
+
+    record = {
+        "stage": stage,
+        "program": program,
+        "command": shlex.join(command),
+        "mode": mode,
+        "job_id": os.environ.get("SLURM_ARRAY_JOB_ID", os.environ.get("SLURM_JOB_ID")),
+        "task_id": os.environ.get("SLURM_ARRAY_TASK_ID"),
+        "host": socket.gethostname(),
+        "start_time": start,
+        "wall_s": end - start,
+        "user_s": rusage.ru_utime,
+        "system_s": rusage.ru_stime,
+        # ru_maxrss is in kilobytes on linux
+        "max_rss_mb": rusage.ru_maxrss / 1024,
+        "return_code": return_code,
+        "profile_file": profile_file if (profile_file is not None) and os.path.exists(profile_file) else None,
+        "note": note,
+    }
+    try:
+        with open(record_base + PROFILE_RECORD_SUFFIX, "w") as f:
+            json.dump(record, f)
+    except OSError as e:
+        print(f"[profile] could not write {record_base + PROFILE_RECORD_SUFFIX}: {e}", file=sys.stderr)
+    print(f"[profile] {program}: wall {record['wall_s']:.1f}s, cpu {record['user_s'] + record['system_s']:.1f}s, "
+          f"max rss {record['max_rss_mb']:.0f} MB, exit code {return_code}" + (f" ({note})" if note else ""),
+          file=sys.stderr, flush=True)
+    return return_code
+
+
+def console_script():
+    parser = argparse.ArgumentParser(description="Run a command and record its wall time, cpu time, max RSS and "
+                                                 "optionally a profile, see profile_report")
+    parser.add_argument("--mode", default="time", choices=[m for m in PROFILE_MODES if m != "off"])
+    parser.add_argument("--stage", default="unknown")
+    parser.add_argument("--profile_dir", required=True)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        parser.error("no command to profile")
+    sys.exit(profile_command(command, args.mode, args.stage, args.profile_dir))
+
+
+if __name__ == "__main__":
+    console_script()
@@ -1,22 +1,31 @@
-from neuron_morphology.swc_io import morphology_from_swc
-import matplotlib.pyplot as plt
-from morph_utils.visuals import basic_morph_plot
 import json
 import argschema as ags
 import os
-from skeleton_keys.io import load_default_layer_template
+from skeleton_keychain.swc_arrays import SwcArrays, load_swc_arrays, decimate_swc_arrays, plot_swc_arrays, \
+    get_soma_index, read_swc_sidecar
 
 class IO_Schema(ags.ArgSchema):
     ur_swc = ags.fields.InputFile(description='input txt with specimen id list')
     la_swc = ags.fields.InputFile(description='input txt with specimen id list')
     qc_image_file = ags.fields.OutputFile(description='input txt with specimen id list')
     layer_depths_file = ags.fields.InputFile(description="layer depths file",allow_none=True,default=None)
-
-def main(ur_swc,la_swc,qc_image_file,layer_depths_file, **kwargs):
-
-    filename = os.path.basename(ur_swc)
-
+    dpi = ags.fields.Int(description="resolution of the qc image", default=300)
+    fast_render = ags.fields.Boolean(description="If true, read the swc files into numpy arrays and draw each "
+                                                 "compartment type as one NaN-separated polyline instead of building "
+                                                 "neuron_morphology objects. Much faster for large (e.g. autotraced) "
+                                                 "reconstructions", default=False)
+    decimate_step = ags.fields.Int(description="With fast_render, keep only every n-th node of unbranched sections "
+                                               "(branch points, tips and compartment changes are always kept)",
+                                   default=1)
+
+
+def load_layer_depths(layer_depths_file):
+    """
+    :param layer_depths_file: (str): json with average layer depths, if None the skeleton_keys default template is used
+    :return: (dict) layer name -> depth, with the pia ('1') at 0
+    """
     if layer_depths_file is None:
+        from skeleton_keys.io import load_default_layer_template
         layer_depths = load_default_layer_template()
         layer_depths['1'] = 0
     else:
@@ -25,47 +34,106 @@ def main(ur_swc,la_swc,qc_image_file,layer_depths_file, **kwargs):
             layer_depths = json.load(f)
             layer_depths['1']=0
 
+    return layer_depths
+
+
+def draw_qc_panels(ur_ax, la_ax, ur_morph, la_morph, layer_depths, line_w=1, titles=('upright', 'layer aligned')):
+    """
+    Draw an upright and a layer aligned morphology side by side, with layer boundaries on the layer aligned panel
+
+    :param ur_ax: matplotlib axes for the upright morphology
+    :param la_ax: matplotlib axes for the layer aligned morphology
+    :param ur_morph: upright neuron_morphology Morphology or SwcArrays
+    :param la_morph: layer aligned neuron_morphology Morphology or SwcArrays
+    :param layer_depths: (dict) see load_layer_depths
+    :param line_w: (float) line width
+    :param titles: (tuple) panel titles
+    :return: None
+    """
+    for morph, ax, title in [(ur_morph, ur_ax, titles[0]), (la_morph, la_ax, titles[1])]:
+        if isinstance(morph, SwcArrays):
+            plot_swc_arrays(morph, ax=ax, title=title, line_w=line_w, side=False)
+        else:
+            from morph_utils.visuals import basic_morph_plot
+            basic_morph_plot(morph=morph,
+                             ax=ax,
+                             title=title,
+                             line_w=line_w,
+                             side=False,
+                             scatter=False)
+
+    for a in [ur_ax, la_ax]:
+        a.set_aspect('equal')
+
+    for v in layer_depths.values():
+        la_ax.axhline(-v, c='lightgrey', linestyle='--')
+
+
+def load_qc_morphology(swc_file, fast_render=False, decimate_step=1):
+    """
+    :return: SwcArrays when fast_render is True or the swc file has a current binary sidecar (see
+    swc_arrays.read_swc_sidecar), otherwise a neuron_morphology Morphology
+    """
+    if fast_render:
+        return decimate_swc_arrays(load_swc_arrays(swc_file), decimate_step)
+
+    # the sidecar is memory mapped, so the text swc is not parsed at all
+    swc_arrays = read_swc_sidecar(swc_file)
+    if swc_arrays is not None:
+        return swc_arrays
+
+    from neuron_morphology.swc_io import morphology_from_swc
+    return morphology_from_swc(swc_file)
+
+
+def render_qc_image(ur_morph, la_morph, qc_image_file, layer_depths, filename, dpi=300):
+    """
+    Write the qc image of a specimen from morphologies that are already loaded
+
+    :param ur_morph: upright neuron_morphology Morphology or SwcArrays
+    :param la_morph: layer aligned neuron_morphology Morphology or SwcArrays
+    :param qc_image_file: (str): output png
+    :param layer_depths: (dict) see load_layer_depths
+    :param filename: (str): name shown in the title
+    :param dpi: (int): resolution of the qc image
+    :return: None
+    """
+    import matplotlib.pyplot as plt
 
-    ur_morph = morphology_from_swc(ur_swc)
-    la_morph = morphology_from_swc(la_swc)
     # la_morph_soma = la_morph.get_soma()
     # aff_center = [1,0,0, 0,1,0, 0,0,1, -la_morph_soma['x'],0,-la_morph_soma['z']]
     # la_morph = aff.from_list(aff_center).transform_morphology(la_morph)
     # morphology_to_swc(la_morph,la_swc)
     print("Layer Aligned Soma")
-    print(la_morph.get_soma())
+    if isinstance(la_morph, SwcArrays):
+        soma_index = get_soma_index(la_morph)
+        print(None if soma_index is None else la_morph.xyz[soma_index])
+    else:
+        print(la_morph.get_soma())
 
     fig, axe = plt.subplots(1, 2)
-    basic_morph_plot(morph=ur_morph,
-                     ax=axe[0],
-                     title='upright',
-                     line_w=1,
-                     side=False,
-                     scatter=False)
-    basic_morph_plot(morph=la_morph,
-                     ax=axe[1],
-                     title='layer aligned',
-                     line_w=1,
-                     side=False,
-                     scatter=False)
-
-    for a in axe:
-        a.set_aspect('equal')
-
-    for v in layer_depths.values():
-        axe[1].axhline(-v, c='lightgrey', linestyle='--')
+    draw_qc_panels(axe[0], axe[1], ur_morph, la_morph, layer_depths)
 
     fig.suptitle("sp: {}".format(filename), ha='center', y=1.15)
     fig.set_size_inches(9, 4)
-    fig.savefig(qc_image_file, dpi=300, bbox_inches='tight')
-    plt.clf()
+    fig.savefig(qc_image_file, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main(ur_swc,la_swc,qc_image_file,layer_depths_file, dpi=300, fast_render=False, decimate_step=1, **kwargs):
+    filename = os.path.basename(ur_swc)
+
+    layer_depths = load_layer_depths(layer_depths_file)
+
+    ur_morph = load_qc_morphology(ur_swc, fast_render, decimate_step)
+    la_morph = load_qc_morphology(la_swc, fast_render, decimate_step)
+    render_qc_image(ur_morph, la_morph, qc_image_file, layer_depths, filename, dpi=dpi)
 
     # core_files_to_delete = [f for f in os.listdir(".") if "core." in f and ".py" not in f]
     # for fi in core_files_to_delete:
     #     print("Deleting: {}".format(fi))
     #     os.remove(fi)
 
-
 if __name__ == "__main__":
     module = ags.ArgSchemaParser(schema_type=IO_Schema)
     main(**module.args)
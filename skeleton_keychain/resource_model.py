@@ -0,0 +1,147 @@
+import os
+import numpy as np
+from skeleton_keychain.job_tracking import JobDatabase, update_job_status, unfinished_job_ids, JOB_DATABASE_FILE_NAME
+
+# smallest requests the model will make, whatever the history says
+MIN_MEMORY_MB = 1024
+MIN_TIME_MINUTES = 10
+
+
+def file_sizes(file_paths):
+    """
+    :param file_paths: (list): paths to files
+    :return: (int) total size in bytes, or None if any file does not exist (yet)
+    """
+    total = 0
+    for file_path in file_paths:
+        try:
+            total += os.path.getsize(file_path)
+        except OSError:
+            return None
+    return total
+
+
+def load_job_history(output_dirs, refresh=True):
+    """
+    Completed jobs (or array tasks) of previous runs, with the size of their inputs and what they used
+
+    :param output_dirs: (list): run_features output directories with a run_jobs.sqlite
+    :param refresh: (bool): collect accounting (sacct or local) for recorded runs that still have jobs without a
+    final state before reading them, the stored accounting of finished runs is used as is
+    :return: (list) of dict with keys stage, n_specimens, specimen_ids, input_bytes (or None), max_rss_mb, elapsed_s
+    """
+    history = []
+    for output_dir in output_dirs:
+        if not os.path.exists(os.path.join(output_dir, JOB_DATABASE_FILE_NAME)):
+            continue
+        job_db = JobDatabase(output_dir)
+        run_ids = [row[0] for row in job_db.connection.execute("select run_id from runs").fetchall()]
+        for run_id in run_ids:
+            jobs = job_db.get_jobs(run_id)
+            accounting = job_db.get_accounting([job["job_id"] for job in jobs])
+            if refresh and unfinished_job_ids(jobs, accounting):
+                try:
+                    update_job_status(job_db, run_id, output_dir)
+                except (RuntimeError, OSError) as e:
+                    print(f"Could not collect accounting for run {run_id} in {output_dir} ({e})")
+                accounting = job_db.get_accounting([job["job_id"] for job in jobs])
+            for job in jobs:
+                task_records = {r["task_id"]: r for r in accounting[job["job_id"]]}
+                is_array = any(task_id is not None for task_id in task_records)
+                task_input_bytes = job["task_input_bytes"] or [None] * len(job["task_specimen_ids"])
+                for task_idx, (task_specimen_ids, input_bytes) in enumerate(zip(job["task_specimen_ids"],
+                                                                                task_input_bytes)):
+                    record = task_records.get(task_idx if is_array else None)
+                    if (record is None) or (record["state"] != "COMPLETED"):
+                        continue
+                    if (record["max_rss_mb"] is None) or (record["elapsed_s"] is None):
+                        continue
+                    history.append({
+                        "stage": job["stage"],
+                        "n_specimens": len(task_specimen_ids),
+                        "specimen_ids": task_specimen_ids,
+                        "input_bytes": input_bytes,
+                        "max_rss_mb": record["max_rss_mb"],
+                        "elapsed_s": record["elapsed_s"],
+                    })
+        job_db.close()
+    return history
+
+
+def _fit_linear(x, y, quantile):
+    """Least squares line plus the given quantile of its residuals, a constant when x does not vary"""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if np.ptp(x) == 0:
+        slope, intercept = 0.0, float(np.mean(y))
+    else:
+        slope, intercept = np.polyfit(x, y, 1)
+        slope = max(float(slope), 0.0)
+        intercept = float(np.mean(y - slope * x))
+    residual = float(np.quantile(y - (intercept + slope * x), quantile))
+    return {"slope": slope, "intercept": intercept, "residual": max(residual, 0.0), "n": len(x)}
+
+
+class ResourceModel:
+    """
+    Per stage linear models of memory (MaxRSS) and run time (Elapsed) as a function of the total size of a job's
+    input swc files, or of its number of specimens when file sizes are not known. Predictions are the fitted line plus
+    a high quantile of the residuals, scaled by a safety margin.
+    """
+
+    def __init__(self, history, safety_margin=1.25, quantile=0.95, min_samples=10):
+        """
+        :param history: (list): see load_job_history
+        :param safety_margin: (float): predictions are multiplied by this
+        :param quantile: (float): residual quantile added to the fitted line
+        :param min_samples: (int): stages with fewer completed jobs fall back to static requests
+        """
+        self.safety_margin = safety_margin
+        self.models = {}
+        stages = sorted(set(h["stage"] for h in history))
+        for stage in stages:
+            stage_history = [h for h in history if h["stage"] == stage]
+            by_bytes = [h for h in stage_history if h["input_bytes"] is not None]
+            for feature, records in [("input_bytes", by_bytes), ("n_specimens", stage_history)]:
+                if len(records) < min_samples:
+                    continue
+                x = [h[feature] for h in records]
+                self.models[(stage, feature)] = {
+                    "max_rss_mb": _fit_linear(x, [h["max_rss_mb"] for h in records], quantile),
+                    "elapsed_s": _fit_linear(x, [h["elapsed_s"] for h in records], quantile),
+                }
+
+    @classmethod
+    def from_output_dirs(cls, output_dirs, refresh=True, **kwargs):
+        return cls(load_job_history(output_dirs, refresh=refresh), **kwargs)
+
+    def predict(self, stage, n_specimens=1, input_bytes=None):
+        """
+        :return: (int) memory in mb, (int) time in minutes, or None when there is not enough history for the stage
+        """
+        if (input_bytes is not None) and ((stage, "input_bytes") in self.models):
+            model, x = self.models[(stage, "input_bytes")], input_bytes
+        elif (stage, "n_specimens") in self.models:
+            model, x = self.models[(stage, "n_specimens")], n_specimens
+        else:
+            return None
+
+        predictions = {}
+        for target, fit in model.items():
+            predictions[target] = (fit["intercept"] + fit["slope"] * x + fit["residual"]) * self.safety_margin
+        memory_mb = max(int(np.ceil(predictions["max_rss_mb"])), MIN_MEMORY_MB)
+        time_minutes = max(int(np.ceil(predictions["elapsed_s"] / 60)), MIN_TIME_MINUTES)
+        return memory_mb, time_minutes
+
+    def apply(self, slurm_kwargs, stage, n_specimens=1, input_bytes=None):
+        """
+        Replace the --mem and --time of a resource request with the model's prediction, the request is returned
+        unchanged when the stage has no model
+
+        :param slurm_kwargs: (dict): slurm resource request
+        :return: (dict) resource request
+        """
+        prediction = self.predict(stage, n_specimens=n_specimens, input_bytes=input_bytes)
+        if prediction is None:
+            return slurm_kwargs
+        memory_mb, time_minutes = prediction
+        return dict(slurm_kwargs, **{"--mem": f"{memory_mb}mb", "--time": str(time_minutes)})
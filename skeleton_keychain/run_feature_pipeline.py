@@ -1,10 +1,29 @@
 import os
+import json
 import argschema as ags
 import numpy as np
-import time
-from skeleton_keys.database_queries import query_for_swc_file
-import shutil
-from skeleton_keychain.SlurmDAG import create_job_file, submit_job_return_id
+from skeleton_keychain.SlurmDAG import Slurm_DAG
+from skeleton_keychain.executors import get_executor
+from skeleton_keychain.manifest import RunManifest
+from skeleton_keychain.job_tracking import JobDatabase, LOCAL_ACCOUNTING_FILE_NAME, update_job_status
+from skeleton_keychain.resource_model import ResourceModel, file_sizes, load_job_history
+from skeleton_keychain.planning import (specimen_input_bytes, specimen_runtimes, stage_time_model,
+                                        estimate_specimen_costs, largest_first, pack_specimens, schedule_plan,
+                                        print_plan)
+from skeleton_keychain.swc_retrieval import retrieve_swc_files, query_for_swc_files
+from skeleton_keychain.swc_cache import (SwcCache, file_gen_cache_keys, write_key_file, unlink_shared_outputs,
+                                         swc_cache_store_command, CACHED_OUTPUTS)
+from skeleton_keychain.shared_file_gen import SHARED_FILE_GEN_LINK_FILE_NAME, write_link_file, link_outputs_command
+from skeleton_keychain.file_gen_gate import GATE_FILE_NAME, file_gen_gate_command, add_linked_job_id
+from skeleton_keychain.preflight import run_preflight, PREFLIGHT_REPORT_FILE_NAME
+from skeleton_keychain.swc_sidecars import swc_sidecars_command
+from skeleton_keychain.incremental_features import (FEATURE_RECORD_FILE_NAME, feature_record_params,
+                                                    load_feature_record, plan_feature_increment,
+                                                    merge_feature_increment_command)
+from skeleton_keychain.manifest import hash_parameters
+from skeleton_keychain.profiling import PROFILE_MODES, PROFILE_DIR_NAME
+from skeleton_keychain.file_generation import file_gen_paths, file_gen_commands, file_gen_chunk_command, \
+    layer_list_argument, shell_command, command_argv
 
 
 class IO_Schema(ags.ArgSchema):
@@ -76,6 +95,213 @@ class IO_Schema(ags.ArgSchema):
         defualt = True,
         description = "see skeleton_keys.layer_aligned_swc. essentialyl for pseq set True, everything else set False"
     )
+    use_job_arrays = ags.fields.Boolean(
+        default=False,
+        description="If true, submit swc file generation as slurm job arrays (one task per specimen) instead of "
+                    "one job per specimen",
+    )
+    max_array_size = ags.fields.Int(
+        default=1000,
+        description="Max number of tasks in a single file generation job array (should not exceed the cluster's "
+                    "MaxArraySize)",
+    )
+    array_throttle = ags.fields.Int(
+        default=None,
+        allow_none=True,
+        description="Max number of simultaneously running tasks per file generation job array (slurm %N)",
+    )
+    executor = ags.fields.Str(
+        default="slurm",
+        description="Where to run jobs. slurm submits with sbatch, local runs the same job files in a local process "
+                    "pool and waits for them to finish",
+    )
+    local_max_cpus = ags.fields.Int(
+        default=None,
+        allow_none=True,
+        description="With --executor local, number of cpus jobs may use at once (defaults to all cpus)",
+    )
+    local_max_memory = ags.fields.Str(
+        default=None,
+        allow_none=True,
+        description="With --executor local, memory jobs may use at once in slurm --mem syntax e.g. 64gb "
+                    "(defaults to all physical memory)",
+    )
+    max_concurrent_submissions = ags.fields.Int(
+        default=8,
+        description="With --executor slurm, max number of sbatch calls running at once",
+    )
+    submissions_per_second = ags.fields.Float(
+        default=None,
+        allow_none=True,
+        description="With --executor slurm, max average number of sbatch calls per second (token bucket with a burst "
+                    "of max_concurrent_submissions), to go easy on a busy controller",
+    )
+    max_submit_retries = ags.fields.Int(
+        default=5,
+        description="Times an sbatch call that failed because the controller was busy (e.g. socket timed out) is "
+                    "retried, with exponential backoff",
+    )
+    specimens_per_job = ags.fields.Int(
+        default=1,
+        description="Number of specimens each file generation job (or job array task) processes. When more than 1, "
+                    "a chunk of specimens is processed in a single python process that imports everything once "
+                    "and logs failed specimens without stopping the chunk",
+    )
+    preflight = ags.fields.Str(
+        default="abort",
+        description="Check every specimen's input files (raw swc, polygon json or the given upright/layer-aligned "
+                    "swc files) exist and parse before submitting anything. abort stops the run when any specimen "
+                    "fails, exclude leaves failed specimens out, off skips the check",
+    )
+    preflight_check_contents = ags.fields.Boolean(
+        default=True,
+        description="If false, preflight only checks input files exist and are not empty instead of also reading "
+                    "swc headers and parsing json files",
+    )
+    preflight_workers = ags.fields.Int(
+        default=32,
+        description="Number of input files preflight reads at once",
+    )
+    swc_copy_workers = ags.fields.Int(
+        default=16,
+        description="Number of concurrent copies when retrieving swc files from LIMS for orientation independent "
+                    "features",
+    )
+    histogram_shards = ags.fields.Int(
+        default=1,
+        description="Number of depth profile/soma depth jobs to split the specimens across. Each shard only waits "
+                    "for the file generation jobs of its own specimens and the shards are merged into "
+                    "AlignedHistogram.csv and AlignedSomaDepths.csv",
+    )
+    feature_shards = ags.fields.Int(
+        default=1,
+        description="Number of feature calculation jobs to split the specimens across. Shards are merged into "
+                    "RawFeatureLong.csv by the post processing job",
+    )
+    incremental_features = ags.fields.Boolean(
+        default=False,
+        description="If true, only calculate features of specimens that are not in the existing RawFeatureLong.csv "
+                    "or whose swc files were regenerated or changed since, and merge them into it (see "
+                    "feature_record.json). Depth profiles are projected onto the loadings saved by the first run "
+                    "(the save_*_depth_profile_loadings_file paths, by default <output_dir>/<compartment>_depth_"
+                    "profile_loadings.csv) so old and new rows stay comparable. The wide tables are regenerated from "
+                    "the merged long table",
+    )
+    feature_shard_cpus = ags.fields.Int(default=8, description="cpus per feature shard job")
+    feature_shard_memory = ags.fields.Str(default="16gb", description="memory per feature shard job")
+    feature_shard_time = ags.fields.Str(default="24:00:00", description="time limit per feature shard job")
+    auto_resources = ags.fields.Boolean(
+        default=True,
+        description="If true, predict the memory and time request of file generation, histogram and feature jobs "
+                    "from the accounting of earlier runs (see run_status), falling back to the static requests when "
+                    "a stage has too little history",
+    )
+    resource_history_dirs = ags.fields.List(
+        ags.fields.Str,
+        default=None,
+        allow_none=True,
+        cli_as_single_argument=True,
+        description="run_features output directories to learn resource requests from, defaults to output_dir",
+    )
+    resource_safety_margin = ags.fields.Float(
+        default=1.25,
+        description="Predicted memory and time requests are multiplied by this",
+    )
+    size_aware_scheduling = ags.fields.Boolean(
+        default=True,
+        description="If true, estimate each specimen's run time from its swc file size (and, for file generation, "
+                    "its run time in earlier runs), submit file generation largest first and pack specimen chunks, "
+                    "histogram shards and feature shards to similar estimated run times instead of splitting them "
+                    "in input order. The predicted makespan is compared with the actual one by run_status",
+    )
+    max_file_gen_retries = ags.fields.Int(
+        default=0,
+        description="When more than 0, a gate job checks every specimen's upright, layer-aligned and qc files once "
+                    "file generation finished and resubmits only the specimens that failed, up to this many times, "
+                    "with memory and time scaled by --retry_memory_factor and --retry_time_factor",
+    )
+    retry_memory_factor = ags.fields.Float(default=1.5, description="memory of a retry relative to the failed job")
+    retry_time_factor = ags.fields.Float(default=1.5, description="time limit of a retry relative to the failed job")
+    file_gen_success_threshold = ags.fields.Float(
+        default=None,
+        allow_none=True,
+        description="Fraction (0-1) of specimens that need their files (after retries) for histogram and feature "
+                    "jobs to run. Setting it adds the file generation gate job, downstream stages are cancelled "
+                    "when the gate fails",
+    )
+    swc_sidecars = ags.fields.Boolean(
+        default=True,
+        description="If true, write a binary sidecar (<id>.swc.npy, memory mapped when read) next to every generated "
+                    "upright and layer-aligned swc file, and convert given --aligned_swc_dir/--upright_swc_dir files "
+                    "in a separate job. QC images and other skeleton_keychain readers use a current sidecar instead "
+                    "of parsing the swc text",
+    )
+    swc_cache_dir = ags.fields.Str(
+        default=None,
+        allow_none=True,
+        description="Shared cache of upright swc, layer-aligned swc and qc image files keyed by the content of their "
+                    "inputs (raw swc, polygon json, layer depths and surface lookup files) and the correction "
+                    "parameters. Specimens found in the cache are linked into output_dir instead of being "
+                    "generated again, and newly generated files are added to it. Layer drawings pulled from the "
+                    "database are identified by specimen id only",
+    )
+    swc_cache_max_gb = ags.fields.Float(
+        default=500.0,
+        allow_none=True,
+        description="Least recently used swc cache entries are evicted beyond this size",
+    )
+    profile = ags.fields.Str(
+        default="off",
+        description="time, cprofile or py-spy to wrap every program in the generated job files with profile_command, "
+                    "which records its wall time, cpu time and max RSS (plus a cProfile or py-spy profile of the "
+                    "python process) in JobFiles/Profiles. Summarize them with profile_report --output_dir "
+                    "<output_dir>",
+    )
+    resume = ags.fields.Boolean(
+        default=True,
+        description="If true, only submit specimens and stages whose outputs are missing or whose inputs/parameters "
+                    "changed since they were last submitted to this output_dir (see run_manifest.json). Set False to "
+                    "resubmit everything",
+    )
+
+
+# resource request every job shares, the stages add their own job name, log file, cpus, memory and time
+STAGE_SLURM_KWARGS = {"--mail-type": "NONE", "--nodes": "1", "--partition": "celltypes"}
+
+
+def stage_setup_commands(slurm_virtual_env, execution_dir):
+    """
+    Commands every job file starts with, they activate the conda environment and change to the execution directory
+
+    :param slurm_virtual_env: (str): conda environment the console scripts are installed in
+    :param execution_dir: (str): directory the jobs run in
+    :return: (list) commands
+    """
+    return ["source ~/.bashrc", f"conda activate {slurm_virtual_env}", f"cd {execution_dir}"]
+
+
+def stage_node(node_id, name, stage, commands, resources, job_file, setup_commands, **node_fields):
+    """
+    Build the DAG node of one job of a stage
+
+    :param node_id: (int): id of the node in the DAG, this id is not the same as slurm job id
+    :param name: (str): name of the node
+    :param stage: (str): stage the job belongs to
+    :param commands: (list): commands the job runs after the setup commands
+    :param resources: (dict): slurm resource request of the job, added to STAGE_SLURM_KWARGS
+    :param job_file: (str): job file the commands are written to
+    :param setup_commands: (list): commands the job file starts with, see stage_setup_commands
+    :param node_fields: other fields of the node, e.g. parent_ids, start_condition, specimen_ids or array
+    :return: (dict) DAG node
+    """
+    node = {"id": node_id, "parent_ids": [], "name": name, "stage": stage}
+    node.update(node_fields)
+    node.update({
+        "job_file": job_file,
+        "slurm_kwargs": dict(STAGE_SLURM_KWARGS, **resources),
+        "slurm_commands": list(setup_commands) + list(commands),
+    })
+    return node
 
 
 def main(input_specimen_id_txt,
@@ -103,6 +329,40 @@ def main(input_specimen_id_txt,
          save_basal_dendrite_depth_profile_loadings_file,
          save_apical_dendrite_depth_profile_loadings_file,
          align_morph_to_layer_drawings,
+         use_job_arrays=False,
+         max_array_size=1000,
+         array_throttle=None,
+         executor="slurm",
+         local_max_cpus=None,
+         local_max_memory=None,
+         max_concurrent_submissions=8,
+         submissions_per_second=None,
+         max_submit_retries=5,
+         resume=True,
+         specimens_per_job=1,
+         preflight="abort",
+         preflight_check_contents=True,
+         preflight_workers=32,
+         swc_copy_workers=16,
+         histogram_shards=1,
+         feature_shards=1,
+         incremental_features=False,
+         feature_shard_cpus=8,
+         feature_shard_memory="16gb",
+         feature_shard_time="24:00:00",
+         auto_resources=True,
+         resource_history_dirs=None,
+         resource_safety_margin=1.25,
+         size_aware_scheduling=True,
+         swc_cache_dir=None,
+         swc_cache_max_gb=500.0,
+         swc_sidecars=True,
+         max_file_gen_retries=0,
+         retry_memory_factor=1.5,
+         retry_time_factor=1.5,
+         file_gen_success_threshold=None,
+         profile="off",
+         shared_file_gen=None,
          **kwargs):
 
     # validation
@@ -111,6 +371,26 @@ def main(input_specimen_id_txt,
             raise ValueError("--calculate_features was set to True but you did not specify "
                              "--orientation_independent_features to True or False ")
 
+    if executor not in ["slurm", "local"]:
+        raise ValueError(f"--executor must be slurm or local, you have set it to {executor}")
+    if profile not in PROFILE_MODES:
+        raise ValueError(f"--profile must be one of {PROFILE_MODES}, you have set it to {profile}")
+    executor_name = executor
+    executor_kwargs = {"max_concurrent_submissions": max_concurrent_submissions,
+                       "submissions_per_second": submissions_per_second,
+                       "submission_burst": max_concurrent_submissions,
+                       "max_submit_retries": max_submit_retries}
+    local_job_id_prefix = ""
+    if executor == "local":
+        # local job ids start at 1 with every executor, prefixing them with the run keeps the jobs of different runs
+        # apart in the accounting file they share
+        job_db = JobDatabase(output_dir)
+        local_job_id_prefix = f"run{(job_db.latest_run_id() or 0) + 1}-"
+        job_db.close()
+        executor_kwargs = {"max_cpus": local_max_cpus, "max_memory": local_max_memory,
+                           "accounting_file": os.path.join(output_dir, LOCAL_ACCOUNTING_FILE_NAME),
+                           "job_id_prefix": local_job_id_prefix}
+    executor = get_executor(executor, **executor_kwargs)
 
 
     # core_files_to_delete = [f for f in os.listdir(".") if "core." in f and ".py" not in f]
@@ -119,15 +399,8 @@ def main(input_specimen_id_txt,
     #     os.remove(fi)
 
     execution_dir = os.path.abspath(".")
-    cd_command = "cd {}".format(execution_dir)
-    layer_list = "None"
-    if species == "mouse":
-        layer_list = ["Layer1", "Layer2/3", "Layer4", "Layer5", "Layer6a", "Layer6b"]
-    elif species == "human":
-        layer_list = ["Layer1", "Layer2", "Layer3", "Layer4", "Layer5", "Layer6"]
-    
-    if layer_list != "None":
-        layer_list = '"[' + "".join([f"'{lyr}', " for lyr in layer_list]) + ']"'
+    setup_commands = stage_setup_commands(slurm_virtual_env, execution_dir)
+    layer_list = layer_list_argument(species)
 
     specimen_ids = np.loadtxt(input_specimen_id_txt, dtype=str)
     if specimen_ids.shape == ():
@@ -135,13 +408,68 @@ def main(input_specimen_id_txt,
 
     # specimen_ids = pd.read_csv(input_specimen_id_txt)['specimen_id'].values
     print("Number of Specimens to analyze files for: {}".format(len(specimen_ids)))
-    time.sleep(2)
 
     job_dir = os.path.join(output_dir, "JobFiles")
     if not os.path.exists(job_dir):
         os.mkdir(job_dir)
 
-    swc_file_gen_job_ids = []
+    # check the input files of every specimen before anything is submitted, instead of finding a typo or a missing
+    # file in a failed job hours later
+    if (aligned_swc_dir is None) and (upright_swc_dir is None) and (not orientation_independent_features):
+        preflight_inputs = [(raw_orientation_swc_dir, ".swc", "swc"), (polygon_json_dir, ".json", "json")]
+    elif orientation_independent_features:
+        preflight_inputs = [(raw_orientation_swc_dir, ".swc", "swc")]
+    else:
+        for input_dir in [aligned_swc_dir, upright_swc_dir]:
+            if (input_dir is not None) and (not os.path.isdir(input_dir)):
+                raise ValueError(f"Input directory {input_dir} does not exist")
+        preflight_inputs = [(aligned_swc_dir, ".swc", "swc"), (upright_swc_dir, ".swc", "swc")]
+    preflight_specimen_ids = run_preflight(
+        specimen_ids,
+        [(input_dir, suffix, kind) for input_dir, suffix, kind in preflight_inputs if input_dir is not None],
+        shared_files={"layer_depths_file": layer_depths_file, "surface_paths_file": surface_paths_file,
+                      "closest_surface_voxel_file": closest_surface_voxel_file},
+        action=preflight,
+        report_file=os.path.join(job_dir, PREFLIGHT_REPORT_FILE_NAME),
+        check_contents=preflight_check_contents,
+        n_workers=preflight_workers)
+    if len(preflight_specimen_ids) != len(specimen_ids):
+        # downstream jobs read the specimen ids from file, they get the ones that passed
+        specimen_ids = preflight_specimen_ids
+        input_specimen_id_txt = os.path.abspath(os.path.join(job_dir, "preflight_specimen_ids.txt"))
+        with open(input_specimen_id_txt, "w") as f:
+            for sp_id in specimen_ids:
+                f.write(f"{sp_id}\n")
+        if not specimen_ids:
+            raise ValueError("No specimens passed preflight, see {}".format(
+                os.path.join(job_dir, PREFLIGHT_REPORT_FILE_NAME)))
+    all_specimen_ids = [str(sp_id) for sp_id in specimen_ids]
+
+    manifest = RunManifest(output_dir)
+
+    # memory and time requests are predicted from the accounting of earlier runs when there is enough history,
+    # otherwise the static requests below are used
+    resource_model = None
+    job_history = []
+    if auto_resources:
+        job_history = load_job_history(resource_history_dirs or [output_dir])
+        resource_model = ResourceModel(job_history, safety_margin=resource_safety_margin)
+        if resource_model.models:
+            print("Sizing resource requests from job history for stages: {}".format(
+                sorted(set(stage for stage, _ in resource_model.models))))
+
+    # every job of this run is a node in one workflow DAG which is validated and submitted at the end
+    dag_nodes = []
+    file_gen_node_ids = []
+    file_gen_node_by_specimen = {}
+    gate = None
+    file_gen_specimen_ids = []
+    file_gen_keys = {}
+    shared_owners = {}
+    link_node_id = None
+    # swc files whose sizes estimate the cost of a specimen, see planning
+    cost_swc_dir = None
+    schedule_plans = []
     dag_id = 0
     if (aligned_swc_dir is None) and (upright_swc_dir is None) and (not orientation_independent_features):
         
@@ -163,103 +491,338 @@ def main(input_specimen_id_txt,
                 os.mkdir(dd)
 
 
+        file_gen_kwargs = {
+            "upright_swc_dir": upright_swc_dir,
+            "aligned_swc_dir": aligned_swc_dir,
+            "qc_image_dir": qc_image_dir,
+            "raw_orientation_swc_dir": raw_orientation_swc_dir,
+            "polygon_json_dir": polygon_json_dir,
+            "layer_depths_file": layer_depths_file,
+            "surface_paths_file": surface_paths_file,
+            "closest_surface_voxel_file": closest_surface_voxel_file,
+            "shrinkage_correction": shrinkage_correction,
+            "slice_angle_tilt_correction": slice_angle_tilt_correction,
+            "layer_list": layer_list,
+            "align_morph_to_layer_drawings": align_morph_to_layer_drawings,
+        }
+
+        # only (re)generate files for specimens that are missing outputs or whose inputs/parameters changed
+        file_gen_io = {}
         for sp_id in specimen_ids:
-            dag_id += 1
+            paths = file_gen_paths(sp_id, **file_gen_kwargs)
+            file_gen_io[sp_id] = (
+                [paths["raw_swc_file"], paths["polygon_json"], layer_depths_file, surface_paths_file,
+                 closest_surface_voxel_file],
+                [paths["la_file"], paths["ur_file"], paths["qc_image_file"]]
+            )
+        file_gen_specimen_ids = []
+        for sp_id in specimen_ids:
+            sp_input_files, sp_output_files = file_gen_io[sp_id]
+            if resume and manifest.is_current("file_gen", sp_id, sp_input_files, file_gen_kwargs, sp_output_files):
+                continue
+            file_gen_specimen_ids.append(sp_id)
+        if len(file_gen_specimen_ids) != len(specimen_ids):
+            print("Skipping file generation for {} specimens with up to date files".format(
+                len(specimen_ids) - len(file_gen_specimen_ids)))
 
-            la_file = os.path.abspath(os.path.join(aligned_swc_dir, "{}.swc".format(sp_id)))
-            ur_file = os.path.abspath(os.path.join(upright_swc_dir, "{}.swc".format(sp_id)))
-            log_file = os.path.abspath(os.path.join(job_dir, "{}.out".format(sp_id)))
-            job_file = os.path.abspath(os.path.join(job_dir, "{}.sh".format(sp_id)))
-            qc_image_file = os.path.abspath(os.path.join(qc_image_dir, "{}.png".format(sp_id)))
+        # the swc cache and the runs of a run spec identify file generation work by the content of its inputs and
+        # its parameters. Up to date specimens are only keyed for later runs of a run spec to link their files
+        key_specimen_ids = []
+        if shared_file_gen is not None:
+            key_specimen_ids = list(specimen_ids)
+        elif swc_cache_dir is not None:
+            key_specimen_ids = file_gen_specimen_ids
+        if key_specimen_ids:
+            lims_swc_files = None
+            if raw_orientation_swc_dir is None:
+                try:
+                    lims_swc_files = query_for_swc_files(key_specimen_ids)
+                except Exception as e:
+                    print(f"Could not look up swc files in the database, not sharing generated files ({e})")
+                    lims_swc_files = {}
+            file_gen_keys = file_gen_cache_keys(key_specimen_ids, file_gen_kwargs, swc_files=lims_swc_files,
+                                                max_workers=swc_copy_workers,
+                                                digest_memo_dir=swc_cache_dir or output_dir)
 
-            raw_swc_file, polygon_json = None, None
-            if raw_orientation_swc_dir is not None:
-                # In this scenario we have raw swc files that we will need to upright/layeralign based on drawings
-                raw_swc_file = os.path.abspath(os.path.join(raw_orientation_swc_dir, "{}.swc".format(sp_id)))
+        # link specimens that were generated before, with the same inputs and parameters, from the swc cache and
+        # only generate the rest
+        swc_cache_kwargs = None
+        cache_hits = {}
+        if (swc_cache_dir is not None) and file_gen_specimen_ids:
+            swc_cache = SwcCache(swc_cache_dir,
+                                 max_bytes=None if swc_cache_max_gb is None else int(swc_cache_max_gb * 1024 ** 3))
+            pending = set(file_gen_specimen_ids)
+            cache_keys = {sp_id: key for sp_id, key in file_gen_keys.items() if sp_id in pending}
+            cache_hits = {}
+            for sp_id, key in swc_cache.lookup(cache_keys).items():
+                paths = file_gen_paths(sp_id, **file_gen_kwargs)
+                # an entry evicted by another run since the lookup is generated again
+                if not swc_cache.restore(key, {output: paths[output] for output in CACHED_OUTPUTS}):
+                    print(f"swc cache entry of {sp_id} was evicted, generating it")
+                    continue
+                cache_hits[sp_id] = key
+                manifest.record("file_gen", sp_id, file_gen_io[sp_id][0], file_gen_kwargs, file_gen_io[sp_id][1],
+                                outputs_restored=True)
+            file_gen_specimen_ids = [sp_id for sp_id in file_gen_specimen_ids if sp_id not in cache_hits]
+            print("swc cache: {} hits, {} misses, {} specimens can not be cached".format(
+                len(cache_hits), len(cache_keys) - len(cache_hits),
+                len(file_gen_specimen_ids) + len(cache_hits) - len(cache_keys)))
 
-            if polygon_json_dir is not None:
-                polygon_json = os.path.abspath(os.path.join(polygon_json_dir, "{}.json".format(sp_id)))
+            cache_key_file = os.path.abspath(os.path.join(job_dir, "swc_cache_keys.txt"))
+            write_key_file(cache_key_file, {sp_id: key for sp_id, key in cache_keys.items()
+                                            if sp_id not in cache_hits})
+            swc_cache_kwargs = {"swc_cache_dir": os.path.abspath(swc_cache_dir),
+                                "swc_cache_key_file": cache_key_file,
+                                "max_swc_cache_gb": swc_cache_max_gb}
+            swc_cache.evict()
+            swc_cache.close()
 
-            # resource request from slurm
-            slurm_resource_kwargs = {
-                "--job-name": f"seg-{sp_id}",
-                "--mail-type": "NONE",
-                "--nodes": "1",
+        # specimens an earlier run of the same run spec generates with the same inputs and parameters are linked from
+        # that run's output directory once its job finished, instead of being generated twice
+        if (shared_file_gen is not None) and file_gen_specimen_ids:
+            pending = set(file_gen_specimen_ids)
+            shared_owners = shared_file_gen.lookup({sp_id: key for sp_id, key in file_gen_keys.items()
+                                                    if sp_id in pending})
+            file_gen_specimen_ids = [sp_id for sp_id in file_gen_specimen_ids if sp_id not in shared_owners]
+            if shared_owners:
+                print("Linking the files of {} specimens generated by an earlier run of the run spec".format(
+                    len(shared_owners)))
+
+        # files about to be regenerated must not be written through links into the cache
+        for sp_id in file_gen_specimen_ids:
+            unlink_shared_outputs(file_gen_io[sp_id][1])
+
+        # the largest specimens are submitted first and chunks are packed to similar estimated run times, so a few
+        # huge cells submitted last do not set the makespan of the stage
+        cost_swc_dir = raw_orientation_swc_dir
+        file_gen_costs = None
+        file_gen_time_model = stage_time_model(resource_model, "file_gen")
+        if size_aware_scheduling and file_gen_specimen_ids:
+            file_gen_costs, file_gen_cost_unit = estimate_specimen_costs(
+                file_gen_specimen_ids, specimen_input_bytes(file_gen_specimen_ids, cost_swc_dir),
+                time_model=file_gen_time_model, runtimes=specimen_runtimes(job_history, "file_gen"))
+            if file_gen_costs is not None:
+                file_gen_specimen_ids = largest_first(file_gen_specimen_ids, file_gen_costs)
+
+        # each work unit is processed by one job (or array task), it is either a single specimen id or a txt file
+        # listing a chunk of specimen ids
+        chunk_failure_log_file = os.path.abspath(os.path.join(job_dir, "file_gen_chunk_failures.txt"))
+        if specimens_per_job > 1:
+            work_units = []
+            work_unit_specimen_ids = []
+            if file_gen_costs is not None:
+                chunks = pack_specimens(file_gen_specimen_ids, file_gen_costs,
+                                        int(np.ceil(len(file_gen_specimen_ids) / specimens_per_job)))
+            else:
+                chunks = [file_gen_specimen_ids[chunk_start:chunk_start + specimens_per_job]
+                          for chunk_start in range(0, len(file_gen_specimen_ids), specimens_per_job)]
+            for chunk_idx, chunk_specimen_ids in enumerate(chunks):
+                chunk_file = os.path.abspath(os.path.join(job_dir, f"file_gen_chunk_{chunk_idx}.txt"))
+                with open(chunk_file, "w") as f:
+                    for sp_id in chunk_specimen_ids:
+                        f.write(f"{sp_id}\n")
+                work_units.append(chunk_file)
+                work_unit_specimen_ids.append(chunk_specimen_ids)
+        else:
+            work_units = file_gen_specimen_ids
+            work_unit_specimen_ids = [[sp_id] for sp_id in file_gen_specimen_ids]
+
+        if file_gen_costs is not None:
+            concurrency = None
+            if use_job_arrays and (array_throttle is not None):
+                concurrency = array_throttle
+            elif (executor_name == "local") and (local_max_cpus is not None):
+                concurrency = max(local_max_cpus // 2, 1)
+            schedule_plans.append(schedule_plan(
+                "file_gen", work_unit_specimen_ids, file_gen_costs, file_gen_cost_unit,
+                job_overhead_s=file_gen_time_model[0] if file_gen_time_model is not None else 0.0,
+                concurrency=concurrency))
+            print_plan(schedule_plans[-1])
+
+        # raw swc sizes are only known when raw files are given, otherwise they are pulled from the database
+        if raw_orientation_swc_dir is not None:
+            work_unit_input_bytes = [file_sizes([file_gen_paths(sp_id, **file_gen_kwargs)["raw_swc_file"]
+                                                 for sp_id in unit_specimen_ids])
+                                     for unit_specimen_ids in work_unit_specimen_ids]
+        else:
+            work_unit_input_bytes = [None] * len(work_units)
+
+        if use_job_arrays:
+            # one array job per block of work units, each task looks up its unit by SLURM_ARRAY_TASK_ID
+            unit_variable = "CHUNK_FILE" if specimens_per_job > 1 else "SPECIMEN_ID"
+            if specimens_per_job > 1:
+                unit_commands = [file_gen_chunk_command(f"${{{unit_variable}}}", chunk_failure_log_file,
+                                                        swc_cache_kwargs, swc_sidecars, **file_gen_kwargs)]
+            else:
+                unit_commands = file_gen_commands(f"${{{unit_variable}}}", swc_sidecars, **file_gen_kwargs)
+                if swc_cache_kwargs is not None:
+                    unit_commands.append(swc_cache_store_command(f"${{{unit_variable}}}", **swc_cache_kwargs, **file_gen_kwargs))
+
+            for array_idx, array_start in enumerate(range(0, len(work_units), max_array_size)):
+                dag_id += 1
+                array_work_units = work_units[array_start:array_start + max_array_size]
+
+                array_id_file = os.path.abspath(os.path.join(job_dir, f"file_gen_array_{array_idx}.txt"))
+                with open(array_id_file, "w") as f:
+                    for unit in array_work_units:
+                        f.write(f"{unit}\n")
+
+                log_file = os.path.abspath(os.path.join(job_dir, f"file_gen_array_{array_idx}_%a.out"))
+                job_file = os.path.abspath(os.path.join(job_dir, f"file_gen_array_{array_idx}.sh"))
+
+                slurm_resource_kwargs = {
+                    "--job-name": f"seg-array-{array_idx}",
+                    "--kill-on-invalid-dep": "yes",
+                    "--cpus-per-task": "2",
+                    "--mem": "10gb",
+                    "--time": "96:00:00",
+                    "--output": log_file
+                }
+                # every task of an array gets the same request, size it for the largest work unit
+                array_specimen_ids = work_unit_specimen_ids[array_start:array_start + max_array_size]
+                array_input_bytes = work_unit_input_bytes[array_start:array_start + max_array_size]
+                if resource_model is not None:
+                    slurm_resource_kwargs = resource_model.apply(
+                        slurm_resource_kwargs, "file_gen",
+                        n_specimens=max(len(unit_specimen_ids) for unit_specimen_ids in array_specimen_ids),
+                        input_bytes=None if None in array_input_bytes else max(array_input_bytes))
+
+                array_commands = [
+                    f'{unit_variable}=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {array_id_file})',
+                    f'echo "{unit_variable}: ${{{unit_variable}}}"',
+                ] + unit_commands
+
+                # this job has no upstream dependency
+                file_gen_dag_node = stage_node(dag_id, "file-gen-array-{}".format(array_idx), "file_gen",
+                                               array_commands, slurm_resource_kwargs, job_file, setup_commands,
+                                               task_specimen_ids=array_specimen_ids,
+                                               task_input_bytes=array_input_bytes,
+                                               array=len(array_work_units), array_throttle=array_throttle)
+
+                dag_nodes.append(file_gen_dag_node)
+                file_gen_node_ids.append(dag_id)
+                for unit_specimen_ids in array_specimen_ids:
+                    for sp_id in unit_specimen_ids:
+                        file_gen_node_by_specimen[sp_id] = dag_id
+
+        else:
+            for unit, unit_specimen_ids, unit_input_bytes in zip(work_units, work_unit_specimen_ids,
+                                                                 work_unit_input_bytes):
+                dag_id += 1
+
+                if specimens_per_job > 1:
+                    unit_name = os.path.splitext(os.path.basename(unit))[0]
+                    unit_commands = [file_gen_chunk_command(unit, chunk_failure_log_file, swc_cache_kwargs,
+                                                            swc_sidecars, **file_gen_kwargs)]
+                else:
+                    unit_name = unit
+                    unit_commands = file_gen_commands(unit, swc_sidecars, **file_gen_kwargs)
+                    if swc_cache_kwargs is not None:
+                        unit_commands.append(swc_cache_store_command(unit, **swc_cache_kwargs, **file_gen_kwargs))
+
+                log_file = os.path.abspath(os.path.join(job_dir, "{}.out".format(unit_name)))
+                job_file = os.path.abspath(os.path.join(job_dir, "{}.sh".format(unit_name)))
+
+                # resource request from slurm
+                slurm_resource_kwargs = {
+                    "--job-name": f"seg-{unit_name}",
+                    "--kill-on-invalid-dep": "yes",
+                    "--cpus-per-task": "2",
+                    "--mem": "10gb",
+                    "--time": "96:00:00",
+                    "--output": log_file
+                }
+                if resource_model is not None:
+                    slurm_resource_kwargs = resource_model.apply(slurm_resource_kwargs, "file_gen",
+                                                                 n_specimens=len(unit_specimen_ids),
+                                                                 input_bytes=unit_input_bytes)
+
+                # bringing it all together, this job has no upstream dependency
+                file_gen_dag_node = stage_node(dag_id, "{}-file-gen".format(unit_name), "file_gen", unit_commands,
+                                               slurm_resource_kwargs, job_file, setup_commands,
+                                               specimen_ids=unit_specimen_ids, input_bytes=unit_input_bytes)
+
+                dag_nodes.append(file_gen_dag_node)
+                file_gen_node_ids.append(dag_id)
+                for sp_id in unit_specimen_ids:
+                    file_gen_node_by_specimen[sp_id] = dag_id
+
+        for sp_id in file_gen_specimen_ids:
+            manifest.record("file_gen", sp_id, file_gen_io[sp_id][0], file_gen_kwargs, file_gen_io[sp_id][1])
+
+        # a gate job checks every specimen's files once file generation finished, retries the failed specimens and
+        # only lets the downstream stages (which then depend on it with afterok) start when enough succeeded
+        if file_gen_node_ids and ((max_file_gen_retries > 0) or (file_gen_success_threshold is not None)):
+            dag_id += 1
+            gate_file = os.path.abspath(os.path.join(job_dir, GATE_FILE_NAME))
+            gate_slurm_resource_kwargs = {
+                "--job-name": "file-gen-gate",
                 "--kill-on-invalid-dep": "yes",
-                "--cpus-per-task": "2",
-                "--mem": "10gb",
-                "--time": "96:00:00",
-                "--partition": "celltypes",
-                "--output": log_file
+                "--cpus-per-task": "1",
+                "--mem": "2gb",
+                "--time": "60",
             }
+            dag_nodes.append(stage_node(
+                dag_id, "file-gen-gate", "file_gen_gate", [file_gen_gate_command(gate_file, 0)],
+                dict(gate_slurm_resource_kwargs,
+                     **{"--output": os.path.abspath(os.path.join(job_dir, "file_gen_gate_0.out"))}),
+                os.path.abspath(os.path.join(job_dir, "file_gen_gate_0.sh")), setup_commands,
+                parent_ids=file_gen_node_ids, start_condition="afterany",
+                specimen_ids=[str(sp_id) for sp_id in file_gen_specimen_ids]))
 
-            # what you want to run on slurm
-            upright_command_kwargs = {
-                "specimen_id": sp_id,
-                "output_file": ur_file,
-                "closest_surface_voxel_file": closest_surface_voxel_file,
-                "surface_paths_file": surface_paths_file,
-                "swc_path": raw_swc_file,
-                "surface_and_layers_file": polygon_json,
-                "correct_for_shrinkage": shrinkage_correction,
-                "correct_for_slice_angle": slice_angle_tilt_correction,
-            }
-            upright_command_kwargs = {k: v for k, v in upright_command_kwargs.items() if v is not None}
-            upright_command_kwargs = " ".join(["--{} {}".format(k, v) for k, v in upright_command_kwargs.items()])
-
-            layer_align_command_kwargs = {
-                "specimen_id": sp_id,
-                "output_file": la_file,
-                "layer_depths_file": layer_depths_file,
-                "closest_surface_voxel_file": closest_surface_voxel_file,
-                "surface_paths_file": surface_paths_file,
-                "swc_path": raw_swc_file,
-                "surface_and_layers_file": polygon_json,
-                "correct_for_shrinkage": shrinkage_correction,
-                "correct_for_slice_angle": slice_angle_tilt_correction,
-                "layer_list": layer_list,
-                "align_morph_to_layer_drawings":align_morph_to_layer_drawings
-            }
-            layer_align_command_kwargs = {k: v for k, v in layer_align_command_kwargs.items() if v is not None}
-            layer_align_command_kwargs = " ".join(
-                ["--{} {}".format(k, v) for k, v in layer_align_command_kwargs.items()])
-
-            qc_image_command_kwargs = {
-                "ur_swc": ur_file,
-                "la_swc": la_file,
-                "qc_image_file": qc_image_file,
-                "layer_depths_file": layer_depths_file
-            }
-            if layer_depths_file is None:
-                del qc_image_command_kwargs["layer_depths_file"]
-
-            qc_image_command_kwargs = " ".join(
-                ["--{} {}".format(k, v) for k, v in qc_image_command_kwargs.items() if v is not None])
-
-            slurm_commands = [
-                "source ~/.bashrc",
-                f"conda activate {slurm_virtual_env}",
-                cd_command,
-                "skelekeys-layer-aligned-swc {}".format(layer_align_command_kwargs),
-                "skelekeys-upright-corrected-swc {}".format(upright_command_kwargs),
-                "qc_swc_image {}".format(qc_image_command_kwargs)
-            ]
-
-            # bringing it all together
-            file_gen_dag_node = {
-                "id": dag_id,  # this id is not the same as slurm job id.
-                "parent_id": -1,  # this job has no upstream dependency
-                "name": "{}-file-gen".format(sp_id),
-                "job_file": job_file,
-                "slurm_kwargs": slurm_resource_kwargs,
-                "slurm_commands": slurm_commands,
+            # retries run one specimen per array task
+            retry_task_commands = file_gen_commands("${SPECIMEN_ID}", swc_sidecars, **file_gen_kwargs)
+            if swc_cache_kwargs is not None:
+                retry_task_commands.append(swc_cache_store_command("${SPECIMEN_ID}", **swc_cache_kwargs,
+                                                                   **file_gen_kwargs))
+            gate = {
+                "gate_file": gate_file,
+                "gate_node_id": dag_id,
+                "output_dir": os.path.abspath(output_dir),
+                "job_dir": os.path.abspath(job_dir),
+                "executor": executor_name,
+                "executor_kwargs": {"max_cpus": local_max_cpus, "max_memory": local_max_memory}
+                if executor_name == "local" else executor_kwargs,
+                "job_id_prefix": local_job_id_prefix,
+                "specimen_ids": [str(sp_id) for sp_id in file_gen_specimen_ids],
+                "output_files": {str(sp_id): file_gen_io[sp_id][1] for sp_id in file_gen_specimen_ids},
+                "setup_commands": setup_commands,
+                "task_commands": retry_task_commands,
+                "slurm_kwargs": dict(STAGE_SLURM_KWARGS, **{"--cpus-per-task": "2", "--mem": "10gb",
+                                                            "--time": "96:00:00"}),
+                "gate_slurm_kwargs": dict(STAGE_SLURM_KWARGS, **gate_slurm_resource_kwargs),
+                "max_retries": max_file_gen_retries,
+                "memory_factor": retry_memory_factor,
+                "time_factor": retry_time_factor,
+                "success_threshold": file_gen_success_threshold or 0.0,
+                "max_array_size": max_array_size,
+                "array_throttle": array_throttle,
+                "downstream_node_ids": [],
             }
+            file_gen_node_ids = [dag_id]
+            file_gen_node_by_specimen = {sp_id: dag_id for sp_id in file_gen_node_by_specimen}
 
-            create_job_file(file_gen_dag_node)
-            slurm_job_id = submit_job_return_id(job_file=job_file, parent_job_id=None, start_condition=None)
-
-            swc_file_gen_job_ids.append(slurm_job_id)
-
+        # one job links the files of specimens generated by an earlier run of the run spec once the jobs generating
+        # them finished, or the gate of that run when it has one. Retries of that gate re-point the link job to the
+        # next gate (see file_gen_gate), so specimens the retries recover are linked too
+        if shared_owners:
+            dag_id += 1
+            shared_link_file = os.path.abspath(os.path.join(job_dir, SHARED_FILE_GEN_LINK_FILE_NAME))
+            write_link_file(shared_link_file, shared_owners,
+                            {sp_id: file_gen_paths(sp_id, **file_gen_kwargs) for sp_id in shared_owners})
+            owner_job_ids = [owner["job_id"] for owner in shared_owners.values() if owner["job_id"] is not None]
+            dag_nodes.append(stage_node(
+                dag_id, "file-gen-links", "file_gen_links", [link_outputs_command(shared_link_file)],
+                {"--job-name": "file-gen-links", "--cpus-per-task": "1", "--mem": "2gb", "--time": "60",
+                 "--output": os.path.abspath(os.path.join(job_dir, "file_gen_links.out"))},
+                os.path.abspath(os.path.join(job_dir, "file_gen_links.sh")), setup_commands,
+                dependency_job_ids=list(dict.fromkeys(owner_job_ids)), start_condition="afterany",
+                specimen_ids=[str(sp_id) for sp_id in shared_owners]))
+            link_node_id = dag_id
+            file_gen_node_ids.append(dag_id)
+            for sp_id in shared_owners:
+                file_gen_node_by_specimen[sp_id] = dag_id
+                manifest.record("file_gen", sp_id, file_gen_io[sp_id][0], file_gen_kwargs, file_gen_io[sp_id][1])
 
     elif orientation_independent_features:
         if raw_orientation_swc_dir is None:
@@ -268,10 +831,13 @@ def main(input_specimen_id_txt,
             if not os.path.exists(swc_dst_dir):
                 os.mkdir(swc_dst_dir)
 
-            for sp_id in specimen_ids:
-                swc_src_pth = query_for_swc_file(sp_id)
-                swc_dst_pth = os.path.join(swc_dst_dir, f"{sp_id}.swc")
-                shutil.copy(swc_src_pth, swc_dst_pth)
+            retrieval_report = retrieve_swc_files(specimen_ids, swc_dst_dir, max_workers=swc_copy_workers)
+            if retrieval_report["failed"]:
+                failure_file = os.path.join(swc_dst_dir, "retrieval_failures.txt")
+                with open(failure_file, "w") as f:
+                    for sp_id, reason in retrieval_report["failed"].items():
+                        f.write(f"{sp_id}\t{reason}\n")
+                print(f"WARNING: {len(retrieval_report['failed'])} swc files could not be retrieved, see {failure_file}")
 
             feature_swc_dir = swc_dst_dir
         else:
@@ -279,27 +845,34 @@ def main(input_specimen_id_txt,
 
 
     else:
-        # validate the provided swc directories
-        if aligned_swc_dir is not None:
-            assert os.path.exists(aligned_swc_dir)
-            assert len([f for f in os.listdir(aligned_swc_dir) if f.endswith(".swc")]) != 0
-        else:
+        # the provided swc directories were validated by preflight
+        if aligned_swc_dir is None:
             print(f"with orientation_independent_features={orientation_independent_features} "
                   f"need to define aligned_swc_dir, you have set it to {aligned_swc_dir}. "
                   )
         if upright_swc_dir is not None:
             feature_swc_dir = upright_swc_dir
-            assert os.path.exists(upright_swc_dir)
-            assert len([f for f in os.listdir(upright_swc_dir) if f.endswith(".swc")]) != 0
         else:
             print(f"with orientation_independent_features={orientation_independent_features} "
                   f"need to define upright_swc_dir, you have set it to {upright_swc_dir}. "
                   )
+
+        # binary sidecars of the given swc files are written by a job of their own that nothing waits on, sidecars
+        # that are current are left alone
+        sidecar_swc_dirs = [os.path.abspath(d) for d in [aligned_swc_dir, upright_swc_dir] if d is not None]
+        if swc_sidecars and sidecar_swc_dirs:
+            dag_id += 1
+            dag_nodes.append(stage_node(
+                dag_id, "swc-sidecars", "swc_sidecars", [swc_sidecars_command(swc_dirs=sidecar_swc_dirs, n_workers=8)],
+                {"--job-name": "swc-sidecars", "--cpus-per-task": "8", "--mem": "16gb", "--time": "12:00:00",
+                 "--output": os.path.abspath(os.path.join(job_dir, "swc_sidecars_job.log"))},
+                os.path.abspath(os.path.join(job_dir, "swc_sidecars_job.sh")), setup_commands,
+                specimen_ids=[str(sp_id) for sp_id in specimen_ids]))
     if calculate_features:
 
         histogram_ofile = None
         soma_depth_ofile = None
-        histogram_job_id = None
+        feature_parent_ids = file_gen_node_ids
         if not orientation_independent_features:
             # Generate Auxilary Files Needed For Feature Calc
             histo_job_file = os.path.abspath(os.path.join(job_dir, "histogram_job.sh"))
@@ -320,41 +893,148 @@ def main(input_specimen_id_txt,
             # resource request from slurm
             histo_slurm_resource_kwargs = {
                 "--job-name": f"histogram-gen",
-                "--mail-type": "NONE",
-                "--nodes": "1",
                 "--kill-on-invalid-dep": "no",
                 "--cpus-per-task": "2",
                 "--mem": "10gb",
                 "--time": "60",
-                "--partition": "celltypes",
                 "--output": histo_log_file
             }
-            histo_slurm_commands = [
-                "source ~/.bashrc",
-                f"conda activate {slurm_virtual_env}",
-                cd_command,
-                profile_cmd
-            ]
-
-            histo_file_gen_dag_node = {
-                "id": dag_id + 1,  # this id is not the same as slurm job id.
-                "parent_id": -1,  # this job has no upstream dependency
-                "name": "histo-file-gen",
-                "job_file": histo_job_file,
-                "slurm_kwargs": histo_slurm_resource_kwargs,
-                "slurm_commands": histo_slurm_commands,
-            }
 
-            create_job_file(histo_file_gen_dag_node)
-            if swc_file_gen_job_ids != []:
-                histogram_job_id = submit_job_return_id(job_file=histo_job_file, parent_job_id=swc_file_gen_job_ids,
-                                                        start_condition="afterany")
+            histo_input_files = [input_specimen_id_txt, layer_depths_file] + [
+                os.path.join(aligned_swc_dir, f"{sp_id}.swc") for sp_id in specimen_ids]
+            histo_output_files = [histogram_ofile, soma_depth_ofile]
+            if histogram_shards <= 1:
+                if resume and (file_gen_node_ids == []) and manifest.is_current(
+                        "histogram", "all", histo_input_files, aux_file_input_args, histo_output_files):
+                    print("Skipping histogram generation, {} and {} are up to date".format(histogram_ofile,
+                                                                                           soma_depth_ofile))
+                else:
+                    histo_input_bytes = file_sizes(histo_input_files[2:])
+                    if resource_model is not None:
+                        histo_slurm_resource_kwargs = resource_model.apply(histo_slurm_resource_kwargs, "histogram",
+                                                                           n_specimens=len(specimen_ids),
+                                                                           input_bytes=histo_input_bytes)
+                    dag_id += 1
+                    # wait for every file generation job to finish
+                    histo_file_gen_dag_node = stage_node(dag_id, "histo-file-gen", "histogram", [profile_cmd],
+                                                         histo_slurm_resource_kwargs, histo_job_file, setup_commands,
+                                                         parent_ids=file_gen_node_ids, start_condition="afterany",
+                                                         specimen_ids=all_specimen_ids,
+                                                         input_bytes=histo_input_bytes)
+                    dag_nodes.append(histo_file_gen_dag_node)
+                    manifest.record("histogram", "all", histo_input_files, aux_file_input_args, histo_output_files,
+                                    inputs_pending=file_gen_node_ids != [])
+
+                    # the histogram job already waits on file generation, features only need to wait on it
+                    feature_parent_ids = [dag_id]
+
             else:
-                histogram_job_id = submit_job_return_id(job_file=histo_job_file, parent_job_id=None,
-                                                        start_condition=None)
+                # one profiles job per shard of specimens that only waits for the file generation jobs of its own
+                # specimens, a merge job then streams the shards into AlignedHistogram.csv and AlignedSomaDepths.csv
+                histo_shard_dir = os.path.join(output_dir, "HistogramShards")
+                if not os.path.exists(histo_shard_dir):
+                    os.mkdir(histo_shard_dir)
+
+                histogram_shard_files = []
+                soma_depth_shard_files = []
+                histo_merge_parent_ids = []
+                histogram_costs = None
+                histogram_time_model = stage_time_model(resource_model, "histogram_shards")
+                if size_aware_scheduling:
+                    histogram_costs, histogram_cost_unit = estimate_specimen_costs(
+                        specimen_ids, specimen_input_bytes(specimen_ids, cost_swc_dir or aligned_swc_dir),
+                        time_model=histogram_time_model)
+                if histogram_costs is not None:
+                    shards = [[str(sp_id) for sp_id in shard]
+                              for shard in pack_specimens(specimen_ids, histogram_costs, histogram_shards)]
+                    schedule_plans.append(schedule_plan(
+                        "histogram_shards", shards, histogram_costs, histogram_cost_unit,
+                        job_overhead_s=histogram_time_model[0] if histogram_time_model is not None else 0.0))
+                    print_plan(schedule_plans[-1])
+                else:
+                    shards = [[str(sp_id) for sp_id in shard]
+                              for shard in np.array_split(np.array(specimen_ids, dtype=str), histogram_shards)
+                              if len(shard) > 0]
+                for shard_idx, shard_specimen_ids in enumerate(shards):
+                    shard_id_file = os.path.abspath(os.path.join(histo_shard_dir, f"histogram_shard_{shard_idx}.txt"))
+                    with open(shard_id_file, "w") as f:
+                        for sp_id in shard_specimen_ids:
+                            f.write(f"{sp_id}\n")
+                    shard_histogram_ofile = os.path.join(histo_shard_dir, f"AlignedHistogram_shard{shard_idx}.csv")
+                    shard_soma_depth_ofile = os.path.join(histo_shard_dir, f"AlignedSomaDepths_shard{shard_idx}.csv")
+                    histogram_shard_files.append(shard_histogram_ofile)
+                    soma_depth_shard_files.append(shard_soma_depth_ofile)
+
+                    shard_aux_args = dict(aux_file_input_args,
+                                          specimen_id_file=shard_id_file,
+                                          output_hist_file=shard_histogram_ofile,
+                                          output_soma_file=shard_soma_depth_ofile)
+                    shard_profile_cmd = shell_command("skelekeys-profiles-from-swcs", command_argv(shard_aux_args))
+                    shard_slurm_resource_kwargs = dict(
+                        histo_slurm_resource_kwargs,
+                        **{"--job-name": f"histogram-shard-{shard_idx}",
+                           "--output": os.path.abspath(os.path.join(histo_shard_dir,
+                                                                    f"histogram_shard_{shard_idx}.log"))})
+
+                    shard_parent_ids = sorted({file_gen_node_by_specimen[sp_id] for sp_id in shard_specimen_ids
+                                               if sp_id in file_gen_node_by_specimen})
+                    shard_input_files = [layer_depths_file] + [
+                        os.path.join(aligned_swc_dir, f"{sp_id}.swc") for sp_id in shard_specimen_ids]
+                    shard_input_bytes = file_sizes(shard_input_files[1:])
+                    if resource_model is not None:
+                        shard_slurm_resource_kwargs = resource_model.apply(shard_slurm_resource_kwargs,
+                                                                           "histogram_shards",
+                                                                           n_specimens=len(shard_specimen_ids),
+                                                                           input_bytes=shard_input_bytes)
+                    shard_output_files = [shard_histogram_ofile, shard_soma_depth_ofile]
+                    shard_params = dict(shard_aux_args, specimen_ids=shard_specimen_ids)
+                    if resume and (shard_parent_ids == []) and manifest.is_current(
+                            "histogram_shards", shard_idx, shard_input_files, shard_params, shard_output_files):
+                        print("Skipping histogram shard {}, {} is up to date".format(shard_idx, shard_histogram_ofile))
+                        continue
 
-            # adding histogram job id to this will let our feature calculation job to wait until its finished
-            swc_file_gen_job_ids.append(histogram_job_id)
+                    dag_id += 1
+                    # only waits for the file generation jobs of this shard's specimens
+                    histo_shard_dag_node = stage_node(
+                        dag_id, f"histo-shard-{shard_idx}", "histogram_shards", [shard_profile_cmd],
+                        shard_slurm_resource_kwargs,
+                        os.path.abspath(os.path.join(histo_shard_dir, f"histogram_shard_{shard_idx}.sh")),
+                        setup_commands, parent_ids=shard_parent_ids, start_condition="afterany",
+                        specimen_ids=shard_specimen_ids, input_bytes=shard_input_bytes)
+                    dag_nodes.append(histo_shard_dag_node)
+                    manifest.record("histogram_shards", shard_idx, shard_input_files, shard_params,
+                                    shard_output_files, inputs_pending=shard_parent_ids != [])
+                    histo_merge_parent_ids.append(dag_id)
+
+                histo_merge_slurm_resource_kwargs = {
+                    "--job-name": f"histogram-merge",
+                    "--kill-on-invalid-dep": "yes",
+                    "--cpus-per-task": "1",
+                    "--mem": "4gb",
+                    "--time": "60",
+                    "--output": histo_log_file
+                }
+                histo_merge_commands = [
+                    'merge_csv_shards --input_files "[' + ", ".join([f"'{f}'" for f in shard_files]) +
+                    f']" --output_file {merged_file}'
+                    for shard_files, merged_file in [(histogram_shard_files, histogram_ofile),
+                                                     (soma_depth_shard_files, soma_depth_ofile)]
+                ]
+                histo_merge_input_files = histogram_shard_files + soma_depth_shard_files
+                if resume and (histo_merge_parent_ids == []) and manifest.is_current(
+                        "histogram", "all", histo_merge_input_files, {}, histo_output_files):
+                    print("Skipping histogram merge, {} and {} are up to date".format(histogram_ofile,
+                                                                                      soma_depth_ofile))
+                else:
+                    dag_id += 1
+                    histo_merge_dag_node = stage_node(dag_id, "histo-merge", "histogram_merge", histo_merge_commands,
+                                                      histo_merge_slurm_resource_kwargs, histo_job_file,
+                                                      setup_commands, parent_ids=histo_merge_parent_ids,
+                                                      start_condition="afterok", specimen_ids=all_specimen_ids)
+                    dag_nodes.append(histo_merge_dag_node)
+                    manifest.record("histogram", "all", histo_merge_input_files, {}, histo_output_files,
+                                    inputs_pending=histo_merge_parent_ids != [])
+                    feature_parent_ids = [dag_id]
 
         # Calculate Features
         feature_ofile = os.path.join(output_dir, "RawFeatureLong.csv")
@@ -375,48 +1055,358 @@ def main(input_specimen_id_txt,
                                  "save_apical_dendrite_depth_profile_loadings_file": save_apical_dendrite_depth_profile_loadings_file,
                                  "output_file": feature_ofile
                                  }
+
+        # incremental runs only calculate the specimens that are new or whose swc files changed, and the post
+        # processing job merges them into the existing long table
+        feature_specimen_ids = all_specimen_ids
+        feature_increment_files = None
+        feature_record_file = os.path.join(output_dir, FEATURE_RECORD_FILE_NAME)
+        feature_record_swc_dirs = [os.path.abspath(feature_swc_dir)]
+        if (not orientation_independent_features) and (aligned_swc_dir is not None):
+            feature_record_swc_dirs.append(os.path.abspath(aligned_swc_dir))
+        if incremental_features:
+            # old and new rows have to be projected onto the same depth profile loadings, the first run saves them
+            loadings_files = {}
+            saved_loadings_missing = []
+            if not orientation_independent_features:
+                for compartment, analyze in [("axon", analyze_axon),
+                                             ("basal_dendrite", analyze_basal_dendrite),
+                                             ("apical_dendrite", analyze_apical_dendrite)]:
+                    if not analyze:
+                        continue
+                    given_loadings_file = feat_calc_input_cfigs[f"{compartment}_depth_profile_loadings_file"]
+                    if given_loadings_file is not None:
+                        loadings_files[compartment] = given_loadings_file
+                        continue
+                    save_loadings_file = feat_calc_input_cfigs[f"save_{compartment}_depth_profile_loadings_file"]
+                    if save_loadings_file is None:
+                        save_loadings_file = os.path.join(output_dir, f"{compartment}_depth_profile_loadings.csv")
+                        feat_calc_input_cfigs[f"save_{compartment}_depth_profile_loadings_file"] = save_loadings_file
+                    loadings_files[compartment] = save_loadings_file
+                    if not os.path.exists(save_loadings_file):
+                        saved_loadings_missing.append(save_loadings_file)
+
+            feature_params_hash = hash_parameters(feature_record_params(
+                feature_swc_dir, analyze_axon, analyze_basal_dendrite, analyze_apical_dendrite,
+                orientation_independent_features, loadings_files))
+            increment_specimen_ids = None
+            if saved_loadings_missing:
+                print(f"No saved depth profile loadings ({', '.join(saved_loadings_missing)}), calculating features "
+                      f"of every specimen")
+            else:
+                increment_specimen_ids = plan_feature_increment(all_specimen_ids, feature_record_swc_dirs,
+                                                                feature_ofile, feature_record_file,
+                                                                feature_params_hash,
+                                                                pending_specimen_ids=file_gen_specimen_ids +
+                                                                list(shared_owners))
+
+            if increment_specimen_ids is not None:
+                for compartment, loadings_file in loadings_files.items():
+                    feat_calc_input_cfigs[f"{compartment}_depth_profile_loadings_file"] = loadings_file
+                    feat_calc_input_cfigs[f"save_{compartment}_depth_profile_loadings_file"] = None
+                feature_specimen_ids = increment_specimen_ids
+                recorded_specimen_ids = set(load_feature_record(feature_record_file)["specimens"])
+                if increment_specimen_ids or (recorded_specimen_ids != set(all_specimen_ids)):
+                    increment_dir = os.path.join(output_dir, "FeatureIncrement")
+                    if not os.path.exists(increment_dir):
+                        os.mkdir(increment_dir)
+                    increment_specimen_id_txt = os.path.abspath(os.path.join(increment_dir,
+                                                                             "increment_specimen_ids.txt"))
+                    with open(increment_specimen_id_txt, "w") as f:
+                        for sp_id in increment_specimen_ids:
+                            f.write(f"{sp_id}\n")
+                    feat_calc_input_cfigs["specimen_id_file"] = increment_specimen_id_txt
+                    feat_calc_input_cfigs["output_file"] = os.path.join(increment_dir, "RawFeatureLong_increment.csv")
+                    feature_increment_files = [feat_calc_input_cfigs["output_file"]] if increment_specimen_ids else []
+                else:
+                    print("RawFeatureLong.csv is up to date with {}".format(input_specimen_id_txt))
+
         feat_cmd = "skelekeys-morph-features " + " ".join(
             ["--{} {}".format(k, v) for k, v in feat_calc_input_cfigs.items() if v is not None])
         feat_post_proc_cmd = 'skelekeys-postprocess-features --input_files "' + f"['{feature_ofile}'" + f']" --wide_normalized_output_file {wide_norm_ofile} --wide_unnormalized_output_file {wide_unnorm_ofile}'
 
-        feature_job_file = os.path.abspath(os.path.join(job_dir, "Feature_Calculation_Job.sh"))
-        feature_job_log_file = os.path.abspath(os.path.join(job_dir, "Feature_Calculation_Job.out"))
-
-        feature_slurm_resource_kwargs = {
-            "--job-name": f"features-calc",
-            "--mail-type": "NONE",
-            "--nodes": "1",
-            "--kill-on-invalid-dep": "no",
-            "--cpus-per-task": "70",
-            "--mem": "120gb",
-            "--time": "124:00:00",
-            "--partition": "celltypes",
-            "--output": feature_job_log_file
-        }
-        feature_slurm_commands = [
-            "source ~/.bashrc",
-            f"conda activate {slurm_virtual_env}",
-            cd_command,
-            feat_cmd,
-            feat_post_proc_cmd
-        ]
-        feature_gen_dag_node = {
-            "id": dag_id + 2,  # this id is not the same as slurm job id.
-            "parent_id": -1,  # this job has no upstream dependency
-            "name": "histo-file-gen",
-            "job_file": feature_job_file,
-            "slurm_kwargs": feature_slurm_resource_kwargs,
-            "slurm_commands": feature_slurm_commands,
-        }
+        feature_common_input_files = [soma_depth_ofile, histogram_ofile, axon_depth_profile_loadings_file,
+                                      basal_dendrite_depth_profile_loadings_file,
+                                      apical_dendrite_depth_profile_loadings_file]
+        postprocess_parent_ids = []
+        if not feature_specimen_ids:
+            print("No specimens need their features calculated")
+        elif feature_shards <= 1:
+            feature_job_file = os.path.abspath(os.path.join(job_dir, "Feature_Calculation_Job.sh"))
+            feature_job_log_file = os.path.abspath(os.path.join(job_dir, "Feature_Calculation_Job.out"))
+
+            feature_slurm_resource_kwargs = {
+                "--job-name": f"features-calc",
+                "--kill-on-invalid-dep": "no",
+                "--cpus-per-task": "70",
+                "--mem": "120gb",
+                "--time": "124:00:00",
+                "--output": feature_job_log_file
+            }
+
+            feature_swc_files = [os.path.join(feature_swc_dir, f"{sp_id}.swc") for sp_id in feature_specimen_ids]
+            feature_input_files = [feat_calc_input_cfigs["specimen_id_file"]] + feature_common_input_files + \
+                feature_swc_files
+            feature_input_bytes = file_sizes(feature_swc_files)
+            if resource_model is not None:
+                feature_slurm_resource_kwargs = resource_model.apply(feature_slurm_resource_kwargs, "features",
+                                                                     n_specimens=len(feature_specimen_ids),
+                                                                     input_bytes=feature_input_bytes)
+            if resume and (feature_parent_ids == []) and manifest.is_current(
+                    "features", "all", feature_input_files, feat_calc_input_cfigs,
+                    [feat_calc_input_cfigs["output_file"]]):
+                print("Skipping feature calculation, {} is up to date".format(feat_calc_input_cfigs["output_file"]))
+            else:
+                dag_id += 1
+                feature_gen_dag_node = stage_node(dag_id, "features-calc", "features", [feat_cmd],
+                                                  feature_slurm_resource_kwargs, feature_job_file, setup_commands,
+                                                  parent_ids=feature_parent_ids, start_condition="afterany",
+                                                  specimen_ids=feature_specimen_ids, input_bytes=feature_input_bytes)
+                dag_nodes.append(feature_gen_dag_node)
+                manifest.record("features", "all", feature_input_files, feat_calc_input_cfigs,
+                                [feat_calc_input_cfigs["output_file"]], inputs_pending=feature_parent_ids != [])
+                postprocess_parent_ids = [dag_id]
+
+        else:
+            # K smaller jobs that each write a long format csv for their share of the specimens, merged by the post
+            # processing job. A crashed shard only loses (and on the next run only resubmits) its own specimens
+            shard_dir = os.path.join(output_dir, "FeatureShards")
+            if not os.path.exists(shard_dir):
+                os.mkdir(shard_dir)
+
+            # every shard has to project depth profiles onto the same loadings, so unless loadings were given a
+            # loadings job fits them once over every specimen's depth profile and all shards wait for it and read them
+            shared_loadings_files = {}
+            if not orientation_independent_features:
+                for compartment, analyze in [("axon", analyze_axon),
+                                             ("basal_dendrite", analyze_basal_dendrite),
+                                             ("apical_dendrite", analyze_apical_dendrite)]:
+                    given_loadings_file = feat_calc_input_cfigs[f"{compartment}_depth_profile_loadings_file"]
+                    if (not analyze) or (given_loadings_file is not None):
+                        continue
+                    save_loadings_file = feat_calc_input_cfigs[f"save_{compartment}_depth_profile_loadings_file"]
+                    if save_loadings_file is None:
+                        save_loadings_file = os.path.join(shard_dir, f"{compartment}_depth_profile_loadings.csv")
+                    shared_loadings_files[compartment] = save_loadings_file
+
+            loadings_node_ids = []
+            if shared_loadings_files:
+                loadings_job_file = os.path.abspath(os.path.join(shard_dir, "Depth_Profile_Loadings_Job.sh"))
+                loadings_log_file = os.path.abspath(os.path.join(shard_dir, "Depth_Profile_Loadings_Job.out"))
+                loadings_kwargs = {"specimen_id_file": feat_calc_input_cfigs["specimen_id_file"],
+                                   "aligned_depth_profile_file": histogram_ofile,
+                                   **{f"{compartment}_loadings_file": loadings_file
+                                      for compartment, loadings_file in shared_loadings_files.items()}}
+                loadings_slurm_resource_kwargs = {
+                    "--job-name": "depth-profile-loadings",
+                    "--kill-on-invalid-dep": "yes",
+                    "--cpus-per-task": "1",
+                    "--mem": "16gb",
+                    "--time": "2:00:00",
+                    "--output": loadings_log_file
+                }
+                loadings_cmd = shell_command("fit_depth_profile_loadings", command_argv(loadings_kwargs))
+                loadings_input_files = [feat_calc_input_cfigs["specimen_id_file"], histogram_ofile]
+                loadings_output_files = list(shared_loadings_files.values())
+                if resume and (feature_parent_ids == []) and manifest.is_current(
+                        "depth_profile_loadings", "all", loadings_input_files, loadings_kwargs, loadings_output_files):
+                    print("Skipping depth profile loadings, {} are up to date".format(loadings_output_files))
+                else:
+                    dag_id += 1
+                    loadings_dag_node = stage_node(dag_id, "depth-profile-loadings", "depth_profile_loadings",
+                                                   [loadings_cmd], loadings_slurm_resource_kwargs, loadings_job_file,
+                                                   setup_commands, parent_ids=feature_parent_ids,
+                                                   start_condition="afterok", specimen_ids=feature_specimen_ids)
+                    dag_nodes.append(loadings_dag_node)
+                    manifest.record("depth_profile_loadings", "all", loadings_input_files, loadings_kwargs,
+                                    loadings_output_files, inputs_pending=feature_parent_ids != [])
+                    loadings_node_ids = [dag_id]
+
+            feature_costs = None
+            feature_time_model = stage_time_model(resource_model, "feature_shards")
+            if size_aware_scheduling:
+                feature_costs, feature_cost_unit = estimate_specimen_costs(
+                    feature_specimen_ids, specimen_input_bytes(feature_specimen_ids, cost_swc_dir or feature_swc_dir),
+                    time_model=feature_time_model)
+            if feature_costs is not None:
+                shards = [[str(sp_id) for sp_id in shard]
+                          for shard in pack_specimens(feature_specimen_ids, feature_costs, feature_shards)]
+                schedule_plans.append(schedule_plan(
+                    "feature_shards", shards, feature_costs, feature_cost_unit,
+                    job_overhead_s=feature_time_model[0] if feature_time_model is not None else 0.0))
+                print_plan(schedule_plans[-1])
+            else:
+                shards = [[str(sp_id) for sp_id in shard]
+                          for shard in np.array_split(np.array(feature_specimen_ids, dtype=str), feature_shards)
+                          if len(shard) > 0]
+            feature_shard_files = []
+            for shard_idx, shard_specimen_ids in enumerate(shards):
+                shard_id_file = os.path.abspath(os.path.join(shard_dir, f"feature_shard_{shard_idx}.txt"))
+                with open(shard_id_file, "w") as f:
+                    for sp_id in shard_specimen_ids:
+                        f.write(f"{sp_id}\n")
+                shard_ofile = os.path.join(shard_dir, f"RawFeatureLong_shard{shard_idx}.csv")
+                feature_shard_files.append(shard_ofile)
+
+                shard_cfigs = dict(feat_calc_input_cfigs, specimen_id_file=shard_id_file, output_file=shard_ofile)
+                for compartment, loadings_file in shared_loadings_files.items():
+                    shard_cfigs[f"{compartment}_depth_profile_loadings_file"] = loadings_file
+                    shard_cfigs[f"save_{compartment}_depth_profile_loadings_file"] = None
+                shard_cmd = shell_command("skelekeys-morph-features", command_argv(shard_cfigs))
+
+                shard_job_file = os.path.abspath(os.path.join(shard_dir, f"Feature_Shard_{shard_idx}_Job.sh"))
+                shard_log_file = os.path.abspath(os.path.join(shard_dir, f"Feature_Shard_{shard_idx}_Job.out"))
+                shard_slurm_resource_kwargs = {
+                    "--job-name": f"features-shard-{shard_idx}",
+                    "--kill-on-invalid-dep": "no",
+                    "--cpus-per-task": str(feature_shard_cpus),
+                    "--mem": feature_shard_memory,
+                    "--time": feature_shard_time,
+                    "--output": shard_log_file
+                }
 
-        create_job_file(feature_gen_dag_node)
+                shard_parent_ids = list(feature_parent_ids) + loadings_node_ids
+                shard_swc_files = [os.path.join(feature_swc_dir, f"{sp_id}.swc") for sp_id in shard_specimen_ids]
+                shard_input_files = feature_common_input_files + [
+                    shard_cfigs[f"{compartment}_depth_profile_loadings_file"] for compartment in shared_loadings_files
+                ] + shard_swc_files
+                shard_input_bytes = file_sizes(shard_swc_files)
+                if resource_model is not None:
+                    shard_slurm_resource_kwargs = resource_model.apply(shard_slurm_resource_kwargs, "feature_shards",
+                                                                       n_specimens=len(shard_specimen_ids),
+                                                                       input_bytes=shard_input_bytes)
+                shard_params = dict(shard_cfigs, specimen_ids=shard_specimen_ids)
+                if resume and (shard_parent_ids == []) and manifest.is_current(
+                        "feature_shards", shard_idx, shard_input_files, shard_params, [shard_ofile]):
+                    print("Skipping feature shard {}, {} is up to date".format(shard_idx, shard_ofile))
+                    continue
 
-        if swc_file_gen_job_ids != []:
-            submit_job_return_id(job_file=feature_job_file, parent_job_id=swc_file_gen_job_ids,
-                                 start_condition="afterany")
+                dag_id += 1
+                feature_shard_dag_node = stage_node(dag_id, f"features-shard-{shard_idx}", "feature_shards",
+                                                    [shard_cmd], shard_slurm_resource_kwargs, shard_job_file,
+                                                    setup_commands, parent_ids=shard_parent_ids,
+                                                    start_condition="afterany", specimen_ids=shard_specimen_ids,
+                                                    input_bytes=shard_input_bytes)
+                dag_nodes.append(feature_shard_dag_node)
+                manifest.record("feature_shards", shard_idx, shard_input_files, shard_params, [shard_ofile],
+                                inputs_pending=shard_parent_ids != [])
+                postprocess_parent_ids.append(dag_id)
+
+        # wide tables are a small single core job so the big feature allocation is released as soon as possible
+        postprocess_job_file = os.path.abspath(os.path.join(job_dir, "Feature_Postprocess_Job.sh"))
+        postprocess_log_file = os.path.abspath(os.path.join(job_dir, "Feature_Postprocess_Job.out"))
+        postprocess_slurm_resource_kwargs = {
+            "--job-name": f"features-postprocess",
+            "--kill-on-invalid-dep": "yes",
+            "--cpus-per-task": "1",
+            "--mem": "32gb",
+            "--time": "4:00:00",
+            "--output": postprocess_log_file
+        }
+        postprocess_commands = [feat_post_proc_cmd]
+        postprocess_input_files = [feature_ofile]
+        postprocess_output_files = [wide_norm_ofile, wide_unnorm_ofile]
+        if feature_increment_files is not None:
+            # rows of the specimens that were not recalculated are streamed out of the existing long table and the
+            # increment (or its shards) appended, before the wide tables are regenerated
+            if (feature_shards > 1) and feature_increment_files:
+                feature_increment_files = feature_shard_files
+            merge_cmd = merge_feature_increment_command(input_specimen_id_txt,
+                                                        feat_calc_input_cfigs["specimen_id_file"], feature_ofile,
+                                                        feature_record_swc_dirs, feature_params_hash,
+                                                        feature_record_file, base_file=feature_ofile,
+                                                        increment_files=feature_increment_files)
+            postprocess_commands.insert(0, merge_cmd)
+            postprocess_input_files = [input_specimen_id_txt, feat_calc_input_cfigs["specimen_id_file"]] + \
+                feature_increment_files
+            postprocess_output_files = [feature_ofile] + postprocess_output_files
+        elif (feature_shards > 1) and feature_specimen_ids:
+            # the reduce step, concatenate the shards into RawFeatureLong.csv before post processing
+            merge_cmd = 'merge_csv_shards --input_files "[' + ", ".join(
+                [f"'{f}'" for f in feature_shard_files]) + f']" --output_file {feature_ofile}'
+            postprocess_commands.insert(0, merge_cmd)
+            postprocess_input_files = feature_shard_files
+            postprocess_output_files = [feature_ofile] + postprocess_output_files
+        if incremental_features and (feature_increment_files is None) and feature_specimen_ids:
+            # every specimen was calculated, record them so the next run can add to this long table
+            postprocess_commands.insert(-1, merge_feature_increment_command(
+                input_specimen_id_txt, input_specimen_id_txt, feature_ofile, feature_record_swc_dirs,
+                feature_params_hash, feature_record_file))
+        if resume and (postprocess_parent_ids == []) and manifest.is_current(
+                "postprocess", "all", postprocess_input_files, {}, postprocess_output_files):
+            print("Skipping feature post processing, {} and {} are up to date".format(wide_norm_ofile,
+                                                                                    wide_unnorm_ofile))
         else:
-            submit_job_return_id(job_file=feature_job_file, parent_job_id=None, start_condition=None)
+            dag_id += 1
+            postprocess_dag_node = stage_node(dag_id, "features-postprocess", "postprocess", postprocess_commands,
+                                              postprocess_slurm_resource_kwargs, postprocess_job_file,
+                                              setup_commands, parent_ids=postprocess_parent_ids,
+                                              start_condition="afterok", specimen_ids=all_specimen_ids)
+            dag_nodes.append(postprocess_dag_node)
+            manifest.record("postprocess", "all", postprocess_input_files, {}, postprocess_output_files,
+                            inputs_pending=postprocess_parent_ids != [])
+
+    # every program in the job files records its timings (and profile) in JobFiles/Profiles/<stage>
+    if profile != "off":
+        profile_dir = os.path.abspath(os.path.join(job_dir, PROFILE_DIR_NAME))
+        for node in dag_nodes:
+            node["profile"] = {"mode": profile, "profile_dir": profile_dir, "stage": node.get("stage", node["name"])}
+        if gate is not None:
+            gate["profile"] = {"mode": profile, "profile_dir": profile_dir}
+
+    # stages downstream of the file generation gate only start when it (and every stage in between) succeeded
+    if gate is not None:
+        gated_node_ids = {gate["gate_node_id"]}
+        for node in dag_nodes:
+            if gate["gate_node_id"] in node.get("parent_ids", []):
+                gate["downstream_node_ids"].append(node["id"])
+            if gated_node_ids.intersection(node.get("parent_ids", [])):
+                node["start_condition"] = "afterok"
+                node["slurm_kwargs"]["--kill-on-invalid-dep"] = "yes"
+                gated_node_ids.add(node["id"])
+        with open(gate["gate_file"], "w") as f:
+            json.dump(gate, f, indent=2)
+
+    # the file generation gate judges outputs by this run's submission times, so they are saved before any job starts
+    manifest.save()
+
+    # every submitted job is recorded in output_dir/run_jobs.sqlite, see the run_status console script
+    job_db = JobDatabase(output_dir)
+    run_id = job_db.start_run(executor_name, len(specimen_ids))
+    job_db.record_plans(run_id, schedule_plans)
+    if dag_nodes:
+        workflow = Slurm_DAG(dag_nodes)
+        workflow.submit_dag_to_scheduler(executor=executor, max_workers=max_concurrent_submissions)
+        job_db.record_jobs(run_id, workflow)
+
+    # later runs of the run spec link the files this run generates (or restored from the swc cache) instead of
+    # generating them again. They wait on this run's gate, which includes its retries, when there is one. Local jobs
+    # (and the gate's local retries) are finished once executor.wait() returns, so there is no job to wait on
+    if (shared_file_gen is not None) and file_gen_keys:
+        shared_specimen_ids = [sp_id for sp_id in file_gen_keys if sp_id not in shared_owners]
+        shared_job_ids = {}
+        shared_gate_file = None
+        if executor_name == "slurm":
+            shared_job_ids = {sp_id: workflow.job_ids[file_gen_node_by_specimen[sp_id]]
+                              for sp_id in shared_specimen_ids if sp_id in file_gen_node_by_specimen}
+            shared_gate_file = None if gate is None else gate["gate_file"]
+        shared_file_gen.register({sp_id: file_gen_keys[sp_id] for sp_id in shared_specimen_ids},
+                                 {sp_id: file_gen_paths(sp_id, **file_gen_kwargs) for sp_id in shared_specimen_ids},
+                                 shared_job_ids, gate_file=shared_gate_file)
+    if (link_node_id is not None) and (executor_name == "slurm"):
+        for owner_gate_file in dict.fromkeys(owner["gate_file"] for owner in shared_owners.values()):
+            if owner_gate_file is not None:
+                add_linked_job_id(owner_gate_file, workflow.job_ids[link_node_id])
 
+    job_states = executor.wait()
+    if job_states:
+        failed_jobs = {job_id: state for job_id, state in job_states.items() if state != "COMPLETED"}
+        print(f"{len(job_states) - len(failed_jobs)} of {len(job_states)} local jobs completed")
+        if failed_jobs:
+            print(f"Jobs that did not complete: {failed_jobs}")
+        update_job_status(job_db, run_id, output_dir)
+    job_db.close()
+    print(f"Run {run_id} recorded in {job_db.db_file}, use run_status --output_dir {output_dir} to follow it")
 
 if __name__ == "__main__":
     module = ags.ArgSchemaParser(schema_type=IO_Schema)
@@ -0,0 +1,72 @@
+import json
+import os
+import argschema as ags
+from skeleton_keychain import run_feature_pipeline
+from skeleton_keychain.shared_file_gen import SharedFileGen
+
+
+class IO_Schema(ags.ArgSchema):
+    run_spec_file = ags.fields.InputFile(
+        description="json with a list of run_features configurations (runs) and arguments common to all of them "
+                    "(defaults), e.g. {\"defaults\": {\"species\": \"mouse\", ...}, \"runs\": [{\"output_dir\": ..., "
+                    "\"input_specimen_id_txt\": ...}, ...]}")
+
+
+def load_run_spec(run_spec_file):
+    """
+    Read a run spec and validate every run against the run_features schema
+
+    :param run_spec_file: (str): json with keys runs (list of dicts of run_features arguments) and optionally defaults
+    (dict of arguments every run gets unless it sets them itself)
+    :return: (list) validated run_features arguments of each run
+    """
+    with open(run_spec_file, "r") as f:
+        run_spec = json.load(f)
+    if not run_spec.get("runs"):
+        raise ValueError(f"{run_spec_file} has no runs")
+
+    runs = []
+    for run in run_spec["runs"]:
+        input_data = dict(run_spec.get("defaults", {}), **run)
+        module = ags.ArgSchemaParser(input_data=input_data, schema_type=run_feature_pipeline.IO_Schema, args=[])
+        runs.append(module.args)
+
+    output_dirs = [os.path.abspath(run["output_dir"]) for run in runs]
+    duplicates = sorted(set(d for d in output_dirs if output_dirs.count(d) > 1))
+    if duplicates:
+        raise ValueError(f"Every run of a run spec needs its own output_dir, {duplicates} are used more than once")
+    # jobs of one run can only wait on jobs of an earlier run that went to the same scheduler
+    executors = set(run["executor"] for run in runs)
+    if len(executors) > 1:
+        raise ValueError(f"Every run of a run spec has to use the same executor, got {sorted(executors)}")
+    return runs
+
+
+def main(run_spec_file, **kwargs):
+    """
+    Run several run_features configurations (e.g. different feature settings or overlapping specimen lists) as one
+    submission. File generation is shared between the runs: a specimen whose upright and layer aligned files an
+    earlier run generates from the same inputs and parameters is not generated again, the later run links that run's
+    files once its file generation (and the retries of its gate) finished and its histogram and feature stages wait
+    for them.
+    """
+    runs = load_run_spec(run_spec_file)
+    shared_file_gen = SharedFileGen()
+    for run_idx, run in enumerate(runs):
+        print(f"\nRun {run_idx + 1} of {len(runs)}: {run['output_dir']}")
+        n_linked = shared_file_gen.n_linked
+        run_feature_pipeline.main(**run, shared_file_gen=shared_file_gen)
+        print(f"Run {run_idx + 1} links the files of {shared_file_gen.n_linked - n_linked} specimens generated by "
+              f"an earlier run")
+    print(f"\n{len(runs)} runs submitted, file generation of {shared_file_gen.n_linked} specimens was shared instead "
+          f"of repeated")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
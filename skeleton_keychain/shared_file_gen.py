@@ -0,0 +1,119 @@
+import shutil
+import os
+import argschema as ags
+from skeleton_keychain.swc_cache import CACHED_OUTPUTS
+from skeleton_keychain.swc_arrays import swc_sidecar_file
+from skeleton_keychain.file_generation import command_argv, shell_command
+
+SHARED_FILE_GEN_LINK_FILE_NAME = "shared_file_gen_links.txt"
+
+
+class IO_Schema(ags.ArgSchema):
+    link_file = ags.fields.InputFile(description="tab separated source and destination file of every output to link, "
+                                                 "written by run_features")
+
+
+class SharedFileGen:
+    """
+    File generation submitted by the runs of one run spec (see run_spec), keyed like the swc cache by the content of
+    a specimen's inputs and the parameters that change its outputs. The first run that needs a key generates it, later
+    runs link its outputs once the owning run's file generation (and the retries of its gate) finished instead of
+    generating them again.
+    """
+
+    def __init__(self):
+        # key -> dict with output_files (file_gen_paths output -> path), job_id (None when the files exist) and
+        # gate_file (None when the owning run has no file generation gate)
+        self.owners = {}
+        self.n_linked = 0
+
+    def lookup(self, keys):
+        """
+        :param keys: (dict): specimen id -> file generation key
+        :return: (dict) specimen id -> owner (dict with output_files, job_id and gate_file) of the specimens an earlier
+        run generates
+        """
+        owners = {sp_id: self.owners[key] for sp_id, key in keys.items() if key in self.owners}
+        self.n_linked += len(owners)
+        return owners
+
+    def register(self, keys, output_files, job_ids, gate_file=None):
+        """
+        :param keys: (dict): specimen id -> file generation key of the specimens a run generates (or restored)
+        :param output_files: (dict): specimen id -> file_gen_paths output -> path
+        :param job_ids: (dict): specimen id -> id of the job that writes its files, the gate job when the run has a
+        file generation gate, None when they already exist
+        :param gate_file: (str): gate file of the run, its retries re-point the link jobs of later runs to the next
+        gate
+        :return: None
+        """
+        for sp_id, key in keys.items():
+            if key not in self.owners:
+                self.owners[key] = {"output_files": {output: output_files[sp_id][output] for output in CACHED_OUTPUTS},
+                                    "job_id": job_ids.get(sp_id),
+                                    "gate_file": gate_file}
+
+
+def write_link_file(link_file, owners, output_files):
+    """
+    :param owners: (dict): specimen id -> owner, see SharedFileGen.lookup
+    :param output_files: (dict): specimen id -> file_gen_paths output -> path the owner's file is linked to
+    :return: None
+    """
+    with open(link_file, "w") as f:
+        for sp_id, owner in owners.items():
+            for output in CACHED_OUTPUTS:
+                f.write(f"{sp_id}\t{owner['output_files'][output]}\t{output_files[sp_id][output]}\n")
+
+
+def link_file(src, dst):
+    """Hard link src to dst, or copy it when they are on different file systems"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def link_outputs(link_file_path):
+    """
+    Link the outputs listed in a link file into place, along with the binary sidecars of swc files
+
+    :return: (dict) specimen id -> list of missing source files, for specimens whose owner did not write them
+    """
+    missing = {}
+    with open(link_file_path, "r") as f:
+        links = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    for sp_id, src, dst in links:
+        if not os.path.exists(src):
+            missing.setdefault(sp_id, []).append(src)
+            continue
+        link_file(src, dst)
+        if os.path.exists(swc_sidecar_file(src)):
+            link_file(swc_sidecar_file(src), swc_sidecar_file(dst))
+    n_specimens = len(set(link[0] for link in links))
+    print(f"Linked the files of {n_specimens - len(missing)} of {n_specimens} specimens")
+    return missing
+
+
+def link_outputs_command(link_file_path):
+    return shell_command("link_file_gen_outputs", command_argv({"link_file": link_file_path}))
+
+
+def main(link_file, **kwargs):
+    missing = link_outputs(link_file)
+    # failures are retried and reported by the run that owns the file generation, downstream stages of this run treat
+    # the missing specimens like specimens whose file generation failed
+    for sp_id, sources in missing.items():
+        print(f"WARNING: {sp_id}: {', '.join(sources)} were not generated")
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
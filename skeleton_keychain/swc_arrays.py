@@ -0,0 +1,246 @@
+from collections import namedtuple
+import os
+import numpy as np
+
+SWC_COLUMNS = ["id", "type", "x", "y", "z", "radius", "parent"]
+
+MORPH_COLORS = {1: 'black', 2: "firebrick", 4: "orange", 3: "steelblue"}
+
+# column arrays of one swc file, parent_index is the row of each node's parent (-1 for roots and missing parents)
+SwcArrays = namedtuple("SwcArrays", ["ids", "types", "xyz", "radius", "parents", "parent_index"])
+
+
+# binary sidecar of a swc file (<name>.swc.npy), a record array that is memory mapped when read. Fields are ordered
+# so every column stays aligned, 56 bytes per node
+SWC_SIDECAR_SUFFIX = ".npy"
+SWC_SIDECAR_DTYPE = np.dtype([("id", "<i8"), ("xyz", "<f8", (3,)), ("parent", "<i8"), ("parent_index", "<i8"),
+                              ("type", "<i4"), ("radius", "<f4")])
+
+
+def swc_sidecar_file(swc_file):
+    return swc_file + SWC_SIDECAR_SUFFIX
+
+
+def read_swc_sidecar(swc_file):
+    """
+    Memory map the binary sidecar of a swc file. The columns of the returned SwcArrays are views into the mapped file.
+    A sidecar carries the modification time of the swc file it was made from and is stale once they differ.
+
+    :param swc_file: (str): path to swc file
+    :return: SwcArrays, or None when there is no current sidecar
+    """
+    sidecar_file = swc_sidecar_file(swc_file)
+    try:
+        if os.stat(sidecar_file).st_mtime_ns != os.stat(swc_file).st_mtime_ns:
+            return None
+        records = np.load(sidecar_file, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if (records.dtype != SWC_SIDECAR_DTYPE) or (records.ndim != 1):
+        return None
+    return SwcArrays(ids=records["id"],
+                     types=records["type"],
+                     xyz=records["xyz"],
+                     radius=records["radius"],
+                     parents=records["parent"],
+                     parent_index=records["parent_index"])
+
+
+def write_swc_sidecar(swc_file, swc_arrays=None):
+    """
+    Write the binary sidecar of a swc file
+
+    :param swc_file: (str): path to swc file
+    :param swc_arrays: SwcArrays of the file when they are already in memory, otherwise the file is parsed
+    :return: (str) sidecar file
+    """
+    # the swc file is stat'ed before it is read, so a swc file that changes meanwhile leaves a stale sidecar
+    swc_stat = os.stat(swc_file)
+    if swc_arrays is None:
+        swc_arrays = load_swc_arrays(swc_file, use_sidecar=False)
+
+    records = np.empty(len(swc_arrays.ids), dtype=SWC_SIDECAR_DTYPE)
+    records["id"] = swc_arrays.ids
+    records["type"] = swc_arrays.types
+    records["xyz"] = swc_arrays.xyz
+    records["radius"] = swc_arrays.radius
+    records["parent"] = swc_arrays.parents
+    records["parent_index"] = swc_arrays.parent_index
+
+    sidecar_file = swc_sidecar_file(swc_file)
+    tmp_file = f"{sidecar_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, records)
+    os.utime(tmp_file, ns=(swc_stat.st_atime_ns, swc_stat.st_mtime_ns))
+    os.replace(tmp_file, sidecar_file)
+    return sidecar_file
+
+
+def load_swc_arrays(swc_file, use_sidecar=True):
+    """
+    Parse a swc file straight into numpy column arrays, without building a morphology object graph
+
+    :param swc_file: (str): path to swc file
+    :param use_sidecar: (bool): memory map the file's binary sidecar instead when it is current
+    :return: SwcArrays
+    """
+    if use_sidecar:
+        swc_arrays = read_swc_sidecar(swc_file)
+        if swc_arrays is not None:
+            return swc_arrays
+
+    import pandas as pd
+
+    swc_df = pd.read_csv(swc_file, sep=r"\s+", comment="#", header=None, names=SWC_COLUMNS, usecols=range(7))
+    ids = swc_df["id"].to_numpy(dtype=np.int64)
+    parents = swc_df["parent"].to_numpy(dtype=np.int64)
+    return SwcArrays(ids=ids,
+                     types=swc_df["type"].to_numpy(dtype=np.int64),
+                     xyz=swc_df[["x", "y", "z"]].to_numpy(dtype=np.float64),
+                     radius=swc_df["radius"].to_numpy(dtype=np.float64),
+                     parents=parents,
+                     parent_index=map_parent_index(ids, parents))
+
+
+def map_parent_index(ids, parents):
+    """
+    Vectorized node id -> row lookup of every node's parent
+
+    :param ids: (array): node ids
+    :param parents: (array): parent node ids, -1 for roots
+    :return: (array) row of each node's parent, -1 for roots and parents that are not in the file
+    """
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    pos = np.clip(np.searchsorted(sorted_ids, parents), 0, max(len(ids) - 1, 0))
+    found = (len(ids) > 0) & (sorted_ids[pos] == parents) & (parents != -1)
+    return np.where(found, order[pos], -1)
+
+
+def get_soma_index(swc_arrays):
+    """
+    :return: (int) row of the soma (first root node of type 1), or None
+    """
+    soma_rows = np.flatnonzero((swc_arrays.types == 1) & (swc_arrays.parent_index == -1))
+    return int(soma_rows[0]) if len(soma_rows) else None
+
+
+def decimate_swc_arrays(swc_arrays, step):
+    """
+    Thin out the nodes of unbranched sections while keeping the topology. Roots, tips, branch points, nodes where the
+    compartment type changes and the soma's children are always kept, plus every step-th remaining node. Each kept node
+    is reconnected to its closest kept ancestor.
+
+    :param swc_arrays: SwcArrays
+    :param step: (int): keep every step-th node of unbranched sections, 1 returns the input unchanged
+    :return: SwcArrays
+    """
+    if step <= 1:
+        return swc_arrays
+
+    n_nodes = len(swc_arrays.ids)
+    parent_index = swc_arrays.parent_index
+    has_parent = parent_index >= 0
+
+    n_children = np.bincount(parent_index[has_parent], minlength=n_nodes)
+    type_change = np.zeros(n_nodes, dtype=bool)
+    type_change[has_parent] = swc_arrays.types[has_parent] != swc_arrays.types[parent_index[has_parent]]
+    soma_index = get_soma_index(swc_arrays)
+
+    keep = (~has_parent) | (n_children != 1) | type_change | (np.arange(n_nodes) % step == 0)
+    if soma_index is not None:
+        keep |= parent_index == soma_index
+    keep[parent_index[type_change]] = True
+
+    # pointer jumping: every node ends up pointing at its closest kept ancestor (or itself when kept)
+    nearest_kept = np.where(keep, np.arange(n_nodes), parent_index)
+    while True:
+        unresolved = (nearest_kept >= 0) & ~keep[np.maximum(nearest_kept, 0)]
+        if not unresolved.any():
+            break
+        nearest_kept[unresolved] = nearest_kept[nearest_kept[unresolved]]
+
+    kept_rows = np.flatnonzero(keep)
+    new_row = np.full(n_nodes, -1)
+    new_row[kept_rows] = np.arange(len(kept_rows))
+    kept_parent_rows = parent_index[kept_rows]
+    new_parent_index = np.where(kept_parent_rows >= 0, new_row[nearest_kept[np.maximum(kept_parent_rows, 0)]], -1)
+    new_ids = swc_arrays.ids[kept_rows]
+
+    return SwcArrays(ids=new_ids,
+                     types=swc_arrays.types[kept_rows],
+                     xyz=swc_arrays.xyz[kept_rows],
+                     radius=swc_arrays.radius[kept_rows],
+                     parents=np.where(new_parent_index >= 0, new_ids[np.maximum(new_parent_index, 0)], -1),
+                     parent_index=new_parent_index)
+
+
+def swc_segments(swc_arrays, side=False):
+    """
+    :param swc_arrays: SwcArrays
+    :param side: (bool): if True use zy instead of xy coordinates
+    :return: (array) segments of shape (n, 2, 2) from parent to child, (array) compartment type of each segment
+    (the child's type)
+    """
+    points = swc_arrays.xyz[:, [2, 1]] if side else swc_arrays.xyz[:, [0, 1]]
+    child_rows = np.flatnonzero(swc_arrays.parent_index >= 0)
+    segments = np.stack([points[swc_arrays.parent_index[child_rows]], points[child_rows]], axis=1)
+    return segments, swc_arrays.types[child_rows]
+
+
+def segments_to_polyline(segments):
+    """
+    Join segments into one polyline broken by NaNs, so matplotlib draws them as a single path. With the Agg backend this
+    renders several times faster than a LineCollection, which draws every segment as its own path.
+
+    :param segments: (array): segments of shape (n, 2, 2)
+    :return: (array) x, (array) y of length 3 * n
+    """
+    xs = np.full((len(segments), 3), np.nan)
+    ys = np.full((len(segments), 3), np.nan)
+    xs[:, :2] = segments[:, :, 0]
+    ys[:, :2] = segments[:, :, 1]
+    return xs.ravel(), ys.ravel()
+
+
+def plot_swc_arrays(swc_arrays,
+                    ax,
+                    title="",
+                    morph_colors=MORPH_COLORS,
+                    side=False,
+                    line_w=0.5,
+                    soma_dot_size=1,
+                    scatter_roots=True):
+    """
+    Fast equivalent of morph_utils.visuals.basic_morph_plot that draws a single line per compartment type
+
+    :param swc_arrays: SwcArrays
+    :param ax: matplotlib axes
+    :param title: plot title
+    :param morph_colors: dictionary to represent colors for each compartment
+    :param side: if True will plot zy
+    :param line_w: linewidth for morphology lines
+    :param soma_dot_size: size of the soma marker
+    :param scatter_roots: scatter nodes of type 1 whose parent = -1
+    :return: None
+    """
+    ax.set_title(title)
+    segments, segment_types = swc_segments(swc_arrays, side=side)
+    for compartment, color in morph_colors.items():
+        compartment_segments = segments[segment_types == compartment]
+        if len(compartment_segments):
+            ax.plot(*segments_to_polyline(compartment_segments), c=color, linewidth=line_w, zorder=compartment)
+
+    points = swc_arrays.xyz[:, [2, 1]] if side else swc_arrays.xyz[:, [0, 1]]
+    soma_index = get_soma_index(swc_arrays)
+    if soma_index is not None:
+        ax.scatter(*points[soma_index], c='k', marker='X', s=soma_dot_size)
+        soma_children = np.flatnonzero(swc_arrays.parent_index == soma_index)
+        if len(soma_children):
+            soma_segments = np.stack([np.repeat(points[[soma_index]], len(soma_children), axis=0),
+                                      points[soma_children]], axis=1)
+            ax.plot(*segments_to_polyline(soma_segments), c='k', linewidth=line_w * 2.5)
+
+    if scatter_roots:
+        root_rows = np.flatnonzero((swc_arrays.types == 1) & (swc_arrays.parent_index == -1))
+        ax.scatter(points[root_rows, 0], points[root_rows, 1], c='k', marker='X', s=line_w * 40)
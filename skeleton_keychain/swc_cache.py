@@ -0,0 +1,439 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import sqlite3
+import shutil
+import stat
+import time
+import sys
+import os
+import json
+import argschema as ags
+import numpy as np
+from skeleton_keychain.manifest import hash_parameters
+from skeleton_keychain.file_generation import file_gen_paths, command_argv, shell_command
+
+CACHE_INDEX_FILE_NAME = "swc_cache.sqlite"
+# file_gen_paths output -> file name within a cache entry
+CACHED_OUTPUTS = {"ur_file": "upright.swc", "la_file": "layer_aligned.swc", "qc_image_file": "qc.png"}
+# file generation parameters that change the generated files, output directories are not part of the cache key
+CACHE_KEY_PARAMETERS = ["layer_list", "shrinkage_correction", "slice_angle_tilt_correction",
+                        "align_morph_to_layer_drawings"]
+# digests of larger files (the HDF5 lookup volumes) are remembered by path, size and modification time, so they are
+# only read in full when they changed
+FULL_HASH_MAX_BYTES = 64 * 1024 ** 2
+HASH_BLOCK_SIZE = 1024 ** 2
+DIGEST_MEMO_FILE_NAME = "content_digests.json"
+_digest_memo = {}
+
+
+class IO_Schema(ags.ArgSchema):
+    action = ags.fields.Str(default="stats",
+                            description="store: add the generated files of specimens to the cache, stats: print "
+                                        "cache statistics, evict: shrink the cache to max_cache_gb")
+    cache_dir = ags.fields.Str(description="swc cache directory")
+    max_cache_gb = ags.fields.Float(default=None, allow_none=True,
+                                    description="least recently used entries are evicted beyond this size")
+    key_file = ags.fields.Str(default=None, allow_none=True,
+                              description="tab separated specimen id and cache key, written by run_features")
+    specimen_id = ags.fields.Str(default=None, allow_none=True, description="specimen to store")
+    specimen_id_file = ags.fields.Str(default=None, allow_none=True, description="txt file with specimens to store")
+    upright_swc_dir = ags.fields.Str(default=None, allow_none=True, description="Directory with upright swc files")
+    aligned_swc_dir = ags.fields.Str(default=None, allow_none=True,
+                                     description="Directory with layer-aligned swc files")
+    qc_image_dir = ags.fields.Str(default=None, allow_none=True, description="Directory with qc images")
+
+
+def hash_file(file_path, size):
+    digest = hashlib.sha1(str(size).encode("utf-8"))
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_digest_memo(memo_file):
+    try:
+        with open(memo_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def content_digest(file_path, memo_dir=None):
+    """
+    sha1 of a file's content. Files larger than FULL_HASH_MAX_BYTES are read in full once, their digest is remembered
+    by path, size and modification time in this process and, with memo_dir, in memo_dir/content_digests.json for later
+    runs. A rewritten file gets a new modification time and is hashed again.
+
+    :param file_path: (str): path to file
+    :param memo_dir: (str): directory to remember the digests of large files in
+    :return: (str) hex digest, or None if the file does not exist
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    if file_stat.st_size <= FULL_HASH_MAX_BYTES:
+        return hash_file(file_path, file_stat.st_size)
+
+    memo_key = f"{os.path.abspath(file_path)}\t{file_stat.st_size}\t{file_stat.st_mtime_ns}"
+    if memo_key in _digest_memo:
+        return _digest_memo[memo_key]
+    memo_file = None if memo_dir is None else os.path.join(memo_dir, DIGEST_MEMO_FILE_NAME)
+    memo = {} if memo_file is None else load_digest_memo(memo_file)
+    digest = memo.get(memo_key)
+    if digest is None:
+        digest = hash_file(file_path, file_stat.st_size)
+        if memo_file is not None:
+            # earlier digests of the same path are stale
+            path_prefix = f"{os.path.abspath(file_path)}\t"
+            memo = {key: value for key, value in memo.items() if not key.startswith(path_prefix)}
+            memo[memo_key] = digest
+            os.makedirs(memo_dir, exist_ok=True)
+            tmp_file = f"{memo_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(memo, f, indent=2)
+            os.replace(tmp_file, memo_file)
+    _digest_memo[memo_key] = digest
+    return digest
+
+
+def file_gen_cache_keys(specimen_ids, file_gen_kwargs, swc_files=None, max_workers=16, digest_memo_dir=None):
+    """
+    Cache key of every specimen's file generation outputs. The key hashes the specimen id, the content of its raw swc
+    and polygon json, the content of the layer depths and surface lookup files and the correction parameters.
+
+    :param specimen_ids: (list): specimen ids
+    :param file_gen_kwargs: (dict): see file_generation.file_gen_command_args
+    :param swc_files: (dict): specimen id -> raw swc path, for raw swc files that are pulled from the database
+    :param max_workers: (int): number of files hashed at once
+    :param digest_memo_dir: (str): see content_digest
+    :return: (dict) specimen id -> key, specimens without a known raw swc file are left out
+    """
+    shared_digests = {}
+    for name in ["layer_depths_file", "surface_paths_file", "closest_surface_voxel_file"]:
+        if file_gen_kwargs[name] is not None:
+            shared_digests[name] = content_digest(file_gen_kwargs[name], memo_dir=digest_memo_dir)
+    params = {k: file_gen_kwargs[k] for k in CACHE_KEY_PARAMETERS}
+
+    def specimen_key(sp_id):
+        paths = file_gen_paths(sp_id, **file_gen_kwargs)
+        raw_swc_file = paths["raw_swc_file"] or (swc_files or {}).get(sp_id)
+        swc_digest = content_digest(raw_swc_file) if raw_swc_file is not None else None
+        if swc_digest is None:
+            return None
+        polygon_digest = None
+        if paths["polygon_json"] is not None:
+            polygon_digest = content_digest(paths["polygon_json"])
+            if polygon_digest is None:
+                return None
+        return hash_parameters({"specimen_id": sp_id, "raw_swc": swc_digest, "polygon_json": polygon_digest,
+                                **shared_digests, **params})
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        keys = dict(zip(specimen_ids, pool.map(specimen_key, specimen_ids)))
+    return {sp_id: key for sp_id, key in keys.items() if key is not None}
+
+
+def write_key_file(key_file, keys):
+    with open(key_file, "w") as f:
+        for sp_id, key in keys.items():
+            f.write(f"{sp_id}\t{key}\n")
+
+
+def read_key_file(key_file):
+    keys = {}
+    with open(key_file, "r") as f:
+        for line in f:
+            if line.strip():
+                sp_id, key = line.split()
+                keys[sp_id] = key
+    return keys
+
+
+def unlink_shared_outputs(file_paths):
+    """
+    Remove output files that are hard links into the cache, so regenerating a specimen writes new files instead of
+    truncating the cached ones
+
+    :param file_paths: (list): output files about to be regenerated
+    :return: None
+    """
+    for file_path in file_paths:
+        try:
+            if os.stat(file_path).st_nlink > 1:
+                os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+class SwcCache:
+    """
+    Content addressed cache of upright swc, layer-aligned swc and qc image files shared between output directories.
+    Entries live in cache_dir/objects/<key[:2]>/<key>/ and are indexed in a sqlite database that tracks their size,
+    last use and hit/miss counts. Cached files are read only and handed out as hard links (copies across file systems).
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: (str): cache directory, created if it does not exist
+        :param max_bytes: (int): least recently used entries are evicted beyond this size, None for no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        # many jobs store entries at the same time, wait for their writes instead of failing
+        self.connection = sqlite3.connect(os.path.join(cache_dir, CACHE_INDEX_FILE_NAME), timeout=300)
+        self.connection.executescript("""
+            create table if not exists entries (
+                key text primary key,
+                specimen_id text,
+                n_bytes integer,
+                created_at real,
+                last_used_at real,
+                hits integer
+            );
+            create table if not exists counters (
+                name text primary key,
+                value integer
+            );
+        """)
+        self.connection.commit()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, "objects", key[:2], key)
+
+    def _increment(self, name, value):
+        self.connection.execute("insert into counters (name, value) values (?, ?) "
+                                "on conflict(name) do update set value = value + excluded.value", (name, value))
+
+    def lookup(self, keys):
+        """
+        :param keys: (dict): specimen id -> cache key
+        :return: (dict) specimen id -> cache key of the specimens that are in the cache
+        """
+        cached_keys = set()
+        key_list = list(set(keys.values()))
+        for batch_start in range(0, len(key_list), 500):
+            batch = key_list[batch_start:batch_start + 500]
+            rows = self.connection.execute("select key from entries where key in ({})".format(
+                ", ".join("?" * len(batch))), batch).fetchall()
+            cached_keys.update(row[0] for row in rows)
+
+        hits = {sp_id: key for sp_id, key in keys.items()
+                if (key in cached_keys) and os.path.isdir(self.entry_dir(key))}
+        now = time.time()
+        self.connection.executemany("update entries set last_used_at = ?, hits = hits + 1 where key = ?",
+                                    [(now, key) for key in hits.values()])
+        self._increment("hits", len(hits))
+        self._increment("misses", len(keys) - len(hits))
+        self.connection.commit()
+        return hits
+
+    def restore(self, key, output_files):
+        """
+        Link (or copy) a cache entry's files into place. Another run can evict the entry after it was looked up, then
+        the files restored so far are removed again and the specimen has to be generated.
+
+        :param key: (str): cache key
+        :param output_files: (dict): file_gen_paths output (ur_file, la_file, qc_image_file) -> destination path
+        :return: (bool) True if every file was restored
+        """
+        entry_dir = self.entry_dir(key)
+        try:
+            for output, file_name in CACHED_OUTPUTS.items():
+                dst = output_files[output]
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                try:
+                    # the link shares the cached file's inode, so its mtime is left alone (see RunManifest.record)
+                    os.link(os.path.join(entry_dir, file_name), dst)
+                except OSError:
+                    # other file system, or a cache entry owned by someone else
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    shutil.copyfile(os.path.join(entry_dir, file_name), dst)
+        except FileNotFoundError:
+            if os.path.isdir(entry_dir):
+                raise
+            for restored_file in output_files.values():
+                if os.path.lexists(restored_file):
+                    os.remove(restored_file)
+            return False
+        return True
+
+    def store(self, key, specimen_id, output_files):
+        """
+        Copy generated files into the cache, they are moved into place in one rename so readers never see a partial
+        entry
+
+        :return: (bool) True if a new entry was added
+        """
+        entry_dir = self.entry_dir(key)
+        if os.path.isdir(entry_dir):
+            self.connection.execute("update entries set last_used_at = ? where key = ?", (time.time(), key))
+            self.connection.commit()
+            return False
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        n_bytes = 0
+        for output, file_name in CACHED_OUTPUTS.items():
+            cached_file = os.path.join(tmp_dir, file_name)
+            shutil.copyfile(output_files[output], cached_file)
+            os.chmod(cached_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            n_bytes += os.path.getsize(cached_file)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another job stored the same key first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+
+        now = time.time()
+        self.connection.execute("insert or replace into entries (key, specimen_id, n_bytes, created_at, last_used_at, "
+                                "hits) values (?, ?, ?, ?, ?, 0)", (key, str(specimen_id), n_bytes, now, now))
+        self._increment("stores", 1)
+        self.connection.commit()
+        return True
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within max_bytes
+
+        :return: (int) number of evicted entries
+        """
+        if self.max_bytes is None:
+            return 0
+        total_bytes = self.connection.execute("select coalesce(sum(n_bytes), 0) from entries").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return 0
+
+        evicted_keys = []
+        for key, n_bytes in self.connection.execute("select key, n_bytes from entries order by last_used_at"):
+            if total_bytes <= self.max_bytes:
+                break
+            evicted_keys.append(key)
+            total_bytes -= n_bytes
+        # entries leave the index before their files, so lookups of other runs no longer find them
+        self.connection.executemany("delete from entries where key = ?", [(key,) for key in evicted_keys])
+        self._increment("evictions", len(evicted_keys))
+        self.connection.commit()
+        for key in evicted_keys:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        return len(evicted_keys)
+
+    def stats(self):
+        """
+        :return: (dict) with keys entries, bytes, max_bytes, hits, misses, stores, evictions and hit_rate
+        """
+        n_entries, n_bytes = self.connection.execute(
+            "select count(*), coalesce(sum(n_bytes), 0) from entries").fetchone()
+        counters = dict(self.connection.execute("select name, value from counters").fetchall())
+        stats = {"entries": n_entries, "bytes": n_bytes, "max_bytes": self.max_bytes}
+        for name in ["hits", "misses", "stores", "evictions"]:
+            stats[name] = counters.get(name, 0)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+        return stats
+
+    def close(self):
+        self.connection.close()
+
+
+def store_generated_files(cache, key_file, specimen_ids, upright_swc_dir, aligned_swc_dir, qc_image_dir):
+    """
+    Add the files generated for specimens to the cache. Files older than the key file were not written by this run
+    (e.g. a step failed for the specimen) and are not stored.
+
+    :param cache: (SwcCache): cache to store in
+    :param key_file: (str): see write_key_file
+    :param specimen_ids: (list): specimen ids
+    :return: (int) number of new cache entries, (list) specimens whose files were not generated
+    """
+    keys = read_key_file(key_file)
+    planned_at_ns = os.stat(key_file).st_mtime_ns
+    n_stored = 0
+    not_generated = []
+    for sp_id in specimen_ids:
+        sp_id = str(sp_id)
+        if sp_id not in keys:
+            continue
+        paths = file_gen_paths(sp_id, upright_swc_dir, aligned_swc_dir, qc_image_dir, None, None)
+        output_files = {output: paths[output] for output in CACHED_OUTPUTS}
+        try:
+            is_new = all(os.stat(f).st_mtime_ns >= planned_at_ns for f in output_files.values())
+        except FileNotFoundError:
+            is_new = False
+        if not is_new:
+            print(f"Not caching {sp_id}, its files were not generated by this run")
+            not_generated.append(sp_id)
+            continue
+        n_stored += cache.store(keys[sp_id], sp_id, output_files)
+    cache.evict()
+    return n_stored, not_generated
+
+
+def swc_cache_store_command(specimen_id, swc_cache_dir, swc_cache_key_file, max_swc_cache_gb, upright_swc_dir,
+                            aligned_swc_dir, qc_image_dir, **kwargs):
+    """
+    Command that adds the files generated for one specimen to the cache
+
+    :param specimen_id: (str): specimen id, or a shell variable that resolves to one at run time
+    :param kwargs: other file generation parameters are ignored
+    :return: (str) command to execute in a job file
+    """
+    store_kwargs = {"action": "store", "cache_dir": swc_cache_dir, "key_file": swc_cache_key_file,
+                    "specimen_id": specimen_id, "upright_swc_dir": upright_swc_dir, "aligned_swc_dir": aligned_swc_dir,
+                    "qc_image_dir": qc_image_dir, "max_cache_gb": max_swc_cache_gb}
+    return shell_command("swc_cache", command_argv(store_kwargs))
+
+
+def print_stats(stats):
+    print(f"Entries: {stats['entries']}")
+    size_gb = stats["bytes"] / 1024 ** 3
+    if stats["max_bytes"] is not None:
+        print(f"Size: {size_gb:.2f} of {stats['max_bytes'] / 1024 ** 3:.2f} GB")
+    else:
+        print(f"Size: {size_gb:.2f} GB")
+    hit_rate = "-" if stats["hit_rate"] is None else f"{100 * stats['hit_rate']:.1f}%"
+    print(f"Hits: {stats['hits']}  Misses: {stats['misses']}  Hit rate: {hit_rate}")
+    print(f"Stored: {stats['stores']}  Evicted: {stats['evictions']}")
+
+
+def main(action, cache_dir, max_cache_gb, key_file, specimen_id, specimen_id_file, upright_swc_dir, aligned_swc_dir,
+         qc_image_dir, **kwargs):
+    if action not in ["store", "stats", "evict"]:
+        raise ValueError(f"--action must be store, stats or evict, you have set it to {action}")
+
+    max_bytes = None if max_cache_gb is None else int(max_cache_gb * 1024 ** 3)
+    cache = SwcCache(cache_dir, max_bytes=max_bytes)
+    not_generated = []
+    if action == "store":
+        if key_file is None:
+            raise ValueError("--action store needs a --key_file")
+        specimen_ids = [specimen_id] if specimen_id is not None else []
+        if specimen_id_file is not None:
+            specimen_ids += [str(sp_id) for sp_id in np.loadtxt(specimen_id_file, dtype=str, ndmin=1)]
+        n_stored, not_generated = store_generated_files(cache, key_file, specimen_ids, upright_swc_dir,
+                                                        aligned_swc_dir, qc_image_dir)
+        print(f"Stored {n_stored} of {len(specimen_ids)} specimens in {cache_dir}")
+    elif action == "evict":
+        print(f"Evicted {cache.evict()} entries from {cache_dir}")
+    print_stats(cache.stats())
+    cache.close()
+
+    # the store step is the last command of a file generation job, keep the job failed when the files were not made
+    if not_generated:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
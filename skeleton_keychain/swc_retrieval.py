@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import os
+
+# well_known_file_type_id of manually traced reconstruction swc files in LIMS
+SWC_FILE_TYPE_ID = 303941301
+
+
+def default_query_engine():
+    """LIMS query engine from skeleton_keys, imported here so runs that never touch LIMS don't load database drivers"""
+    from skeleton_keys.database_queries import default_query_engine as sk_default_query_engine
+    return sk_default_query_engine()
+
+
+def query_for_swc_files(specimen_ids, query_engine=None):
+    """
+    Look up the swc file of every specimen in a single database query
+
+    :param specimen_ids: (list): specimen ids
+    :param query_engine: callable that takes a sql string and returns a list of dict-like rows. Defaults to the
+    skeleton_keys LIMS engine, a local stand-in can be passed instead (e.g. in tests)
+    :return: (dict) specimen id (str) -> swc file path, specimens without a swc file are left out
+    """
+    if query_engine is None:
+        query_engine = default_query_engine()
+
+    specimen_id_list = ", ".join([str(int(sp_id)) for sp_id in specimen_ids])
+    query = f"""
+        select distinct on (nr.specimen_id)
+            nr.specimen_id as specimen_id,
+            wkf.filename as filename,
+            wkf.storage_directory as storage_directory
+        from neuron_reconstructions nr
+        join well_known_files wkf on wkf.attachable_id = nr.id
+            and wkf.attachable_type = 'NeuronReconstruction'
+            and wkf.well_known_file_type_id = {SWC_FILE_TYPE_ID}
+        where nr.specimen_id in ({specimen_id_list})
+            and nr.manual and not nr.superseded
+        order by nr.specimen_id, nr.id desc
+    """
+    results = query_engine(query)
+    return {str(r["specimen_id"]): os.path.join(r["storage_directory"], r["filename"]) for r in results}
+
+
+def is_same_file(src_path, dst_path):
+    """True when dst_path exists with the same size and modification time as src_path"""
+    if not os.path.exists(dst_path):
+        return False
+    src_stat, dst_stat = os.stat(src_path), os.stat(dst_path)
+    return (src_stat.st_size == dst_stat.st_size) and (int(src_stat.st_mtime) == int(dst_stat.st_mtime))
+
+
+def _copy_swc(src_path, dst_path):
+    if is_same_file(src_path, dst_path):
+        return "skipped"
+    shutil.copy2(src_path, dst_path)
+    return "copied"
+
+
+def retrieve_swc_files(specimen_ids, dst_dir, query_engine=None, max_workers=16, progress_interval=500):
+    """
+    Copy the swc file of every specimen from LIMS storage into dst_dir as <specimen id>.swc. Paths are looked up in one
+    query and copied by a bounded thread pool, files already in dst_dir with matching size/mtime are not copied again.
+
+    :param specimen_ids: (list): specimen ids
+    :param dst_dir: (str): directory to copy swc files into
+    :param query_engine: see query_for_swc_files
+    :param max_workers: (int): number of concurrent copies
+    :param progress_interval: (int): print progress every this many files
+    :return: (dict) with keys copied, skipped (lists of specimen ids) and failed (dict specimen id -> reason)
+    """
+    specimen_ids = [str(sp_id) for sp_id in specimen_ids]
+    swc_paths = query_for_swc_files(specimen_ids, query_engine=query_engine)
+
+    report = {"copied": [], "skipped": [], "failed": {}}
+    for sp_id in specimen_ids:
+        if sp_id not in swc_paths:
+            report["failed"][sp_id] = "no swc file found in database"
+    print(f"Found swc files for {len(specimen_ids) - len(report['failed'])} of {len(specimen_ids)} specimens in the "
+          f"database")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_copy_swc, swc_paths[sp_id], os.path.join(dst_dir, f"{sp_id}.swc")): sp_id
+            for sp_id in specimen_ids if sp_id in swc_paths
+        }
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            sp_id = futures[future]
+            try:
+                report[future.result()].append(sp_id)
+            except OSError as e:
+                report["failed"][sp_id] = f"copy failed: {e}"
+            if (n_done % progress_interval == 0) or (n_done == len(futures)):
+                print(f"Retrieved {n_done}/{len(futures)} swc files")
+
+    print(f"Copied {len(report['copied'])}, already present {len(report['skipped'])}, "
+          f"failed {len(report['failed'])}")
+    for sp_id, reason in report["failed"].items():
+        print(f"  {sp_id}: {reason}")
+
+    return report
@@ -0,0 +1,97 @@
+from concurrent.futures import ProcessPoolExecutor
+import time
+import sys
+import os
+import argschema as ags
+from skeleton_keychain.swc_arrays import read_swc_sidecar, write_swc_sidecar
+from skeleton_keychain.file_generation import command_argv, shell_command
+
+
+class IO_Schema(ags.ArgSchema):
+    swc_files = ags.fields.List(ags.fields.Str, cli_as_single_argument=True, default=None, allow_none=True,
+                                description="swc files to write sidecars for")
+    swc_dirs = ags.fields.List(ags.fields.Str, cli_as_single_argument=True, default=None, allow_none=True,
+                               description="directories whose swc files get sidecars")
+    n_workers = ags.fields.Int(default=1, description="number of swc files converted at once")
+    overwrite = ags.fields.Boolean(default=False, description="If true, rewrite sidecars that are current")
+
+
+def swc_sidecars_command(swc_files=None, swc_dirs=None, n_workers=1):
+    """
+    :return: (str) command that writes the binary sidecars of swc files, see skeleton_keychain.swc_arrays
+    """
+    return shell_command("swc_sidecars", command_argv({
+        "swc_files": list(swc_files) if swc_files else None,
+        "swc_dirs": list(swc_dirs) if swc_dirs else None,
+        "n_workers": n_workers if n_workers != 1 else None,
+    }))
+
+
+def list_swc_files(swc_dir):
+    with os.scandir(swc_dir) as entries:
+        return sorted(entry.path for entry in entries if entry.is_file() and entry.name.endswith(".swc"))
+
+
+def _convert(swc_file):
+    """:return: (str) problem or None"""
+    try:
+        write_swc_sidecar(swc_file)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def convert_swc_files(swc_files, n_workers=1, overwrite=False):
+    """
+    Write the binary sidecar of every swc file that has no current one
+
+    :param swc_files: (list): swc files
+    :param n_workers: (int): number of processes converting files
+    :param overwrite: (bool): also rewrite current sidecars
+    :return: (dict) with keys converted, current (lists of swc files) and failed (dict swc file -> reason)
+    """
+    report = {"converted": [], "current": [], "failed": {}}
+    to_convert = []
+    for swc_file in swc_files:
+        if (not overwrite) and (read_swc_sidecar(swc_file) is not None):
+            report["current"].append(swc_file)
+        else:
+            to_convert.append(swc_file)
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            problems = list(pool.map(_convert, to_convert, chunksize=16))
+    else:
+        problems = [_convert(swc_file) for swc_file in to_convert]
+
+    for swc_file, problem in zip(to_convert, problems):
+        if problem is None:
+            report["converted"].append(swc_file)
+        else:
+            report["failed"][swc_file] = problem
+    return report
+
+
+def main(swc_files, swc_dirs, n_workers, overwrite, **kwargs):
+    start_time = time.time()
+    all_swc_files = list(swc_files or [])
+    for swc_dir in swc_dirs or []:
+        all_swc_files.extend(list_swc_files(swc_dir))
+
+    report = convert_swc_files(all_swc_files, n_workers=n_workers, overwrite=overwrite)
+    print(f"Wrote {len(report['converted'])} swc sidecars, {len(report['current'])} already current, "
+          f"{len(report['failed'])} failed ({time.time() - start_time:.1f}s)")
+    for swc_file, problem in report["failed"].items():
+        print(f"  {swc_file}: {problem}")
+    if report["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
+
+
+def console_script():
+    module = ags.ArgSchemaParser(schema_type=IO_Schema)
+    main(**module.args)
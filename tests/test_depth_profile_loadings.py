@@ -0,0 +1,42 @@
+import os
+import numpy as np
+import pytest
+from skeleton_keychain import depth_profile_loadings
+
+
+def write_depth_profiles(path, profiles):
+    n_bins = len(next(iter(profiles.values()))) // 2
+    with open(path, "w") as f:
+        f.write(",".join(["specimen_id"] + [f"{node_type}_{b}" for node_type in [2, 3] for b in range(n_bins)]) + "\n")
+        for sp_id, row in profiles.items():
+            f.write(",".join([sp_id] + [str(v) for v in row]) + "\n")
+
+
+def test_fit_over_cohort(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    profiles = {str(sp_id): rng.random(8) for sp_id in range(100, 110)}
+    profile_file = os.path.join(str(tmp_path), "AlignedHistogram.csv")
+    write_depth_profiles(profile_file, profiles)
+    specimen_id_file = os.path.join(str(tmp_path), "specimen_ids.txt")
+    cohort = [str(sp_id) for sp_id in range(100, 108)]
+    np.savetxt(specimen_id_file, cohort, fmt="%s")
+
+    fitted = []
+    monkeypatch.setattr(depth_profile_loadings, "fit_loadings",
+                        lambda compartment_profiles: fitted.append(compartment_profiles) or np.eye(4)[:, :2])
+    loadings_file = os.path.join(str(tmp_path), "basal_dendrite_depth_profile_loadings.csv")
+    depth_profile_loadings.main(specimen_id_file, profile_file, basal_dendrite_loadings_file=loadings_file)
+
+    assert len(fitted) == 1
+    np.testing.assert_allclose(fitted[0], np.array([profiles[sp_id][4:] for sp_id in cohort]))
+    np.testing.assert_allclose(np.loadtxt(loadings_file, delimiter=","), np.eye(4)[:, :2])
+
+
+def test_missing_profiles(tmp_path):
+    profile_file = os.path.join(str(tmp_path), "AlignedHistogram.csv")
+    write_depth_profiles(profile_file, {"100": [0.0] * 4})
+    with pytest.raises(ValueError):
+        depth_profile_loadings.load_depth_profiles(profile_file, ["100", "101"])
+    header, _ = depth_profile_loadings.load_depth_profiles(profile_file, ["100"])
+    with pytest.raises(ValueError):
+        depth_profile_loadings.compartment_columns(header, "apical_dendrite")
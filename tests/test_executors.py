@@ -0,0 +1,180 @@
+import json
+import time
+import os
+import pytest
+from skeleton_keychain import executors
+from skeleton_keychain.executors import LocalExecutor, SlurmExecutor, SubmissionError, TokenBucket, get_executor, \
+    parse_sbatch_job_id
+
+
+def write_job_file(job_dir, name, commands, directives=None):
+    job_file = os.path.join(job_dir, f"{name}.sh")
+    directives = dict({"--output": os.path.join(job_dir, f"{name}_%j.out")}, **(directives or {}))
+    with open(job_file, "w") as f:
+        f.write("#!/bin/bash\n")
+        for k, v in directives.items():
+            f.write(f"#SBATCH {k}={v}\n")
+        f.write("\n".join(commands) + "\n")
+    return job_file
+
+
+def read_accounting(accounting_file):
+    with open(accounting_file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_local_dag_dependencies(tmp_path):
+    job_dir = str(tmp_path)
+    accounting_file = os.path.join(job_dir, "local_accounting.jsonl")
+    executor = LocalExecutor(max_cpus=2, poll_interval=0.05, accounting_file=accounting_file, job_id_prefix="run1-")
+
+    marker = os.path.join(job_dir, "first.txt")
+    first = executor.submit(write_job_file(job_dir, "first", [f"echo first > {marker}"]), [], "afterok")
+    second = executor.submit(write_job_file(job_dir, "second", [f"cat {marker}"]), [first], "afterok")
+    failing = executor.submit(write_job_file(job_dir, "failing", ["exit 3"]), [], "afterok")
+    after_ok = executor.submit(write_job_file(job_dir, "after_ok", ["echo never"]), [failing], "afterok")
+    after_any = executor.submit(write_job_file(job_dir, "after_any", ["echo anyway"]), [failing], "afterany")
+    array_directives = {"--array": "0-2%2", "--output": os.path.join(job_dir, "array_%A_%a.out")}
+    array = executor.submit(write_job_file(job_dir, "array", ["echo $SLURM_ARRAY_TASK_ID"], array_directives),
+                            [second], "afterok")
+
+    assert [first, second, failing, after_ok, after_any, array] == [f"run1-{i}" for i in range(1, 7)]
+
+    states = executor.wait()
+    assert states == {
+        first: "COMPLETED",
+        second: "COMPLETED",
+        failing: "FAILED",
+        after_ok: "CANCELLED",
+        after_any: "COMPLETED",
+        array: "COMPLETED",
+    }
+
+    with open(os.path.join(job_dir, f"second_{second}.out"), "r") as f:
+        assert f.read().strip() == "first"
+    for task_id in range(3):
+        with open(os.path.join(job_dir, f"array_{array}_{task_id}.out"), "r") as f:
+            assert f.read().strip() == str(task_id)
+
+    records = {r["job_id"]: r for r in read_accounting(accounting_file)}
+    assert set(records) == {first, second, failing, after_ok, after_any} | {f"{array}_{t}" for t in range(3)}
+    assert records[failing]["exit_code"] == "3:0"
+    assert records[after_ok]["state"] == "CANCELLED"
+    assert records[f"{array}_1"]["parent_job_id"] == array
+    assert all(r["elapsed_s"] >= 0 for r in records.values() if r["state"] == "COMPLETED")
+
+
+def test_local_job_id_prefix_separates_runs(tmp_path):
+    job_dir = str(tmp_path)
+    accounting_file = os.path.join(job_dir, "local_accounting.jsonl")
+    job_ids = []
+    for run_id in [1, 2]:
+        executor = get_executor("local", max_cpus=1, poll_interval=0.05, accounting_file=accounting_file,
+                                job_id_prefix=f"run{run_id}-")
+        job_ids.append(executor.submit(write_job_file(job_dir, f"run{run_id}", ["true"]), [], "afterok"))
+        executor.wait()
+
+    assert job_ids == ["run1-1", "run2-1"]
+    assert [r["job_id"] for r in read_accounting(accounting_file)] == job_ids
+
+
+def test_local_unknown_parent(tmp_path):
+    executor = LocalExecutor(max_cpus=1)
+    with pytest.raises(ValueError):
+        executor.submit(write_job_file(str(tmp_path), "orphan", ["true"]), ["run1-7"], "afterok")
+
+
+def fake_sbatch(bin_dir, responses, monkeypatch):
+    """
+    Put an sbatch on the PATH that logs its arguments and answers the n-th call with the n-th (exit code, stdout,
+    stderr) of responses, the last one is repeated
+    """
+    calls_file = os.path.join(bin_dir, "sbatch_calls.log")
+    cases = "".join(f"  {call_idx + 1}) echo '{std_out}'; echo '{std_err}' >&2; exit {return_code};;\n"
+                    for call_idx, (return_code, std_out, std_err) in enumerate(responses[:-1]))
+    return_code, std_out, std_err = responses[-1]
+    cases += f"  *) echo '{std_out}'; echo '{std_err}' >&2; exit {return_code};;\n"
+    sbatch = os.path.join(bin_dir, "sbatch")
+    with open(sbatch, "w") as f:
+        f.write(f'#!/bin/bash\necho "$@" >> {calls_file}\ncase $(wc -l < {calls_file}) in\n{cases}esac\n')
+    os.chmod(sbatch, 0o755)
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+    return calls_file
+
+
+def read_calls(calls_file):
+    with open(calls_file, "r") as f:
+        return f.read().splitlines()
+
+
+def test_parse_sbatch_job_id():
+    assert parse_sbatch_job_id("Submitted batch job 123\n") == "123"
+    assert parse_sbatch_job_id("456\n") == "456"
+    assert parse_sbatch_job_id("789;cluster1\n") == "789"
+    with pytest.raises(SubmissionError):
+        parse_sbatch_job_id("sbatch: error: Batch job submission failed: Invalid account\n")
+    with pytest.raises(SubmissionError):
+        parse_sbatch_job_id("")
+
+
+def test_sbatch_parsable_cluster_output(tmp_path, monkeypatch):
+    calls_file = fake_sbatch(str(tmp_path), [(0, "77;cluster1", "")], monkeypatch)
+    executor = SlurmExecutor()
+
+    job_id = executor.submit("job.sh", ["10", "11"], "afterok", array_spec="0-3%2")
+    assert job_id == "77"
+    assert read_calls(calls_file) == ["--array=0-3%2 --dependency=afterok:10:11 job.sh"]
+
+
+def test_sbatch_error_is_not_retried(tmp_path, monkeypatch):
+    calls_file = fake_sbatch(str(tmp_path), [(1, "", "sbatch: error: Batch job submission failed: Invalid account")],
+                             monkeypatch)
+    executor = SlurmExecutor(retry_backoff=0.01)
+
+    with pytest.raises(SubmissionError, match="Invalid account"):
+        executor.submit("job.sh", [], "afterok")
+    assert len(read_calls(calls_file)) == 1
+
+
+def test_sbatch_transient_error_is_retried(tmp_path, monkeypatch):
+    socket_error = "sbatch: error: Socket timed out on send/recv operation"
+    calls_file = fake_sbatch(str(tmp_path), [(1, "", socket_error), (1, "", socket_error),
+                                             (0, "Submitted batch job 42", "")], monkeypatch)
+    sleeps = []
+    monkeypatch.setattr(executors.time, "sleep", sleeps.append)
+    executor = SlurmExecutor(retry_backoff=1.0, max_retry_backoff=1.5)
+
+    assert executor.submit("job.sh", [], "afterok") == "42"
+    assert len(read_calls(calls_file)) == 3
+    # the backoff doubles on every retry up to max_retry_backoff, with jitter of +-50%
+    assert 0.5 <= sleeps[0] <= 1.5
+    assert 0.75 <= sleeps[1] <= 2.25
+
+
+def test_sbatch_transient_error_gives_up(tmp_path, monkeypatch):
+    calls_file = fake_sbatch(str(tmp_path), [(1, "", "sbatch: error: Slurm temporarily unable to accept job")],
+                             monkeypatch)
+    monkeypatch.setattr(executors.time, "sleep", lambda seconds: None)
+    executor = SlurmExecutor(max_submit_retries=2)
+
+    with pytest.raises(SubmissionError, match="temporarily unable to accept job"):
+        executor.submit("job.sh", [], "afterok")
+    assert len(read_calls(calls_file)) == 3
+
+
+def test_token_bucket():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+    bucket = TokenBucket(rate=20, capacity=3)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    burst_s = time.monotonic() - start
+    for _ in range(4):
+        bucket.acquire()
+    total_s = time.monotonic() - start
+
+    # the burst goes through at once, the next 4 tokens refill at 20 per second
+    assert burst_s < 0.1
+    assert total_s >= 0.15
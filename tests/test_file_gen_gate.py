@@ -0,0 +1,157 @@
+import os
+import json
+import shlex
+import stat
+import pytest
+from skeleton_keychain import file_gen_gate
+from skeleton_keychain.SlurmDAG import Slurm_DAG
+from skeleton_keychain.executors import LocalExecutor
+from skeleton_keychain.file_gen_gate import GATE_FILE_NAME, add_linked_job_id, redirect_dependencies
+from skeleton_keychain.job_tracking import JobDatabase, LOCAL_ACCOUNTING_FILE_NAME
+from skeleton_keychain.manifest import RunManifest
+from skeleton_keychain.shared_file_gen import SharedFileGen, link_outputs_command
+from skeleton_keychain.swc_cache import CACHED_OUTPUTS
+
+
+def test_link_jobs_follow_the_owner_gate(tmp_path, monkeypatch):
+    gate_file = os.path.join(str(tmp_path), "file_gen_gate.json")
+    with open(gate_file, "w") as f:
+        json.dump({"gate_node_id": 3, "downstream_node_ids": [4]}, f)
+    output_files = {"123": {output: f"/owner/123_{file_name}" for output, file_name in CACHED_OUTPUTS.items()}}
+    shared = SharedFileGen()
+    shared.register({"123": "ab12"}, output_files, {"123": "1003"}, gate_file=gate_file)
+    owner = shared.lookup({"456": "ab12"})["456"]
+    assert (owner["job_id"], owner["gate_file"]) == ("1003", gate_file)
+
+    add_linked_job_id(owner["gate_file"], 2004)
+    add_linked_job_id(owner["gate_file"], 3004)
+    with open(gate_file, "r") as f:
+        gate = json.load(f)
+    assert gate["linked_job_ids"] == ["2004", "3004"]
+    assert gate["downstream_node_ids"] == [4]
+
+    # a fake scontrol records the dependency updates
+    bin_dir = os.path.join(str(tmp_path), "bin")
+    os.makedirs(bin_dir)
+    scontrol = os.path.join(bin_dir, "scontrol")
+    with open(scontrol, "w") as f:
+        f.write(f'#!/bin/bash\necho "$@" >> {os.path.join(str(tmp_path), "scontrol.log")}\n')
+    os.chmod(scontrol, os.stat(scontrol).st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+    redirect_dependencies(gate["linked_job_ids"], "1010", start_condition="afterany")
+    with open(os.path.join(str(tmp_path), "scontrol.log"), "r") as f:
+        assert f.read().splitlines() == ["update JobId=2004 Dependency=afterany:1010",
+                                         "update JobId=3004 Dependency=afterany:1010"]
+
+
+def test_link_command_quoting():
+    assert shlex.split(link_outputs_command("/output dir/JobFiles/shared_file_gen_links.txt")) == [
+        "link_file_gen_outputs", "--link_file", "/output dir/JobFiles/shared_file_gen_links.txt"]
+
+
+def write_gate(output_dir, success_threshold):
+    """
+    A local run whose file generation only writes the outputs of 101, with a gate that retries 102 and 103 once
+    (the retry only recovers 102)
+    """
+    job_dir = os.path.join(output_dir, "JobFiles")
+    swc_dir = os.path.join(output_dir, "SWC_Upright")
+    os.makedirs(job_dir)
+    os.makedirs(swc_dir)
+    specimen_ids = ["101", "102", "103"]
+    output_files = {sp_id: [os.path.join(swc_dir, f"{sp_id}.swc")] for sp_id in specimen_ids}
+    manifest = RunManifest(output_dir)
+    for sp_id in specimen_ids:
+        manifest.record("file_gen", sp_id, [], {}, output_files[sp_id])
+    manifest.save()
+
+    id_file = os.path.join(job_dir, "file_gen.txt")
+    with open(id_file, "w") as f:
+        f.write("\n".join(specimen_ids) + "\n")
+
+    def write_output(succeeding_id):
+        return (f'if [ "${{SPECIMEN_ID}}" != "{succeeding_id}" ]; then exit 1; fi; '
+                f'echo swc > {swc_dir}/${{SPECIMEN_ID}}.swc')
+
+    nodes = [
+        {"id": 1, "parent_ids": [], "name": "file_gen", "stage": "file_gen",
+         "task_specimen_ids": [[sp_id] for sp_id in specimen_ids], "array": len(specimen_ids),
+         "job_file": os.path.join(job_dir, "file_gen.sh"),
+         "slurm_kwargs": {"--mem": "1gb", "--time": "10", "--output": os.path.join(job_dir, "file_gen_%a.out")},
+         "slurm_commands": [f'SPECIMEN_ID=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {id_file})',
+                            write_output("101")]},
+        {"id": 2, "parent_ids": [1], "start_condition": "afterany", "name": "file-gen-gate",
+         "stage": "file_gen_gate", "job_file": os.path.join(job_dir, "file_gen_gate_0.sh"),
+         "slurm_kwargs": {"--output": os.path.join(job_dir, "file_gen_gate_0.out")}, "slurm_commands": ["true"]},
+    ]
+    accounting_file = os.path.join(output_dir, LOCAL_ACCOUNTING_FILE_NAME)
+    executor = LocalExecutor(max_cpus=2, poll_interval=0.05, accounting_file=accounting_file, job_id_prefix="run1-")
+    job_db = JobDatabase(output_dir)
+    run_id = job_db.start_run("local", len(specimen_ids))
+    workflow = Slurm_DAG(nodes)
+    workflow.submit_dag_to_scheduler(executor=executor)
+    job_db.record_jobs(run_id, workflow)
+    executor.wait()
+    job_db.close()
+
+    gate_file = os.path.join(job_dir, GATE_FILE_NAME)
+    with open(gate_file, "w") as f:
+        json.dump({
+            "gate_file": gate_file, "gate_node_id": 2, "output_dir": output_dir, "job_dir": job_dir,
+            "executor": "local", "executor_kwargs": {"max_cpus": 2, "poll_interval": 0.05}, "job_id_prefix": "run1-",
+            "specimen_ids": specimen_ids, "output_files": output_files, "setup_commands": [],
+            "task_commands": [write_output("102")],
+            "slurm_kwargs": {"--mem": "1gb", "--time": "10", "--cpus-per-task": "1"}, "gate_slurm_kwargs": {},
+            "max_retries": 1, "memory_factor": 2.0, "time_factor": 1.5, "success_threshold": success_threshold,
+            "max_array_size": 10, "array_throttle": None, "downstream_node_ids": [],
+        }, f)
+    return gate_file, run_id
+
+
+def read_failures(failure_file):
+    with open(failure_file, "r") as f:
+        return [line.split("\t")[:2] for line in f.read().splitlines()[1:]]
+
+
+def test_gate_retries_failed_specimens(tmp_path):
+    output_dir = str(tmp_path)
+    gate_file, run_id = write_gate(output_dir, success_threshold=0.5)
+    file_gen_gate.main(gate_file, 0)
+
+    job_dir = os.path.join(output_dir, "JobFiles")
+    assert read_failures(os.path.join(job_dir, "file_gen_failures_attempt_0.txt")) == [["102", "FAILED"],
+                                                                                        ["103", "FAILED"]]
+    assert read_failures(os.path.join(job_dir, "file_gen_failures.txt")) == [["103", "FAILED"]]
+    assert os.path.exists(os.path.join(output_dir, "SWC_Upright", "102.swc"))
+
+    job_db = JobDatabase(output_dir)
+    retry_jobs = [job for job in job_db.get_jobs(run_id) if job["stage"] == "file_gen_retry"]
+    job_db.close()
+    assert len(retry_jobs) == 1
+    assert retry_jobs[0]["job_id"] == "run1-retry1-1"
+    assert retry_jobs[0]["task_specimen_ids"] == [["102"], ["103"]]
+    # the retry asks for memory_factor times the memory and time_factor times the time of the failed job
+    assert (retry_jobs[0]["mem_mb"], retry_jobs[0]["time_limit"]) == (2048, "15")
+
+
+def test_gate_fails_below_threshold(tmp_path):
+    output_dir = str(tmp_path)
+    gate_file, _ = write_gate(output_dir, success_threshold=0.9)
+    with pytest.raises(SystemExit) as e:
+        file_gen_gate.main(gate_file, 0)
+    assert e.value.code == 1
+    assert read_failures(os.path.join(output_dir, "JobFiles", "file_gen_failures.txt")) == [["103", "FAILED"]]
+
+
+def test_stale_outputs_fail(tmp_path):
+    output_dir = str(tmp_path)
+    gate_file, run_id = write_gate(output_dir, success_threshold=0.0)
+    with open(gate_file, "r") as f:
+        gate = json.load(f)
+    # outputs left from an earlier run are older than this run's submission
+    manifest = RunManifest(output_dir)
+    manifest.record("file_gen", "101", [], {}, gate["output_files"]["101"])
+    manifest.save()
+    job_db = JobDatabase(output_dir)
+    assert sorted(file_gen_gate.check_specimens(gate, job_db, run_id)) == ["101", "102", "103"]
+    job_db.close()
@@ -0,0 +1,116 @@
+import ast
+import os
+import subprocess
+import sys
+import argschema as ags
+import pytest
+from skeleton_keychain import process_specimen_chunk, swc_sidecars
+from skeleton_keychain.file_generation import SPECIES_LAYER_LISTS, layer_list_argument, file_gen_commands, \
+    file_gen_chunk_command, shell_command
+
+FILE_GEN_SCRIPTS = ["skelekeys-layer-aligned-swc", "skelekeys-upright-corrected-swc", "qc_swc_image"]
+
+
+def shell_argv(command, env=None):
+    """Command line arguments a job file's bash passes to the program of a command"""
+    program, _, args = command.partition(" ")
+    result = subprocess.run(["bash", "-c", f"printf '%s\\0' {args}"], env=env, capture_output=True, text=True,
+                            check=True)
+    return result.stdout.split("\0")[:-1]
+
+
+def argument(argv, name):
+    return argv[argv.index(f"--{name}") + 1]
+
+
+def file_gen_kwargs(output_dir, species):
+    for dir_name in ["Upright Swc", "LayerAligned Swc", "QC Images"]:
+        os.makedirs(os.path.join(output_dir, dir_name), exist_ok=True)
+    return {
+        "upright_swc_dir": os.path.join(output_dir, "Upright Swc"),
+        "aligned_swc_dir": os.path.join(output_dir, "LayerAligned Swc"),
+        "qc_image_dir": os.path.join(output_dir, "QC Images"),
+        "raw_orientation_swc_dir": None,
+        "polygon_json_dir": None,
+        "layer_depths_file": os.path.join(output_dir, "layer depths.json"),
+        "surface_paths_file": None,
+        "closest_surface_voxel_file": None,
+        "shrinkage_correction": True,
+        "slice_angle_tilt_correction": False,
+        "layer_list": layer_list_argument(species),
+        "align_morph_to_layer_drawings": None,
+    }
+
+
+@pytest.fixture
+def fake_console_scripts(monkeypatch):
+    """
+    Replace the file generation console scripts with ones that record their command line arguments, the skeleton_keys
+    scripts write a small swc file to their --output_file
+    """
+    calls = []
+
+    def fake_script(script_name):
+        calls.append((script_name, sys.argv[1:]))
+        if script_name != "qc_swc_image":
+            with open(argument(sys.argv, "output_file"), "w") as f:
+                f.write("1 1 0.0 0.0 0.0 5.0 -1\n2 3 0.0 -50.0 0.0 1.0 1\n3 3 10.0 -80.0 0.0 1.0 2\n")
+
+    for script_name in FILE_GEN_SCRIPTS:
+        monkeypatch.setitem(process_specimen_chunk._console_scripts, script_name,
+                            lambda script_name=script_name: fake_script(script_name))
+    return calls
+
+
+def test_shell_command_quoting():
+    argv = ["--specimen_id", "${SPECIMEN_ID}", "--output_file", "/out dir/${SPECIMEN_ID}.swc", "--layer_list",
+            layer_list_argument("mouse"), "--note", "it's \"quoted\"", "--flag", "True"]
+    command = shell_command("program", argv)
+    assert "--specimen_id \"${SPECIMEN_ID}\"" in command
+    assert shell_argv(command, env={"SPECIMEN_ID": "123"}) == [
+        "--specimen_id", "123", "--output_file", "/out dir/123.swc", "--layer_list", layer_list_argument("mouse"),
+        "--note", "it's \"quoted\"", "--flag", "True"]
+
+
+
+def test_swc_sidecars_command_quoting():
+    swc_dirs = ["/output dir/SWC_Upright", "/output dir/Bob's SWC_LayerAligned"]
+    argv = shell_argv(swc_sidecars.swc_sidecars_command(swc_dirs=swc_dirs, n_workers=8))
+    module = ags.ArgSchemaParser(schema_type=swc_sidecars.IO_Schema, args=argv)
+    assert (module.args["swc_dirs"], module.args["swc_files"], module.args["n_workers"]) == (swc_dirs, None, 8)
+
+@pytest.mark.parametrize("species", ["mouse", "human"])
+def test_file_gen_commands_layer_list(tmp_path, species):
+    kwargs = file_gen_kwargs(str(tmp_path), species)
+    commands = file_gen_commands("${SPECIMEN_ID}", swc_sidecars=True, **kwargs)
+    argv = {command.split(" ")[0]: shell_argv(command, env={"SPECIMEN_ID": "123"}) for command in commands}
+
+    layer_aligned_argv = argv["skelekeys-layer-aligned-swc"]
+    assert ast.literal_eval(argument(layer_aligned_argv, "layer_list")) == SPECIES_LAYER_LISTS[species]
+    assert argument(layer_aligned_argv, "output_file") == os.path.join(kwargs["aligned_swc_dir"], "123.swc")
+    assert ast.literal_eval(argument(argv["swc_sidecars"], "swc_files")) == [
+        os.path.join(kwargs["aligned_swc_dir"], "123.swc"), os.path.join(kwargs["upright_swc_dir"], "123.swc")]
+
+
+@pytest.mark.parametrize("species", ["mouse", "human"])
+def test_chunk_layer_list_round_trip(tmp_path, species, fake_console_scripts):
+    kwargs = file_gen_kwargs(str(tmp_path), species)
+    specimen_id_file = os.path.join(str(tmp_path), "chunk specimens.txt")
+    with open(specimen_id_file, "w") as f:
+        f.write("123\n456\n")
+
+    # the job file's shell hands the chunk command to process_specimen_chunk, which runs every script in process
+    chunk_argv = shell_argv(file_gen_chunk_command(specimen_id_file, **kwargs))
+    module = ags.ArgSchemaParser(schema_type=process_specimen_chunk.IO_Schema, args=chunk_argv)
+    assert module.args["layer_list"] == layer_list_argument(species)
+    process_specimen_chunk.main(**module.args)
+
+    assert [script_name for script_name, _ in fake_console_scripts] == FILE_GEN_SCRIPTS * 2
+    for script_name, argv in fake_console_scripts:
+        assert all(argv[idx].startswith("--") for idx in range(0, len(argv), 2))
+        if script_name == "skelekeys-layer-aligned-swc":
+            assert ast.literal_eval(argument(argv, "layer_list")) == SPECIES_LAYER_LISTS[species]
+            assert os.path.dirname(argument(argv, "output_file")) == kwargs["aligned_swc_dir"]
+        if script_name == "qc_swc_image":
+            assert argument(argv, "layer_depths_file") == kwargs["layer_depths_file"]
+
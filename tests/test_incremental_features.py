@@ -0,0 +1,121 @@
+import os
+import shlex
+import pytest
+import argschema as ags
+from skeleton_keychain import incremental_features
+from skeleton_keychain.incremental_features import plan_feature_increment, merge_feature_increment, \
+    load_feature_record
+
+HEADER = "specimen_id,feature,value\n"
+
+
+def write_long_table(long_file, values, header=HEADER):
+    with open(long_file, "w") as f:
+        f.write(header)
+        for sp_id, value in values.items():
+            f.write(f"{sp_id},axon_length,{value}\n{sp_id},soma_depth,{value}\n")
+    return long_file
+
+
+def read_long_table(long_file):
+    with open(long_file, "r") as f:
+        assert f.readline() == HEADER
+        return {line.split(",")[0]: float(line.split(",")[2]) for line in f}
+
+
+def write_ids(id_file, specimen_ids):
+    with open(id_file, "w") as f:
+        f.write("".join(f"{sp_id}\n" for sp_id in specimen_ids))
+    return id_file
+
+
+def write_swc(swc_dir, sp_id, n_nodes):
+    with open(os.path.join(swc_dir, f"{sp_id}.swc"), "w") as f:
+        f.write("".join(f"{i} 3 0 {i} 0 1 {i - 1 if i > 1 else -1}\n" for i in range(1, n_nodes + 1)))
+
+
+@pytest.fixture
+def first_run(tmp_path):
+    """Features of specimens 1-3 calculated straight into the long table and recorded"""
+    output_dir = str(tmp_path)
+    swc_dir = os.path.join(output_dir, "SWC_Upright")
+    os.makedirs(swc_dir)
+    for sp_id in ["1", "2", "3"]:
+        write_swc(swc_dir, sp_id, 5)
+    run = {"output_dir": output_dir, "swc_dirs": [swc_dir], "params_hash": "ab12",
+           "long_file": write_long_table(os.path.join(output_dir, "RawFeatureLong.csv"), {"1": 1, "2": 2, "3": 3}),
+           "record_file": os.path.join(output_dir, incremental_features.FEATURE_RECORD_FILE_NAME)}
+    id_file = write_ids(os.path.join(output_dir, "ids.txt"), ["1", "2", "3"])
+    incremental_features.main(id_file, id_file, None, None, run["long_file"], run["swc_dirs"], run["params_hash"],
+                              run["record_file"])
+    return run
+
+
+def plan(run, specimen_ids, params_hash=None, pending_specimen_ids=()):
+    return plan_feature_increment(specimen_ids, run["swc_dirs"], run["long_file"], run["record_file"],
+                                  params_hash or run["params_hash"], pending_specimen_ids=pending_specimen_ids)
+
+
+def test_new_changed_and_kept_specimens(first_run):
+    assert sorted(load_feature_record(first_run["record_file"])["specimens"]) == ["1", "2", "3"]
+    assert plan(first_run, ["1", "2", "3"]) == []
+
+    write_swc(first_run["swc_dirs"][0], "2", 8)
+    write_swc(first_run["swc_dirs"][0], "4", 5)
+    assert plan(first_run, ["1", "2", "3", "4"]) == ["2", "4"]
+    assert plan(first_run, ["1", "2", "3", "4"], pending_specimen_ids=["3"]) == ["2", "3", "4"]
+
+    # specimen 4 failed, it has no rows and is planned again by the next run
+    output_dir = first_run["output_dir"]
+    increment_file = write_long_table(os.path.join(output_dir, "increment.csv"), {"2": 20})
+    incremental_features.main(write_ids(os.path.join(output_dir, "all_ids.txt"), ["1", "2", "3", "4"]),
+                              write_ids(os.path.join(output_dir, "increment_ids.txt"), ["2", "4"]),
+                              [increment_file], first_run["long_file"], first_run["long_file"],
+                              first_run["swc_dirs"], first_run["params_hash"], first_run["record_file"])
+    assert read_long_table(first_run["long_file"]) == {"1": 1, "3": 3, "2": 20}
+    assert sorted(load_feature_record(first_run["record_file"])["specimens"]) == ["1", "2", "3"]
+    assert plan(first_run, ["1", "2", "3", "4"]) == ["4"]
+
+    # dropped specimens lose their rows
+    written = merge_feature_increment(first_run["long_file"], [], {"1"}, first_run["long_file"])
+    assert written == {"kept": {"1"}, "calculated": set()}
+    assert read_long_table(first_run["long_file"]) == {"1": 1}
+
+
+def test_record_invalidation(first_run):
+    assert plan(first_run, ["1", "2", "3"], params_hash="cd34") is None
+
+    # a long table rewritten outside of an incremental run can not be merged into
+    write_long_table(first_run["long_file"], {"1": 1, "2": 2, "3": 3, "5": 5})
+    assert plan(first_run, ["1", "2", "3"]) is None
+
+    os.remove(first_run["record_file"])
+    assert plan(first_run, ["1", "2", "3"]) is None
+
+
+def test_header_mismatch(first_run):
+    increment_file = write_long_table(os.path.join(first_run["output_dir"], "increment.csv"), {"2": 20},
+                                      header="specimen_id,feature,value,unit\n")
+    merged_file = os.path.join(first_run["output_dir"], "merged.csv")
+    with pytest.raises(ValueError, match="does not match"):
+        merge_feature_increment(first_run["long_file"], [increment_file], {"1", "3"}, merged_file)
+    assert not os.path.exists(merged_file)
+
+
+def test_merge_command_quoting(tmp_path):
+    output_dir = os.path.join(str(tmp_path), "output dir")
+    os.makedirs(output_dir)
+    paths = {name: os.path.join(output_dir, f"{name}.txt") for name in ["specimen ids", "increment ids"]}
+    increment_files = [os.path.join(output_dir, f"Feature Shard {idx}.csv") for idx in range(2)]
+    for path in list(paths.values()) + increment_files:
+        with open(path, "w") as f:
+            f.write("123\n")
+    command = incremental_features.merge_feature_increment_command(
+        paths["specimen ids"], paths["increment ids"], os.path.join(output_dir, "RawFeatureLong.csv"),
+        [os.path.join(output_dir, "SWC Upright")], "ab12", os.path.join(output_dir, "feature record.json"),
+        base_file=os.path.join(output_dir, "RawFeatureLong.csv"), increment_files=increment_files)
+    module = ags.ArgSchemaParser(schema_type=incremental_features.IO_Schema, args=shlex.split(command)[1:])
+    assert module.args["swc_dirs"] == [os.path.join(output_dir, "SWC Upright")]
+    assert module.args["increment_files"] == increment_files
+    assert module.args["base_file"] == os.path.join(output_dir, "RawFeatureLong.csv")
+    assert module.args["record_file"] == os.path.join(output_dir, "feature record.json")
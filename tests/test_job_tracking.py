@@ -0,0 +1,22 @@
+from skeleton_keychain.job_tracking import JobDatabase
+
+
+def test_get_accounting_of_many_jobs(tmp_path):
+    job_db = JobDatabase(str(tmp_path))
+    records = [{"job_id": str(job_id), "parent_job_id": str(job_id), "task_id": None, "state": "COMPLETED"}
+               for job_id in range(1200)]
+    records += [{"job_id": f"5000_{task_id}", "parent_job_id": "5000", "task_id": task_id, "state": "FAILED"}
+                for task_id in range(3)]
+    job_db.update_accounting(records)
+
+    parent_job_ids = [str(job_id) for job_id in range(100, 1200)] + ["5000", "9999"]
+    accounting = job_db.get_accounting(parent_job_ids)
+    assert list(accounting) == parent_job_ids
+    assert all([r["job_id"] for r in accounting[str(job_id)]] == [str(job_id)] for job_id in range(100, 1200))
+    assert sorted(r["task_id"] for r in accounting["5000"]) == [0, 1, 2]
+    assert accounting["9999"] == []
+
+    plan = job_db.connection.execute("explain query plan select * from accounting where parent_job_id in (?)",
+                                     ["5000"]).fetchall()
+    assert any("accounting_parent_job_id" in row[-1] for row in plan)
+    job_db.close()
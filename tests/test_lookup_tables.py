@@ -0,0 +1,98 @@
+import os
+import h5py
+import numpy as np
+from skeleton_keychain import swc_cache
+from skeleton_keychain.lookup_tables import MemmapLookup, convert_lookup_tables, find_lookup_tables, \
+    verify_lookup_tables, localize_lookup_tables
+
+
+def write_lookup_file(h5_file, seed=0):
+    rng = np.random.default_rng(seed)
+    with h5py.File(h5_file, "w") as f:
+        f.attrs["description"] = "synthetic surface paths"
+        paths = f.create_dataset("paths", data=rng.integers(0, 1000, size=(50, 20), dtype=np.int64))
+        paths.attrs["resolution"] = np.array([10.0, 10.0, 10.0])
+        f.create_dataset("volume lookup flat", data=rng.integers(-1, 50, size=200).astype(np.int32))
+        voxels = f.create_group("voxels")
+        voxels.attrs["units"] = "um"
+        distances = rng.random((10, 6, 4)).astype(np.float32)
+        distances[2, 3, 1] = np.nan
+        voxels.create_dataset("distances", data=distances)
+        voxels.create_dataset("empty", data=np.zeros((0, 3), dtype=np.uint16))
+
+
+def test_memmap_lookups_match_hdf5(tmp_path):
+    h5_file = os.path.join(str(tmp_path), "surface_paths.h5")
+    write_lookup_file(h5_file)
+    table_dir = os.path.join(str(tmp_path), "tables")
+    tables = convert_lookup_tables(h5_file, table_dir)
+    assert find_lookup_tables(h5_file, table_dir) == tables
+    assert verify_lookup_tables(h5_file, tables) == []
+
+    lookup = MemmapLookup(tables)
+    rows = np.array([3, 0, 49, 3])
+    with h5py.File(h5_file, "r") as h5_f:
+        assert sorted(lookup.keys()) == sorted(h5_f.keys())
+        assert lookup.attrs == {"description": "synthetic surface paths"}
+        np.testing.assert_array_equal(lookup["paths"][:], h5_f["paths"][:])
+        np.testing.assert_array_equal(lookup["paths"][7], h5_f["paths"][7])
+        np.testing.assert_array_equal(lookup["paths"][rows, :5], h5_f["paths"][:][rows, :5])
+        np.testing.assert_array_equal(lookup["paths"].attrs["resolution"], h5_f["paths"].attrs["resolution"])
+        flat = lookup["volume lookup flat"]
+        assert flat.dtype == h5_f["volume lookup flat"].dtype
+        np.testing.assert_array_equal(flat[10:20], h5_f["volume lookup flat"][10:20])
+        np.testing.assert_array_equal(lookup["voxels"]["distances"][:], h5_f["voxels"]["distances"][:])
+        np.testing.assert_array_equal(lookup["voxels/distances"][2, 3], h5_f["voxels/distances"][2, 3])
+        assert lookup["voxels"].attrs == {"units": "um"}
+        assert lookup["voxels/empty"].shape == h5_f["voxels/empty"].shape
+        assert ("voxels/distances" in lookup) and ("missing" not in lookup)
+
+    # reads are copy-on-write, changing one does not change the tables or later reads
+    paths = lookup["paths"]
+    paths[:] = -1
+    with h5py.File(h5_file, "r") as h5_f:
+        np.testing.assert_array_equal(lookup["paths"][:], h5_f["paths"][:])
+    lookup.close_tables()
+    assert verify_lookup_tables(h5_file, tables) == []
+
+
+def test_localized_tables(tmp_path):
+    h5_file = os.path.join(str(tmp_path), "closest_surface_voxel.h5")
+    write_lookup_file(h5_file, seed=1)
+    tables = convert_lookup_tables(h5_file, os.path.join(str(tmp_path), "tables"))
+    local_dir = os.path.join(str(tmp_path), "node local")
+    local_tables = localize_lookup_tables(tables, local_dir)
+    assert os.path.dirname(local_tables) == local_dir
+    assert localize_lookup_tables(tables, local_dir) == local_tables
+    assert verify_lookup_tables(h5_file, local_tables) == []
+
+
+def test_changed_file_gets_new_tables(tmp_path):
+    h5_file = os.path.join(str(tmp_path), "surface_paths.h5")
+    table_dir = os.path.join(str(tmp_path), "tables")
+    write_lookup_file(h5_file, seed=0)
+    tables = convert_lookup_tables(h5_file, table_dir)
+    write_lookup_file(h5_file, seed=2)
+    assert find_lookup_tables(h5_file, table_dir) is None
+    assert verify_lookup_tables(h5_file, tables) != []
+    new_tables = convert_lookup_tables(h5_file, table_dir)
+    assert new_tables != tables
+    assert verify_lookup_tables(h5_file, new_tables) == []
+
+
+def test_rewritten_file_of_same_size_gets_new_tables(tmp_path, monkeypatch):
+    monkeypatch.setattr(swc_cache, "FULL_HASH_MAX_BYTES", 1024)
+    monkeypatch.setattr(swc_cache, "_digest_memo", {})
+    h5_file = os.path.join(str(tmp_path), "surface_paths.h5")
+    table_dir = os.path.join(str(tmp_path), "tables")
+    write_lookup_file(h5_file, seed=0)
+    size = os.path.getsize(h5_file)
+    tables = convert_lookup_tables(h5_file, table_dir)
+
+    with h5py.File(h5_file, "r+") as f:
+        f["paths"][25, 10] = -1
+    assert os.path.getsize(h5_file) == size
+    assert find_lookup_tables(h5_file, table_dir) is None
+    new_tables = convert_lookup_tables(h5_file, table_dir)
+    assert new_tables != tables
+    assert verify_lookup_tables(h5_file, new_tables) == []
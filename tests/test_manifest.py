@@ -0,0 +1,93 @@
+import os
+import time
+from skeleton_keychain.manifest import RunManifest
+
+PARAMS = {"shrinkage_correction": True, "species": "mouse"}
+
+
+def write_file(file_path, content, mtime_ns=None):
+    with open(file_path, "w") as f:
+        f.write(content)
+    if mtime_ns is not None:
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+    return file_path
+
+
+def recorded_stage(tmp_path, **record_kwargs):
+    """Inputs, outputs and a manifest with one file_gen entry whose outputs were written after its submission"""
+    output_dir = str(tmp_path)
+    input_files = [write_file(os.path.join(output_dir, "123.swc"), "raw swc"),
+                   write_file(os.path.join(output_dir, "123.json"), "polygons")]
+    output_files = [os.path.join(output_dir, "123_upright.swc"), os.path.join(output_dir, "123_aligned.swc")]
+    manifest = RunManifest(output_dir)
+    manifest.record("file_gen", 123, input_files, PARAMS, output_files, **record_kwargs)
+    written_ns = manifest.get_entry("file_gen", 123)["submitted_at_ns"] + 1
+    for output_file in output_files:
+        write_file(output_file, "generated", written_ns)
+    return manifest, input_files, output_files
+
+
+def test_current_after_outputs_written(tmp_path):
+    manifest, input_files, output_files = recorded_stage(tmp_path)
+    assert manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+    assert not manifest.is_current("file_gen", 456, input_files, PARAMS, output_files)
+    assert not manifest.is_current("histogram", 123, input_files, PARAMS, output_files)
+
+    manifest.save()
+    assert RunManifest(str(tmp_path)).is_current("file_gen", "123", input_files, PARAMS, output_files)
+
+
+def test_changed_input_size_or_mtime(tmp_path):
+    manifest, input_files, output_files = recorded_stage(tmp_path)
+    st = os.stat(input_files[0])
+    write_file(input_files[0], "raw swc with more nodes", st.st_mtime_ns)
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+    manifest, input_files, output_files = recorded_stage(tmp_path)
+    st = os.stat(input_files[1])
+    os.utime(input_files[1], ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+
+def test_changed_params(tmp_path):
+    manifest, input_files, output_files = recorded_stage(tmp_path)
+    assert not manifest.is_current("file_gen", 123, input_files, dict(PARAMS, species="human"), output_files)
+
+
+def test_missing_or_stale_output(tmp_path):
+    manifest, input_files, output_files = recorded_stage(tmp_path)
+    os.remove(output_files[1])
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+    # an output left over from before the submission is not the result of this submission
+    manifest, input_files, output_files = recorded_stage(tmp_path)
+    write_file(output_files[1], "old", manifest.get_entry("file_gen", 123)["submitted_at_ns"] - 1_000_000_000)
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+
+def test_restored_outputs(tmp_path):
+    output_dir = str(tmp_path)
+    input_files = [write_file(os.path.join(output_dir, "123.swc"), "raw swc")]
+    first_written_ns = time.time_ns() - 3600 * 1_000_000_000
+    output_files = [write_file(os.path.join(output_dir, "123_upright.swc"), "cached", first_written_ns)]
+    manifest = RunManifest(output_dir)
+    manifest.record("file_gen", 123, input_files, PARAMS, output_files, outputs_restored=True)
+
+    # restored outputs keep the modification time they were first written at
+    assert manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+    write_file(output_files[0], "changed", first_written_ns)
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+
+def test_pending_inputs(tmp_path):
+    manifest, input_files, output_files = recorded_stage(tmp_path, inputs_pending=True)
+    assert manifest.get_entry("file_gen", 123)["inputs_fingerprint"] is None
+    assert manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+    # an input written after the outputs means the outputs were made from an older version of it
+    write_file(input_files[0], "regenerated", os.stat(output_files[0]).st_mtime_ns + 1_000_000)
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
+
+    os.remove(input_files[0])
+    assert not manifest.is_current("file_gen", 123, input_files, PARAMS, output_files)
@@ -0,0 +1,60 @@
+import pytest
+from skeleton_keychain.planning import estimate_specimen_costs, pack_specimens, predicted_makespan, schedule_plan
+
+
+def test_costs_in_bytes_without_history():
+    costs, unit = estimate_specimen_costs(["1", "2", "3"], {"1": 100, "2": 300})
+    assert unit == "bytes"
+    # specimen 3 has no swc file, it gets the median of the others
+    assert costs == {"1": 100.0, "2": 300.0, "3": 200.0}
+
+    assert estimate_specimen_costs(["1", "2"], {}) == (None, None)
+
+
+def test_costs_in_seconds():
+    input_bytes = {"1": 100, "2": 200, "3": 400}
+
+    # the stage's fitted run time converts sizes to seconds, its job overhead is not part of a specimen's cost
+    costs, unit = estimate_specimen_costs(["1", "2", "3"], input_bytes, time_model=(10.0, 0.5),
+                                          runtimes={"1": 70.0})
+    assert unit == "s"
+    assert costs == {"1": 60.0, "2": 100.0, "3": 200.0}
+
+    # without a fitted model the median seconds per byte of the specimens with history (0.5 and 1) is used, and
+    # specimen 4 without history or swc file gets the median of the others
+    costs, unit = estimate_specimen_costs([1, 2, 3, 4], input_bytes, runtimes={"1": 50.0, "2": 200.0})
+    assert unit == "s"
+    assert costs == {"1": 50.0, "2": 200.0, "3": pytest.approx(300.0), "4": pytest.approx(200.0)}
+
+
+def test_lpt_packing_balance():
+    specimen_ids = [str(sp_id) for sp_id in range(10)]
+    costs = {sp_id: cost for sp_id, cost in zip(specimen_ids, [1, 9, 2, 8, 3, 7, 4, 6, 5, 5])}
+    bins = pack_specimens(specimen_ids, costs, 3)
+
+    assert sorted(sp_id for b in bins for sp_id in b) == sorted(specimen_ids)
+    bin_costs = [sum(costs[sp_id] for sp_id in b) for b in bins]
+    assert bin_costs == sorted(bin_costs, reverse=True)
+    # 50 over 3 bins, the best packing has a largest bin of 17 and LPT is within 4/3 of it
+    assert max(bin_costs) <= 17 * 4 / 3
+    assert max(bin_costs) - min(bin_costs) <= max(costs.values())
+    assert all(b == sorted(b, key=int) for b in bins)
+
+    # a huge specimen gets a bin to itself
+    costs["0"] = 100
+    assert pack_specimens(specimen_ids, costs, 3)[0] == ["0"]
+    assert pack_specimens(specimen_ids[:2], costs, 5) == [["0"], ["1"]]
+
+
+def test_predicted_makespan():
+    assert predicted_makespan([]) == 0.0
+    assert predicted_makespan([5.0, 3.0, 2.0]) == 5.0
+    # the 4th job waits for the first free slot, which frees up after 5 seconds
+    assert predicted_makespan([5.0, 3.0, 2.0, 4.0], concurrency=2) == 9.0
+    assert predicted_makespan([5.0, 3.0, 2.0, 4.0], concurrency=1) == 14.0
+
+    units = [["1", "2"], ["3"]]
+    costs = {"1": 10.0, "2": 20.0, "3": 25.0}
+    plan = schedule_plan("feature_shards", units, costs, "s", job_overhead_s=5.0, concurrency=1)
+    assert (plan["max_unit_cost"], plan["mean_unit_cost"], plan["predicted_makespan_s"]) == (35.0, 32.5, 65.0)
+    assert schedule_plan("feature_shards", units, costs, "bytes")["predicted_makespan_s"] is None
@@ -0,0 +1,69 @@
+import os
+import pytest
+from skeleton_keychain.preflight import run_preflight
+
+SWC = "# header\n1 1 0.0 0.0 0.0 5.0 -1\n2 3 0.0 10.0 0.0 1.0 1\n"
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """Raw swc and polygon json directories where 100 is fine and 101-104 each have one problem"""
+    swc_dir = os.path.join(str(tmp_path), "raw")
+    json_dir = os.path.join(str(tmp_path), "polygons")
+    os.makedirs(swc_dir)
+    os.makedirs(json_dir)
+    files = {(swc_dir, f"{sp_id}.swc"): SWC for sp_id in range(100, 105)}
+    files.update({(json_dir, f"{sp_id}.json"): '{"pia_path": []}' for sp_id in range(100, 105)})
+    del files[(swc_dir, "101.swc")]
+    files[(swc_dir, "102.swc")] = ""
+    files[(swc_dir, "103.swc")] = "# header\n1 soma 0.0 0.0 0.0 5.0 -1\n"
+    files[(json_dir, "104.json")] = '{"pia_path": ['
+    for (directory, file_name), content in files.items():
+        with open(os.path.join(directory, file_name), "w") as f:
+            f.write(content)
+    return {"required_inputs": [(swc_dir, ".swc", "swc"), (json_dir, ".json", "json")],
+            "report_file": os.path.join(str(tmp_path), "preflight_report.txt")}
+
+
+def read_report(report_file):
+    with open(report_file, "r") as f:
+        assert f.readline() == "specimen_id\tstatus\tproblems\n"
+        return {line.split("\t")[0]: line.rstrip("\n").split("\t")[1:] for line in f}
+
+
+def test_exclude(inputs):
+    passed = run_preflight([104, 103, 102, 101, 100], inputs["required_inputs"], action="exclude",
+                           report_file=inputs["report_file"])
+    assert passed == ["100"]
+
+    report = read_report(inputs["report_file"])
+    assert report["100"] == ["ok", ""]
+    assert all(report[sp_id][0] == "failed" for sp_id in ["101", "102", "103", "104"])
+    assert report["101"][1].startswith("missing ")
+    assert report["102"][1].startswith("empty ")
+    assert "first node line is not numeric" in report["103"][1]
+    assert "invalid json" in report["104"][1]
+
+
+def test_abort(inputs):
+    for sp_id in [101, 102, 103, 104]:
+        with pytest.raises(ValueError, match="1 specimens have missing or invalid inputs"):
+            run_preflight([100, sp_id], inputs["required_inputs"], action="abort")
+    assert run_preflight([100], inputs["required_inputs"], action="abort") == ["100"]
+
+    # without content checks only missing and empty files fail
+    assert run_preflight([100, 103, 104], inputs["required_inputs"], action="abort",
+                         check_contents=False) == ["100", "103", "104"]
+
+
+def test_shared_inputs(inputs, tmp_path):
+    layer_depths_file = os.path.join(str(tmp_path), "layer_depths.json")
+    with open(layer_depths_file, "w") as f:
+        f.write("{'2/3': 100}")
+    for action in ["abort", "exclude"]:
+        with pytest.raises(ValueError, match="invalid json"):
+            run_preflight([100], inputs["required_inputs"], shared_files={"layer_depths_file": layer_depths_file},
+                          action=action)
+    with pytest.raises(ValueError, match="does not exist"):
+        run_preflight([100], inputs["required_inputs"], action="exclude",
+                      shared_files={"layer_depths_file": layer_depths_file + ".missing"})
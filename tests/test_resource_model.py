@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+from skeleton_keychain import resource_model
+from skeleton_keychain.job_tracking import JobDatabase
+
+
+def record_run(job_db, job_id, state):
+    run_id = job_db.start_run("slurm", 1)
+    node = {"id": 1, "name": "1001-file-gen", "stage": "file_gen", "specimen_ids": ["1001"], "input_bytes": 100,
+            "job_file": "1001.sh", "slurm_kwargs": {"--mem": "10gb", "--time": "60"}}
+    job_db.record_jobs(run_id, SimpleNamespace(nodes=[node], job_ids={1: job_id}, parent_index={1: []}))
+    job_db.update_accounting([{"job_id": job_id, "parent_job_id": job_id, "task_id": None, "state": state,
+                               "elapsed_s": 30.0, "max_rss_mb": 500.0}])
+    return run_id
+
+
+def test_only_unfinished_runs_are_refreshed(tmp_path, monkeypatch):
+    output_dir = str(tmp_path)
+    job_db = JobDatabase(output_dir)
+    record_run(job_db, "101", "COMPLETED")
+    running_run_id = record_run(job_db, "102", "RUNNING")
+    job_db.close()
+
+    refreshed_run_ids = []
+
+    def update_job_status(job_db, run_id, output_dir):
+        refreshed_run_ids.append(run_id)
+        job_db.update_accounting([{"job_id": "102", "parent_job_id": "102", "task_id": None, "state": "COMPLETED",
+                                   "elapsed_s": 60.0, "max_rss_mb": 800.0}])
+
+    monkeypatch.setattr(resource_model, "update_job_status", update_job_status)
+    history = resource_model.load_job_history([output_dir])
+
+    assert refreshed_run_ids == [running_run_id]
+    assert [(h["elapsed_s"], h["max_rss_mb"]) for h in history] == [(30.0, 500.0), (60.0, 800.0)]
+
+    # once every job finished nothing is queried again
+    refreshed_run_ids.clear()
+    resource_model.load_job_history([output_dir])
+    assert refreshed_run_ids == []
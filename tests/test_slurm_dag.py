@@ -0,0 +1,39 @@
+import os
+from skeleton_keychain.SlurmDAG import Slurm_DAG
+from skeleton_keychain.executors import LocalExecutor
+
+
+def dag_node(job_dir, node_id, parent_ids, commands):
+    return {
+        "id": node_id,
+        "parent_ids": parent_ids,
+        "start_condition": "afterok",
+        "job_file": os.path.join(job_dir, f"{node_id}.sh"),
+        "slurm_kwargs": {"--output": os.path.join(job_dir, f"{node_id}_%j.out")},
+        "slurm_commands": commands,
+    }
+
+
+def test_submit_wide_dag(tmp_path):
+    job_dir = str(tmp_path)
+    n_branches = 50
+    log_file = os.path.join(job_dir, "log.txt")
+    nodes = [dag_node(job_dir, 0, [], [f"echo root >> {log_file}"])]
+    nodes += [dag_node(job_dir, i, [0], [f"echo {i} >> {log_file}"]) for i in range(1, n_branches + 1)]
+    nodes.append(dag_node(job_dir, n_branches + 1, list(range(1, n_branches + 1)), [f"echo merge >> {log_file}"]))
+
+    executor = LocalExecutor(max_cpus=4, poll_interval=0.05)
+    dag = Slurm_DAG(nodes)
+    last_job_id = dag.submit_dag_to_scheduler(executor=executor, max_workers=4)
+
+    assert set(dag.job_ids) == set(range(n_branches + 2))
+    assert last_job_id == dag.job_ids[n_branches + 1]
+    for node in nodes:
+        assert executor.jobs[dag.job_ids[node["id"]]]["parents"] == [dag.job_ids[p] for p in node["parent_ids"]]
+
+    assert set(executor.wait().values()) == {"COMPLETED"}
+    with open(log_file, "r") as f:
+        lines = f.read().split()
+    assert lines[0] == "root"
+    assert lines[-1] == "merge"
+    assert sorted(lines[1:-1], key=int) == [str(i) for i in range(1, n_branches + 1)]
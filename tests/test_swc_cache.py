@@ -0,0 +1,114 @@
+import os
+import shlex
+import time
+import argschema as ags
+from skeleton_keychain import swc_cache
+from skeleton_keychain.manifest import RunManifest
+from skeleton_keychain.swc_cache import SwcCache, CACHED_OUTPUTS
+
+
+def write_outputs(output_dir, sp_id):
+    output_files = {output: os.path.join(output_dir, f"{sp_id}_{file_name}")
+                    for output, file_name in CACHED_OUTPUTS.items()}
+    for output, path in output_files.items():
+        with open(path, "w") as f:
+            f.write(f"{sp_id} {output}\n")
+    return output_files
+
+
+def test_restore_leaves_cached_files_alone(tmp_path):
+    cache = SwcCache(os.path.join(str(tmp_path), "cache"))
+    generated_dir = os.path.join(str(tmp_path), "generated")
+    restored_dir = os.path.join(str(tmp_path), "restored")
+    os.makedirs(generated_dir)
+    os.makedirs(restored_dir)
+    assert cache.store("ab12", "123", write_outputs(generated_dir, "123"))
+
+    cached_files = [os.path.join(cache.entry_dir("ab12"), file_name) for file_name in CACHED_OUTPUTS.values()]
+    cached_mtimes = [os.stat(f).st_mtime_ns for f in cached_files]
+    time.sleep(0.01)
+
+    manifest = RunManifest(restored_dir)
+    restored_files = {output: os.path.join(restored_dir, f"restored_{file_name}")
+                      for output, file_name in CACHED_OUTPUTS.items()}
+    cache.restore("ab12", restored_files)
+    manifest.record("file_gen", "123", [], {}, list(restored_files.values()), outputs_restored=True)
+    cache.close()
+
+    assert [os.stat(f).st_mtime_ns for f in cached_files] == cached_mtimes
+    for output, file_name in CACHED_OUTPUTS.items():
+        assert os.path.samefile(restored_files[output], os.path.join(cache.entry_dir("ab12"), file_name))
+    # restored files are older than the manifest entry but still current
+    assert manifest.is_current("file_gen", "123", [], {}, list(restored_files.values()))
+
+    os.remove(restored_files["la_file"])
+    with open(restored_files["la_file"], "w") as f:
+        f.write("changed\n")
+    assert not manifest.is_current("file_gen", "123", [], {}, list(restored_files.values()))
+
+
+def test_generated_outputs_written_after_submission(tmp_path):
+    manifest = RunManifest(str(tmp_path))
+    output_files = list(write_outputs(str(tmp_path), "123").values())
+    time.sleep(0.01)
+    manifest.record("file_gen", "123", [], {}, output_files)
+    assert not manifest.is_current("file_gen", "123", [], {}, output_files)
+    write_outputs(str(tmp_path), "123")
+    assert manifest.is_current("file_gen", "123", [], {}, output_files)
+
+
+def test_large_file_digest(tmp_path, monkeypatch):
+    monkeypatch.setattr(swc_cache, "FULL_HASH_MAX_BYTES", 1024)
+    monkeypatch.setattr(swc_cache, "_digest_memo", {})
+    h5_file = os.path.join(str(tmp_path), "surface_paths.h5")
+    memo_dir = os.path.join(str(tmp_path), "cache")
+    data = bytearray(os.urandom(8 * 1024))
+    with open(h5_file, "wb") as f:
+        f.write(data)
+    digest = swc_cache.content_digest(h5_file, memo_dir=memo_dir)
+
+    # later runs take the remembered digest while the file is unchanged
+    monkeypatch.setattr(swc_cache, "_digest_memo", {})
+    hashed = []
+    hash_file = swc_cache.hash_file
+    monkeypatch.setattr(swc_cache, "hash_file", lambda *args: hashed.append(args) or hash_file(*args))
+    assert swc_cache.content_digest(h5_file, memo_dir=memo_dir) == digest
+    assert hashed == []
+
+    # the same size with different data in the middle is a different file
+    data[4 * 1024] ^= 0xFF
+    with open(h5_file, "wb") as f:
+        f.write(data)
+    os.utime(h5_file, ns=(os.stat(h5_file).st_atime_ns, os.stat(h5_file).st_mtime_ns + 1000))
+    assert swc_cache.content_digest(h5_file, memo_dir=memo_dir) != digest
+    assert len(hashed) == 1
+
+
+def test_restore_of_evicted_entry(tmp_path):
+    cache = SwcCache(os.path.join(str(tmp_path), "cache"), max_bytes=0)
+    generated_dir = os.path.join(str(tmp_path), "generated")
+    os.makedirs(generated_dir)
+    assert cache.store("ab12", "123", write_outputs(generated_dir, "123"))
+    assert cache.lookup({"123": "ab12"}) == {"123": "ab12"}
+
+    # another run evicts the entry between this run's lookup and restore
+    assert cache.evict() == 1
+    assert cache.lookup({"123": "ab12"}) == {}
+    restored_files = write_outputs(generated_dir, "456")
+    assert not cache.restore("ab12", restored_files)
+    assert not any(os.path.lexists(f) for f in restored_files.values())
+    cache.close()
+
+
+def test_store_command_quoting(tmp_path):
+    output_dir = os.path.join(str(tmp_path), "output dir")
+    command = swc_cache.swc_cache_store_command("123", os.path.join(str(tmp_path), "swc cache"),
+                                                os.path.join(output_dir, "swc cache keys.txt"), 1.5,
+                                                os.path.join(output_dir, "SWC Upright"),
+                                                os.path.join(output_dir, "SWC LayerAligned"),
+                                                os.path.join(output_dir, "QC Images"))
+    module = ags.ArgSchemaParser(schema_type=swc_cache.IO_Schema, args=shlex.split(command)[1:])
+    assert module.args["cache_dir"] == os.path.join(str(tmp_path), "swc cache")
+    assert module.args["key_file"] == os.path.join(output_dir, "swc cache keys.txt")
+    assert module.args["upright_swc_dir"] == os.path.join(output_dir, "SWC Upright")
+    assert (module.args["specimen_id"], module.args["max_cache_gb"]) == ("123", 1.5)
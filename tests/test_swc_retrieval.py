@@ -0,0 +1,83 @@
+import os
+import re
+import numpy as np
+from skeleton_keychain.swc_retrieval import query_for_swc_files, retrieve_swc_files, is_same_file
+
+
+class FakeQueryEngine:
+    """Stands in for the LIMS query engine, answers from a specimen id -> swc path dict and records its queries"""
+
+    def __init__(self, swc_paths):
+        self.swc_paths = swc_paths
+        self.queries = []
+
+    def queried_specimen_ids(self, query_idx=-1):
+        return re.search(r"nr\.specimen_id in \(([^)]*)\)", self.queries[query_idx]).group(1).split(", ")
+
+    def __call__(self, query):
+        self.queries.append(query)
+        return [{"specimen_id": int(sp_id), "storage_directory": os.path.dirname(path),
+                 "filename": os.path.basename(path)}
+                for sp_id, path in self.swc_paths.items() if sp_id in self.queried_specimen_ids()]
+
+
+def write_swc(path, n_nodes):
+    with open(path, "w") as f:
+        for node_id in range(1, n_nodes + 1):
+            f.write(f"{node_id} 3 {node_id}.0 0.0 0.0 1.0 {node_id - 1 if node_id > 1 else -1}\n")
+
+
+def test_query_specimen_id_formatting():
+    engine = FakeQueryEngine({"123": "/lims/a/123_recon.swc", "789": "/lims/b/789_recon.swc"})
+    swc_paths = query_for_swc_files([123, "456", np.int64(789), np.float64(1011.0)], query_engine=engine)
+
+    assert len(engine.queries) == 1
+    assert engine.queried_specimen_ids() == ["123", "456", "789", "1011"]
+    assert swc_paths == {"123": "/lims/a/123_recon.swc", "789": "/lims/b/789_recon.swc"}
+
+
+def test_retrieve_swc_files(tmp_path):
+    storage_dir = os.path.join(str(tmp_path), "lims storage")
+    dst_dir = os.path.join(str(tmp_path), "raw swc")
+    os.makedirs(storage_dir)
+    os.makedirs(dst_dir)
+    swc_paths = {}
+    for sp_id in range(100, 120):
+        swc_paths[str(sp_id)] = os.path.join(storage_dir, f"{sp_id}_recon.swc")
+        write_swc(swc_paths[str(sp_id)], sp_id - 95)
+    # known to the database but missing from storage
+    swc_paths["120"] = os.path.join(storage_dir, "120_recon.swc")
+    engine = FakeQueryEngine(swc_paths)
+    specimen_ids = [str(sp_id) for sp_id in range(100, 122)]
+
+    report = retrieve_swc_files(specimen_ids, dst_dir, query_engine=engine, max_workers=4, progress_interval=5)
+    assert sorted(report["copied"]) == [str(sp_id) for sp_id in range(100, 120)]
+    assert report["skipped"] == []
+    assert set(report["failed"]) == {"120", "121"}
+    assert report["failed"]["121"] == "no swc file found in database"
+    assert report["failed"]["120"].startswith("copy failed")
+    for sp_id in range(100, 120):
+        dst_path = os.path.join(dst_dir, f"{sp_id}.swc")
+        assert is_same_file(swc_paths[str(sp_id)], dst_path)
+        with open(swc_paths[str(sp_id)], "r") as src, open(dst_path, "r") as dst:
+            assert src.read() == dst.read()
+
+    # files already copied are skipped, a file that changed in storage is copied again
+    write_swc(swc_paths["105"], 2)
+    os.utime(swc_paths["105"], (0, 0))
+    report = retrieve_swc_files(specimen_ids, dst_dir, query_engine=engine, max_workers=4)
+    assert report["copied"] == ["105"]
+    assert sorted(report["skipped"]) == sorted(str(sp_id) for sp_id in range(100, 120) if sp_id != 105)
+    assert is_same_file(swc_paths["105"], os.path.join(dst_dir, "105.swc"))
+
+
+def test_is_same_file(tmp_path):
+    src_path = os.path.join(str(tmp_path), "src.swc")
+    dst_path = os.path.join(str(tmp_path), "dst.swc")
+    write_swc(src_path, 3)
+    assert not is_same_file(src_path, dst_path)
+    write_swc(dst_path, 3)
+    os.utime(dst_path, (os.stat(src_path).st_atime, os.stat(src_path).st_mtime))
+    assert is_same_file(src_path, dst_path)
+    os.utime(dst_path, (0, 0))
+    assert not is_same_file(src_path, dst_path)